@@ -1,4 +1,7 @@
 from .netmd import netmd_device as devices
-from .netmd.download import download_track
-from .playlist import archive_playlist, find_next_playlist_path_name, Playlist
-from .transcode import Transcode as TranscodeMD
\ No newline at end of file
+from .netmd.download import download_track, download_tracks
+from .netmd.emulator import EmulatedNetMDUSB
+from .netmd.hotplug import DeviceMonitor
+from .netmd.preflight import Preflight
+from .playlist import archive_playlist, find_next_playlist_path_name, Playlist, TagIndex
+from .transcode import Transcode as TranscodeMD, TranscodeCache, TranscodeStream as TranscodeStreamMD
\ No newline at end of file
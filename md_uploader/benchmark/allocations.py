@@ -0,0 +1,66 @@
+"""Simulated upload allocation benchmark
+
+Runs download_track against the NetMD emulator and reports tracemalloc
+figures and timings for the protocol path (handshake, titling, commit) and
+for a full upload of test.wav.
+
+Run from the md_uploader directory:
+```
+$ python -m benchmark.allocations
+```
+"""
+
+import argparse
+import os
+from pathlib import Path
+import tempfile
+import time
+import tracemalloc
+
+from netmd.download import download_track
+from netmd.emulator import EmulatedNetMDUSB
+from netmd.netmd_device import NetMD
+
+
+TEST_WAV_PATH = Path(__file__).resolve().parents[2].joinpath('test.wav')
+
+
+def create_pcm_file(size):
+    (fd, filename) = tempfile.mkstemp(suffix='.pcm')
+    with os.fdopen(fd, 'wb') as file:
+        file.write(TEST_WAV_PATH.read_bytes()[:size])
+    return filename
+
+
+def measure(filename, iterations):
+    net_md = NetMD(EmulatedNetMDUSB())
+    tracemalloc.start()
+    started = time.perf_counter()
+    for iteration in range(iterations):
+        download_track(net_md, filename, 'Track title %d' % iteration)
+    elapsed = time.perf_counter() - started
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (elapsed / iterations, peak, net_md.net_md_usb.commands // iterations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    small = create_pcm_file(2048 * 4)
+    full = create_pcm_file(os.path.getsize(TEST_WAV_PATH))
+    try:
+        for (name, filename, iterations) in (('protocol', small, args.iterations),
+                                             ('test.wav', full, 5)):
+            (per_upload, peak, commands) = measure(filename, iterations)
+            print('%-9s %4d uploads  %3d commands each  %8.3f ms/upload  peak %9.1f KiB' % (
+                name, iterations, commands, per_upload * 1000, peak / 1024.0))
+    finally:
+        os.remove(small)
+        os.remove(full)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Bulk transfer throughput benchmark
+
+Compares synchronous bulk writes with AsyncBulkWriter against the fake USB
+handle of tests/fake_usb.py. The fake completes each transfer after a fixed
+setup latency plus the time its payload takes at the configured bus bandwidth.
+Queued transfers are serviced back to back, so only synchronous writes pay the
+latency for every transfer.
+
+Run from the md_uploader directory:
+```
+$ python -m benchmark.bulk_transfer --latency-ms 1 --bandwidth-mbs 20
+```
+"""
+
+import argparse
+import time
+
+from netmd.bulk_transfer import AsyncBulkWriter
+from tests.fake_usb import FakeBulkHandle
+
+
+def run_sync(handle, writes, write_size):
+    data = bytes(write_size)
+    started = time.perf_counter()
+    for write in range(writes):
+        handle.bulkWrite(0x02, data)
+    return time.perf_counter() - started
+
+
+def run_async(handle, writes, write_size, transfer_count, transfer_size):
+    data = bytes(write_size)
+    writer = AsyncBulkWriter(handle, 0x02, handle.handle_events,
+                             transfer_count, transfer_size)
+    started = time.perf_counter()
+    for write in range(writes):
+        writer.write(data)
+    writer.flush()
+    return (time.perf_counter() - started, writer.stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency-ms', type=float, default=1.0)
+    parser.add_argument('--bandwidth-mbs', type=float, default=20.0)
+    parser.add_argument('--writes', type=int, default=8)
+    parser.add_argument('--write-size', type=int, default=128 * 1024 + 24)
+    parser.add_argument('--transfer-size', type=int, default=16 * 1024)
+    parser.add_argument('--transfers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    latency = args.latency_ms / 1000.0
+    bandwidth = args.bandwidth_mbs * 1e6
+    total = args.writes * args.write_size
+
+    handle = FakeBulkHandle(latency, bandwidth)
+    elapsed = run_sync(handle, args.writes, args.write_size)
+    print('sync       %8.3f s  %6.2f MB/s' % (elapsed, total / elapsed / 1e6))
+
+    for transfer_count in args.transfers:
+        handle = FakeBulkHandle(latency, bandwidth)
+        (elapsed, stats) = run_async(handle, args.writes, args.write_size,
+                                     transfer_count, args.transfer_size)
+        assert handle.bytes == total, (handle.bytes, total)
+        print('async/%-4d %8.3f s  %6.2f MB/s' % (transfer_count, elapsed,
+                                                  total / elapsed / 1e6))
+        print('           %s' % stats.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+"""Query/response codec micro-benchmark
+
+Checks that the compiled codec gives the same results as the original
+character-by-character implementation for every format string used in
+netmd_device.py, and times both. The original returned string fields as str,
+they are compared as bytes.
+
+Run from the md_uploader directory:
+```
+$ python -m benchmark.codec
+```
+"""
+
+import argparse
+import ast
+from pathlib import Path
+import sys
+import timeit
+
+from netmd.codec import compile_query
+from netmd.codec import compile_response
+
+
+NETMD_DEVICE_PATH = Path(__file__).resolve().parents[1].joinpath('netmd', 'netmd_device.py')
+
+FORMAT_TYPE_LEN_DICT = {
+    'b': 1,
+    'w': 2,
+    'd': 4,
+    'q': 8,
+}
+
+
+def legacy_format_query(format, *args):
+    result = []
+    append = result.append
+    extend = result.extend
+    half = None
+    def hexAppend(value):
+        append(int(value, 16))
+    escaped = False
+    arg_stack = list(args)
+    for char in format:
+        if escaped:
+            escaped = False
+            value = arg_stack.pop(0)
+            if char in FORMAT_TYPE_LEN_DICT:
+                for byte in range(FORMAT_TYPE_LEN_DICT[char] - 1, -1, -1):
+                    append((value >> (byte * 8)) & 0xff)
+            elif char == 'x':
+                length = len(value)
+                append((length >> 8) & 0xff)
+                append(length & 0xff)
+                extend(ord(x) for x in value)
+            elif char == '*':
+                extend(ord(x) for x in value)
+            else:
+                raise ValueError('Unrecognised format char: %r' % (char, ))
+            continue
+        if char == '%':
+            assert half is None
+            escaped = True
+            continue
+        if char == ' ':
+            continue
+        if half is None:
+            half = char
+        else:
+            hexAppend(half + char)
+            half = None
+    assert len(arg_stack) == 0
+    return result
+
+
+def legacy_parse_response(response, format):
+    result = []
+    append = result.append
+    half = None
+    escaped = False
+    input_stack = list(response)
+    def pop():
+        return input_stack.pop(0)
+    for char in format:
+        if escaped:
+            escaped = False
+            if char == '?':
+                pop()
+                continue
+            if char in FORMAT_TYPE_LEN_DICT:
+                value = 0
+                for byte in range(FORMAT_TYPE_LEN_DICT[char] - 1, -1, -1):
+                    value |= (pop() << (byte * 8))
+                append(value)
+            elif char in ('s', 'x'):
+                length = pop() << 8 | pop()
+                value = ''.join(''.join(chr(c) for c in input_stack)[:length])
+                input_stack = input_stack[length:]
+                if char == 's':
+                    append(value[:-1])
+                else:
+                    append(value)
+            elif char == '*':
+                value = ''.join(chr(c) for c in input_stack)
+                input_stack = []
+                append(value)
+            else:
+                raise ValueError('Unrecognised format char: %r' % (char, ))
+            continue
+        if char == '%':
+            assert half is None
+            escaped = True
+            continue
+        if char == ' ':
+            continue
+        if half is None:
+            half = char
+        else:
+            input_value = pop()
+            format_value = int(half + char, 16)
+            if format_value != input_value:
+                raise ValueError('Format and input mismatch at %i: '
+                    'expected %02x, got %02x' % (
+                        len(response) - len(input_stack) - 1,
+                        format_value, input_value))
+            half = None
+    assert len(input_stack) == 0
+    return result
+
+
+def find_format_strings():
+    """
+      Returns (queries, responses): the format strings passed to
+      __send_query and __parse_response in netmd_device.py.
+    """
+    tree = ast.parse(NETMD_DEVICE_PATH.read_text())
+    queries = []
+    responses = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Attribute):
+            continue
+        if node.func.attr == '__send_query':
+            queries.append(string_literal(node.args[0]))
+        elif node.func.attr == '__parse_response':
+            responses.append(string_literal(node.args[1]))
+    return (sorted(set(queries) - {None}), sorted(set(responses) - {None}))
+
+
+def string_literal(node):
+    """
+      Value of a string literal node, None for any other node. Python
+      before 3.8 parses literals as ast.Str.
+    """
+    if sys.version_info < (3, 8):
+        return node.s if isinstance(node, ast.Str) else None
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    return None
+
+
+def fields(format):
+    return [format[index + 1] for (index, char) in enumerate(format) if char == '%']
+
+
+def sample_args(format, string_length):
+    samples = {
+        'b': 0x12,
+        'w': 0x1234,
+        'd': 0x12345678,
+        'q': 0x123456789abcdef0,
+        'x': ''.join(chr(c % 256) for c in range(string_length)),
+        '*': ''.join(chr(c % 256) for c in range(string_length)),
+    }
+    return [samples[char] for char in fields(format)]
+
+
+def sample_response(format, string_length):
+    """
+      Build a response matching format.
+    """
+    pieces = []
+    for (index, char) in enumerate(format.split('%')):
+        if index:
+            field = char[0]
+            char = char[1:]
+            payload = bytes(c % 256 for c in range(string_length))
+            if field in FORMAT_TYPE_LEN_DICT:
+                pieces.append(bytes(range(1, FORMAT_TYPE_LEN_DICT[field] + 1)))
+            elif field == '?':
+                pieces.append(b'\x5a')
+            elif field == 'x':
+                pieces.append(len(payload).to_bytes(2, 'big') + payload)
+            elif field == 's':
+                pieces.append((len(payload) + 1).to_bytes(2, 'big') + payload + b'\0')
+            elif field == '*':
+                pieces.append(payload)
+        pieces.append(bytes.fromhex(char.replace(' ', '')))
+    return b''.join(pieces)
+
+
+def as_bytes(value):
+    """
+      The old codec returned string fields as str, the new one as bytes.
+    """
+    if isinstance(value, str):
+        return value.encode('latin-1')
+    return value
+
+
+def best_time(statement, number):
+    return min(timeit.repeat(statement, number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=200)
+    parser.add_argument('--string-length', type=int, default=64,
+                        help='size of %%x/%%s/%%* values')
+    args = parser.parse_args()
+
+    (queries, responses) = find_format_strings()
+    if not queries or not responses:
+        # nothing would be checked
+        sys.exit('No format strings found in %s' % (NETMD_DEVICE_PATH, ))
+    print('%-70s %10s %10s %7s' % ('format', 'old us', 'new us', 'speedup'))
+
+    total_old = total_new = 0.0
+    for format in queries:
+        query_args = sample_args(format, args.string_length)
+        encoder = compile_query(format)
+        expected = legacy_format_query(format, *query_args)
+        assert list(encoder.encode(*query_args)) == expected, format
+        old = best_time(lambda: legacy_format_query(format, *query_args), args.number)
+        new = best_time(lambda: compile_query(format).encode(*query_args), args.number)
+        total_old += old
+        total_new += new
+        print('Q %-68s %10.2f %10.2f %6.1fx' % (format, old * 1e6, new * 1e6, old / new))
+
+    for format in responses:
+        response = sample_response(format, args.string_length)
+        expected = [as_bytes(value) for value in legacy_parse_response(response, format)]
+        assert compile_response(format).decode(response) == expected, format
+        old = best_time(lambda: legacy_parse_response(response, format), args.number)
+        new = best_time(lambda: compile_response(format).decode(response), args.number)
+        total_old += old
+        total_new += new
+        print('R %-68s %10.2f %10.2f %6.1fx' % (format, old * 1e6, new * 1e6, old / new))
+
+    print('%d query and %d response formats, %.1fx faster overall' % (
+        len(queries), len(responses), total_old / total_new))
+
+
+if __name__ == '__main__':
+    main()
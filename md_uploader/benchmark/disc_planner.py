@@ -0,0 +1,74 @@
+"""Multi-disc planning benchmark
+
+Plans a synthetic playlist of albums across discs and reports how long
+planning takes, the number of discs against the lower bound the total
+duration gives, and how many albums end up split across discs. The exit
+status is 1 when planning takes longer than the budget.
+
+Run from the md_uploader directory:
+```
+$ python -m benchmark.disc_planner --tracks 20000 --budget 1
+```
+"""
+
+import argparse
+import math
+import random
+import sys
+import time
+from pathlib import Path
+
+from netmd.preflight import track_space
+from playlist.playlist import Track
+from playlist.planner import plan_discs
+from playlist.tag_index import TrackTags
+
+
+def create_tracks(count, seed):
+    """
+      Returns count Tracks in albums of 6 to 14 tracks of 2 to 8 minutes.
+    """
+    generator = random.Random(seed)
+    tracks = []
+    album = 0
+    while len(tracks) < count:
+        album += 1
+        for number in range(min(generator.randint(6, 14), count - len(tracks))):
+            path = Path('/music/Album %d/%02d.flac' % (album, number + 1))
+            tags = TrackTags('Track %d' % (number + 1, ), 'Artist %d' % (album % 100, ),
+                             generator.uniform(120, 480), 'Album %d' % (album, ))
+            tracks.append(Track(path, tags))
+    return tracks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=20000)
+    parser.add_argument('--capacity', type=float, default=80 * 60,
+                        help='disc capacity in seconds')
+    parser.add_argument('--budget', type=float, default=1.0,
+                        help='allowed planning time in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    tracks = create_tracks(args.tracks, args.seed)
+    start = time.perf_counter()
+    discs = plan_discs(tracks, args.capacity, space=track_space)
+    elapsed = time.perf_counter() - start
+
+    fewest = int(math.ceil(sum(track_space(track.duration) for track in tracks) / args.capacity))
+    albums = {}
+    for disc in discs:
+        for track in disc.tracks:
+            albums.setdefault(track.album, set()).add(disc.number)
+    split = sum(1 for numbers in albums.values() if len(numbers) > 1)
+    print('%d tracks  %.3f s  %d discs (at least %d)  %d of %d albums split' % (
+        len(tracks), elapsed, len(discs), fewest, split, len(albums)))
+
+    if elapsed > args.budget:
+        print('FAILED planning takes %.3f s, over %.3f s' % (elapsed, args.budget))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
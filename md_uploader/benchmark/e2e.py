@@ -0,0 +1,218 @@
+"""End-to-end upload benchmark with regression baselines
+
+Uploads synthetic playlists made of copies of test.wav (wrapped in a WAV
+header) to the NetMD emulator: transcoding, one secure session, track data,
+deferred titles. Each playlist runs in a fresh process and reports:
+  transcode, encrypt, usb_write, handshake, titling
+                  wall time of each stage in seconds, encrypt covering reading
+                  and framing the packets as well; the tracks are 16-bit WAV,
+                  so transcode times the in-process conversion, never ffmpeg
+  elapsed         wall time of the whole upload
+  bytes_per_sec   bulk bytes written over elapsed
+  peak_rss        peak resident set size in KiB, None where unavailable
+  round_trips     commands sent to the device
+
+The emulated bus writes 16 MiB/s by default, so usb_write measures the
+transfers rather than only the call overhead.
+
+Results can be saved as a JSON baseline and later runs compared with it. A
+metric regresses when it exceeds the baseline by more than the tolerance
+(bytes_per_sec when it falls below it); round trips must not grow at all.
+Times must also grow by more than 10 ms, below which they are timer noise.
+The exit status is 1 on regressions.
+
+Run from the md_uploader directory:
+```
+$ python -m benchmark.e2e --save baseline.json
+$ python -m benchmark.e2e --baseline baseline.json --tolerance 0.25
+```
+"""
+
+import argparse
+import json
+from multiprocessing import Pool
+import os
+import shutil
+import sys
+import tempfile
+import time
+import wave
+
+from benchmark.packets import TEST_WAV_PATH
+from netmd.download import download_tracks
+from netmd.emulator import EmulatedNetMDUSB
+from netmd.netmd_device import NetMD
+from transcode import Transcode
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+PLAYLIST_LENGTHS = (1, 5, 20)
+
+STAGE_METHODS = {
+    'handshake': ('disable_new_track_protection', 'enter_secure_session',
+                  'send_key_data', 'exchange_session_key', 'forget_session_key',
+                  'leave_secure_session', 'setup_download', 'commit_track'),
+    'titling': ('cache_toc', 'set_track_title', 'sync_toc'),
+}
+COST_METRICS = ('transcode', 'encrypt', 'usb_write', 'handshake', 'titling',
+                'elapsed', 'peak_rss')
+TIME_METRICS = ('transcode', 'encrypt', 'usb_write', 'handshake', 'titling', 'elapsed')
+# seconds a time may grow by on top of the tolerance, timer noise
+NOISE_FLOOR = 0.010
+DEFAULT_BANDWIDTH = 16 << 20
+
+
+def create_playlist(directory, length):
+    """
+      Write length WAV files holding the samples of test.wav.
+    """
+    samples = TEST_WAV_PATH.read_bytes()
+    samples = samples[:len(samples) - len(samples) % 4]
+    filenames = []
+    for number in range(length):
+        filename = os.path.join(directory, '%02d.wav' % number)
+        with wave.open(filename, 'wb') as output:
+            output.setnchannels(2)
+            output.setsampwidth(2)
+            output.setframerate(44100)
+            output.writeframes(samples)
+        filenames.append(filename)
+    return filenames
+
+
+def time_methods(net_md, stages):
+    """
+      Wrap the NetMD methods of STAGE_METHODS to add their time to stages.
+    """
+    for (stage, names) in STAGE_METHODS.items():
+        for name in names:
+            setattr(net_md, name, timed(getattr(net_md, name), stages, stage))
+
+
+def timed(method, stages, stage):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            stages[stage] += time.perf_counter() - started
+    return wrapper
+
+
+def run_playlist(options):
+    (length, command_latency, bulk_bandwidth) = options
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = create_playlist(directory, length)
+        net_md_usb = EmulatedNetMDUSB(command_latency=command_latency,
+                                      bulk_bandwidth=bulk_bandwidth)
+        net_md = NetMD(net_md_usb)
+        stages = dict.fromkeys(('transcode', 'encrypt', 'usb_write', 'handshake', 'titling'), 0.0)
+        time_methods(net_md, stages)
+
+        def pcm_tracks():
+            for (number, filename) in enumerate(filenames):
+                started = time.perf_counter()
+                with Transcode(filename) as pcm_filename:
+                    stages['transcode'] += time.perf_counter() - started
+                    yield (pcm_filename, 'Track %d' % number)
+
+        started = time.perf_counter()
+        for _ in download_tracks(net_md, pcm_tracks()):
+            stages['encrypt'] += net_md.transfer_stats.produce_time
+            stages['usb_write'] += net_md.transfer_stats.write_time
+        elapsed = time.perf_counter() - started
+    finally:
+        shutil.rmtree(directory)
+
+    result = dict(stages)
+    result.update({
+        'elapsed': elapsed,
+        'bytes_per_sec': net_md_usb.bulk_bytes / elapsed,
+        'peak_rss': peak_rss(),
+        'round_trips': net_md_usb.commands,
+    })
+    return result
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def compare(results, baseline, tolerance):
+    """
+      Returns a list of regression descriptions.
+    """
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        for metric in COST_METRICS:
+            if result.get(metric) is None or expected.get(metric) is None:
+                continue
+            slack = NOISE_FLOOR if metric in TIME_METRICS else 0
+            if result[metric] > expected[metric] * (1 + tolerance) + slack:
+                regressions.append('%s %s: %.3f > %.3f' % (
+                    name, metric, result[metric], expected[metric]))
+        if result['bytes_per_sec'] < expected['bytes_per_sec'] * (1 - tolerance):
+            regressions.append('%s bytes_per_sec: %.0f < %.0f' % (
+                name, result['bytes_per_sec'], expected['bytes_per_sec']))
+        if result['round_trips'] > expected['round_trips']:
+            regressions.append('%s round_trips: %d > %d' % (
+                name, result['round_trips'], expected['round_trips']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lengths', type=int, nargs='+', default=PLAYLIST_LENGTHS,
+                        help='number of tracks of each playlist')
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='emulated seconds until a command reply is available')
+    parser.add_argument('--bandwidth', type=int, default=DEFAULT_BANDWIDTH,
+                        help='emulated bulk write bytes per second, 0 for unlimited')
+    parser.add_argument('--baseline', help='JSON baseline to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative regression')
+    parser.add_argument('--save', help='write the results as a JSON baseline')
+    args = parser.parse_args()
+
+    results = {}
+    # a fresh process per playlist keeps peak RSS meaningful
+    with Pool(1, maxtasksperchild=1) as pool:
+        for length in args.lengths:
+            name = '%d_tracks' % length
+            results[name] = pool.apply(run_playlist, ((length, args.latency, args.bandwidth or None), ))
+            result = results[name]
+            print('%-10s %7.3f s  %6.1f KiB/s  rss %8s KiB  %4d round trips  '
+                  'transcode %.3f  encrypt %.3f  usb_write %.3f  handshake %.3f  titling %.3f' % (
+                      name, result['elapsed'], result['bytes_per_sec'] / 1024.0,
+                      result['peak_rss'], result['round_trips'], result['transcode'],
+                      result['encrypt'], result['usb_write'], result['handshake'],
+                      result['titling']))
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
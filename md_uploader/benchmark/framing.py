@@ -0,0 +1,83 @@
+"""Packet framing throughput benchmark
+
+Compares the copying path, get_packets followed by pipeline.frame_packet, with
+MDTrack.get_framed_packets, which encrypts the track straight into the packet
+buffer. Per packet the former copies the data three times (file read, cipher
+output, header concatenation), the latter once (cipher output).
+
+The input is test.wav from the repository root, repeated to the requested
+length, read from a file (mmap'd by get_framed_packets) and from a PcmStream.
+Run from the md_uploader directory:
+```
+$ python -m benchmark.framing --minutes 10
+```
+"""
+
+import argparse
+from contextlib import contextmanager
+import os
+import time
+import tracemalloc
+
+from benchmark.packets import create_pcm_file
+from netmd.constants import WIREFORMAT_PCM
+from netmd.download import MDTrack
+from netmd.pipeline import frame_packet
+from transcode.transcode import PcmStream
+
+
+def copying_packets(track):
+    for (key, iv, data) in track.get_packets():
+        yield frame_packet(key, iv, data)
+
+
+def framed_packets(track):
+    return track.get_framed_packets()
+
+
+def measure(produce, source, filename, max_packets_in_flight):
+    with source(filename) as filename:
+        track = MDTrack(filename, '', WIREFORMAT_PCM, max_packets_in_flight)
+        tracemalloc.start()
+        started = time.perf_counter()
+        total = 0
+        for packet in produce(track):
+            total += len(packet)
+        elapsed = time.perf_counter() - started
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return (total, elapsed, peak)
+
+
+@contextmanager
+def file_source(filename):
+    yield filename
+
+
+@contextmanager
+def stream_source(filename):
+    with open(filename, 'rb') as file:
+        yield PcmStream(file, os.path.getsize(filename))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--minutes', type=float, default=10)
+    parser.add_argument('--max-packets-in-flight', type=int, default=1)
+    args = parser.parse_args()
+
+    filename = create_pcm_file(args.minutes)
+    try:
+        for (source_name, source) in (('file', file_source),
+                                      ('stream', stream_source)):
+            for (name, produce) in (('copying', copying_packets),
+                                    ('framed', framed_packets)):
+                (total, elapsed, peak) = measure(produce, source, filename, args.max_packets_in_flight)
+                print('%-6s %-7s %8.1f MiB/s  peak %8.1f KiB' % (
+                    source_name, name, total / elapsed / (1 << 20), peak / 1024.0))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Import time benchmark
+
+Imports each module in a fresh interpreter under `python -X importtime` and
+reports its cumulative import time, the best of several runs. A module fails
+when it takes longer than the budget or when importing it loads USB or cipher
+modules, which must only be loaded once a device or session is used.
+The exit status is 1 on failures.
+
+Run from the md_uploader directory:
+```
+$ python -m benchmark.imports --budget 50
+```
+"""
+
+import argparse
+import subprocess
+import sys
+
+
+MODULES = ('netmd.netmd_device', 'netmd.download', 'netmd.emulator', 'netmd.hotplug',
+           'playlist', 'transcode')
+DEFERRED_MODULES = ('usb1', 'libusb1', 'Crypto')
+
+CHECK_DEFERRED = '''
+import sys
+loaded = set(name.split('.')[0] for name in sys.modules)
+print(' '.join(sorted(loaded.intersection(%r))))
+'''
+
+
+def import_time(module):
+    """
+      Returns the cumulative import time of module in seconds and the
+      DEFERRED_MODULES importing it loaded.
+    """
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import %s\n%s' % (module, CHECK_DEFERRED % (DEFERRED_MODULES, ))],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+        universal_newlines=True)
+    cumulative = None
+    for line in output.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            cumulative = int(fields[1]) / 1e6
+    return (cumulative, output.stdout.split())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modules', nargs='+', default=MODULES)
+    parser.add_argument('--budget', type=float, default=50,
+                        help='allowed import time of each module in milliseconds')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    failures = []
+    for module in args.modules:
+        results = [import_time(module) for _ in range(args.runs)]
+        elapsed = min(cumulative for (cumulative, _) in results)
+        loaded = results[0][1]
+        print('%-20s %7.1f ms%s' % (module, elapsed * 1e3,
+                                     '  loads ' + ' '.join(loaded) if loaded else ''))
+        if elapsed * 1e3 > args.budget:
+            failures.append('%s takes %.1f ms to import, over %.1f ms' % (
+                module, elapsed * 1e3, args.budget))
+        if loaded:
+            failures.append('%s loads %s on import' % (module, ', '.join(loaded)))
+
+    for failure in failures:
+        print('FAILED', failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Packet producer memory benchmark
+
+Compares peak memory of MDTrack.get_packets when its output is collected into
+a list (the way send_track used to receive it) with streaming consumption.
+
+The input is test.wav from the repository root, repeated to the requested
+length. Run from the md_uploader directory:
+```
+$ python -m benchmark.packets --minutes 10
+```
+"""
+
+import argparse
+import os
+from pathlib import Path
+import tempfile
+import time
+import tracemalloc
+
+from netmd.constants import WIREFORMAT_PCM
+from netmd.download import MDTrack
+
+
+TEST_WAV_PATH = Path(__file__).resolve().parents[2].joinpath('test.wav')
+PCM_BYTES_PER_MINUTE = 44100 * 2 * 2 * 60
+
+
+def create_pcm_file(minutes):
+    sample = TEST_WAV_PATH.read_bytes()
+    target_size = int(minutes * PCM_BYTES_PER_MINUTE)
+
+    (fd, filename) = tempfile.mkstemp(suffix='.pcm')
+    with os.fdopen(fd, 'wb') as file:
+        written = 0
+        while written < target_size:
+            chunk = sample[:target_size - written]
+            file.write(chunk)
+            written += len(chunk)
+    return filename
+
+
+def measure(consume, track):
+    tracemalloc.start()
+    started = time.perf_counter()
+    packet_count = consume(track.get_packets())
+    elapsed = time.perf_counter() - started
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (packet_count, elapsed, peak)
+
+
+def consume_list(packets):
+    return len(list(packets))
+
+
+def consume_stream(packets):
+    packet_count = 0
+    for (key, iv, data) in packets:
+        packet_count += 1
+    return packet_count
+
+
+def check_identical(filename):
+    listed = [(key, iv, bytes(data)) for (key, iv, data) in
+              MDTrack(filename, '', WIREFORMAT_PCM, max_packets_in_flight=1).get_packets()]
+    batched = MDTrack(filename, '', WIREFORMAT_PCM, max_packets_in_flight=3).get_packets()
+    for (expected, (key, iv, data)) in zip(listed, batched):
+        if expected != (key, iv, bytes(data)):
+            raise AssertionError('Batched packets differ from single packet output')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--minutes', type=float, default=10)
+    parser.add_argument('--in-flight', type=int, nargs='+', default=[1, 4])
+    args = parser.parse_args()
+
+    filename = create_pcm_file(args.minutes)
+    try:
+        check_identical(filename)
+        print('%.1f minutes of PCM, %d bytes' % (args.minutes, os.path.getsize(filename)))
+
+        runs = [('list', consume_list, 1)] + \
+            [('stream/%d' % in_flight, consume_stream, in_flight) for in_flight in args.in_flight]
+        for (name, consume, in_flight) in runs:
+            track = MDTrack(filename, '', WIREFORMAT_PCM, max_packets_in_flight=in_flight)
+            (packet_count, elapsed, peak) = measure(consume, track)
+            print('%-10s %4d packets  %7.3f s  peak %8.1f MiB' % (
+                name, packet_count, elapsed, peak / float(1 << 20)))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Playlist tag scanning benchmark
+
+Computes the aggregates of a playlist of WAV files (test.wav wrapped in a WAV
+header) with tags read serially, on a thread pool and through a TagIndex, cold
+and warm. Reading a file's tags is slowed down by --latency seconds to stand
+in for a network mount.
+
+Run from the md_uploader directory:
+```
+$ python -m benchmark.playlist_scan --tracks 30 --latency 0.05
+```
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from benchmark.e2e import create_playlist
+from playlist import playlist as playlist_module
+from playlist import Playlist
+from playlist import TagIndex
+
+
+def slow_read_tags(read_tags, latency):
+    def read(path):
+        time.sleep(latency)
+        return read_tags(path)
+    return read
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds added to reading the tags of a file')
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    read_tags = playlist_module.read_tags
+    playlist_module.read_tags = slow_read_tags(read_tags, args.latency)
+    try:
+        music_path = os.path.join(directory, 'music')
+        os.mkdir(music_path)
+        filenames = create_playlist(music_path, args.tracks)
+        playlist_path = os.path.join(directory, 'playlist.m3u')
+        with open(playlist_path, 'w') as file:
+            for filename in filenames:
+                file.write('X:\\%s\n' % os.path.basename(filename))
+
+        with TagIndex(os.path.join(directory, 'tags.db')) as tag_index:
+            for (name, options) in (('serial', {'max_workers': 1}),
+                                    ('threaded', {'max_workers': args.workers}),
+                                    ('index cold', {'max_workers': args.workers, 'tag_index': tag_index}),
+                                    ('index warm', {'max_workers': args.workers, 'tag_index': tag_index})):
+                playlist = Playlist(music_path, ['wav'], playlist_path, **options)
+                playlist.is_single_artist()
+                stats = playlist.scan_stats
+                print('%-10s %7.3f s  %3d tracks  index hit rate %.2f' % (
+                    name, stats.seconds, stats.tracks, stats.hit_rate()))
+    finally:
+        playlist_module.read_tags = read_tags
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Transcript replay benchmark
+
+Replays a NetMD USB transcript recorded with netmd.transcript while running
+the same upload, download_track of test.wav from the repository root, and
+reports the Python side time with the recorded device timing reproduced,
+scaled or left out. A transcript can be recorded against the emulator, or
+against the first connected device with --device.
+
+Run from the md_uploader directory:
+```
+$ python -m benchmark.replay record upload.trace --device
+$ python -m benchmark.replay replay upload.trace --time-scale 0 --profile
+```
+"""
+
+import argparse
+import cProfile
+import pstats
+import time
+
+from benchmark.packets import TEST_WAV_PATH
+from netmd.download import download_track
+from netmd.emulator import EmulatedNetMDUSB
+from netmd.netmd_device import NetMD
+from netmd.transcript import ReplayNetMDUSB
+from netmd.transcript import RecordingNetMDUSB
+
+
+TITLE = 'Replay benchmark'
+
+
+def record(args):
+    if args.device:
+        from netmd import netmd_device as devices
+        net_md = next(devices)
+    else:
+        net_md = NetMD(EmulatedNetMDUSB(command_latency=args.latency,
+                                        bulk_bandwidth=args.bandwidth or None))
+    with RecordingNetMDUSB(net_md.net_md_usb, args.trace) as recorder:
+        net_md.net_md_usb = recorder
+        started = time.perf_counter()
+        download_track(net_md, str(TEST_WAV_PATH), TITLE)
+        print('recorded %.3f s' % (time.perf_counter() - started, ))
+
+
+def replay(args):
+    net_md_usb = ReplayNetMDUSB(args.trace, time_scale=args.time_scale)
+    net_md = NetMD(net_md_usb)
+    profile = cProfile.Profile() if args.profile else None
+    started = time.perf_counter()
+    if profile is not None:
+        profile.enable()
+    download_track(net_md, str(TEST_WAV_PATH), TITLE)
+    if profile is not None:
+        profile.disable()
+    elapsed = time.perf_counter() - started
+    print('replayed %.3f s at time scale %g, %d commands, %d bulk bytes' % (
+        elapsed, args.time_scale, net_md_usb.commands, net_md_usb.bulk_bytes))
+    print(net_md.transfer_stats)
+    if profile is not None:
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    record_parser = subparsers.add_parser('record')
+    record_parser.add_argument('trace')
+    record_parser.add_argument('--device', action='store_true',
+                               help='record the first connected NetMD device')
+    record_parser.add_argument('--latency', type=float, default=0.01,
+                               help='emulated seconds until a command reply is available')
+    record_parser.add_argument('--bandwidth', type=int, default=1 << 20,
+                               help='emulated bulk write bytes per second, 0 for unlimited')
+    record_parser.set_defaults(run=record)
+
+    replay_parser = subparsers.add_parser('replay')
+    replay_parser.add_argument('trace')
+    replay_parser.add_argument('--time-scale', type=float, default=1.0,
+                               help='factor applied to the recorded timing, 0 to skip it')
+    replay_parser.add_argument('--profile', action='store_true')
+    replay_parser.set_defaults(run=replay)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
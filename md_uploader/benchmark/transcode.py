@@ -0,0 +1,109 @@
+"""Native vs ffmpeg transcode benchmark
+
+Builds 16-bit WAV and AIFF files of the requested length from the samples in
+test.wav in the repository root, converts them with Transcode (in process) and with ffmpeg,
+checks the PCM is identical and times both. The ffmpeg run is skipped when it
+is not installed.
+
+Run from the md_uploader directory:
+```
+$ python -m benchmark.transcode --minutes 10
+```
+"""
+
+import argparse
+from array import array
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+import wave
+
+from benchmark.packets import TEST_WAV_PATH
+from transcode import Transcode
+from transcode.transcode import DEV_NULL
+
+
+def create_sources(minutes, channels=2, sample_rate=44100):
+    # test.wav holds headerless PCM, it is only used as sample content
+    frames = TEST_WAV_PATH.read_bytes()
+    target_size = int(minutes * 60 * sample_rate * channels * 2)
+    target_size -= target_size % (channels * 2)
+    data = (frames * (target_size // len(frames) + 1))[:target_size]
+
+    (fd, wav_filename) = tempfile.mkstemp(suffix='.wav')
+    os.close(fd)
+    with wave.open(wav_filename, 'wb') as output:
+        output.setnchannels(channels)
+        output.setsampwidth(2)
+        output.setframerate(sample_rate)
+        output.writeframes(data)
+
+    samples = array('h', data)
+    samples.byteswap()
+    (fd, aiff_filename) = tempfile.mkstemp(suffix='.aiff')
+    with os.fdopen(fd, 'wb') as output:
+        write_aiff(output, channels, sample_rate, samples.tobytes())
+    return (wav_filename, aiff_filename)
+
+
+def write_aiff(output, channels, sample_rate, data):
+    exponent = sample_rate.bit_length() - 1
+    mantissa = sample_rate << (63 - exponent)
+    comm = struct.pack('>hIhHQ', channels, len(data) // (2 * channels), 16,
+                       exponent + 16383, mantissa)
+    output.write(struct.pack('>4sI4s', b'FORM', 4 + 8 + len(comm) + 16 + len(data), b'AIFF'))
+    output.write(struct.pack('>4sI', b'COMM', len(comm)) + comm)
+    output.write(struct.pack('>4sIII', b'SSND', 8 + len(data), 0, 0))
+    output.write(data)
+
+
+def time_native(track_filename):
+    start = time.perf_counter()
+    with Transcode(track_filename) as filename:
+        elapsed = time.perf_counter() - start
+        with open(filename, 'rb') as file:
+            return (elapsed, file.read())
+
+
+def time_ffmpeg(track_filename):
+    (fd, filename) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        start = time.perf_counter()
+        subprocess.check_call(['ffmpeg', '-y', '-i', track_filename, '-f', 's16be', filename],
+                              stdout=DEV_NULL, stderr=DEV_NULL)
+        elapsed = time.perf_counter() - start
+        with open(filename, 'rb') as file:
+            return (elapsed, file.read())
+    finally:
+        os.remove(filename)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--minutes', type=float, default=10)
+    args = parser.parse_args()
+
+    sources = create_sources(args.minutes)
+    has_ffmpeg = shutil.which('ffmpeg') is not None
+    try:
+        for track_filename in sources:
+            (native_time, native_pcm) = time_native(track_filename)
+            print('%-5s native: %7.3f s' % (os.path.splitext(track_filename)[1], native_time))
+            if has_ffmpeg:
+                (ffmpeg_time, ffmpeg_pcm) = time_ffmpeg(track_filename)
+                print('%-5s ffmpeg: %7.3f s%s' % (
+                    os.path.splitext(track_filename)[1], ffmpeg_time,
+                    '' if ffmpeg_pcm == native_pcm else ' (PCM DIFFERS)'))
+        if not has_ffmpeg:
+            print('ffmpeg not found, skipped')
+    finally:
+        for track_filename in sources:
+            os.remove(track_filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Emulated upload benchmark
+
+Uploads test.wav from the repository root several times in one session to the
+NetMD emulator with a configurable command latency and bulk bandwidth, and
+reports the wall time, command count and the last track's transfer stats.
+Needs no hardware, so it can run in CI.
+
+Run from the md_uploader directory:
+```
+$ python -m benchmark.upload --tracks 3 --latency 0.01 --bandwidth 1048576
+```
+"""
+
+import argparse
+import time
+
+from benchmark.packets import TEST_WAV_PATH
+from netmd.download import download_tracks
+from netmd.emulator import EmulatedNetMDUSB
+from netmd.netmd_device import NetMD
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='seconds until a command reply is available')
+    parser.add_argument('--bandwidth', type=int, default=1 << 20,
+                        help='bulk write bytes per second, 0 for unlimited')
+    parser.add_argument('--queue-depth', type=int, default=2)
+    args = parser.parse_args()
+
+    net_md_usb = EmulatedNetMDUSB(command_latency=args.latency,
+                                  bulk_bandwidth=args.bandwidth or None)
+    net_md = NetMD(net_md_usb, queue_depth=args.queue_depth)
+    tracks = [(str(TEST_WAV_PATH), 'Track %d' % number) for number in range(args.tracks)]
+
+    started = time.perf_counter()
+    for (track_number, uuid, ccid) in download_tracks(net_md, tracks):
+        print('track %d uploaded after %.3f s' % (track_number, time.perf_counter() - started))
+    elapsed = time.perf_counter() - started
+
+    print('%d tracks  %.3f s  %d commands  %.1f KiB/s' % (
+        args.tracks, elapsed, net_md_usb.commands,
+        net_md_usb.bulk_bytes / elapsed / 1024.0))
+    print(net_md.transfer_stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# modules import each other as top level packages, as when run from here
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# scripts meant to be run by hand against a real device and music library
+collect_ignore = ['e2e_test.py', 'playlist_test.py', 'md_upload_ctl.py', 'md_upload_daemon.py']
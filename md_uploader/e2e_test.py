@@ -2,9 +2,10 @@ from transliterate import translit
 import usb1
 
 from netmd import netmd_device as devices
-from netmd.download import download_track
+from netmd.download import download_tracks
+from netmd.preflight import Preflight
 from playlist import archive_playlist, find_next_playlist_path_name, Playlist
-from transcode import Transcode
+from transcode import TranscodeStream
 
 
 PATH_MUSIC = '/mnt/music'
@@ -37,19 +38,27 @@ print(playlist.duration())
 is_va_disc = not playlist.is_single_artist()
 md_disc_title = playlist.title()
 
+plan = Preflight(net_md).check(track.duration for track in playlist)
+print(plan)
+if not plan.fits:
+    print('Playlist does not fit on the disc, only the first %d tracks do' % plan.fitting_tracks)
+    exit(1)
+
 net_md.erase_disc()
 net_md.set_disc_title(clean_string(md_disc_title))
 
-for track in playlist:
-    md_track_title = clean_string(track.title if not is_va_disc else '%s - %s' % (track.artist, track.title))
-    print(md_track_title)
+def pcm_tracks():
+    for track in playlist:
+        md_track_title = clean_string(track.title if not is_va_disc else '%s - %s' % (track.artist, track.title))
+        print(md_track_title)
 
-    with Transcode(track.path) as path_pcm:
-        (track_number, uuid, ccid) = download_track(net_md, path_pcm, md_track_title)
+        with TranscodeStream(track.path) as pcm:
+            yield (pcm, md_track_title)
 
+for (track_number, uuid, ccid) in download_tracks(net_md, pcm_tracks()):
     print('Track:', track_number)
-    print("UUID:",''.join(["%02x" % ord(i) for i in uuid]))
-    print("Confirmed Content ID:",''.join(["%02x"%ord(i) for i in ccid]))
+    print("UUID:", uuid.hex())
+    print("Confirmed Content ID:", ccid.hex())
 
 archive_playlist(playlist_path_name, PLAYLIST_ARCHIVE_PATH)
 
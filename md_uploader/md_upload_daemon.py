@@ -0,0 +1,387 @@
+"""Upload daemon
+
+Keeps the USB context and the NetMD device open between uploads and takes
+upload jobs over a Unix socket, so a job does not pay for interpreter start,
+imports and device enumeration. Jobs run one at a time in the order they are
+received; the connection that submitted a job receives its progress as JSON
+lines until the job is done.
+
+Start the daemon, then submit playlists:
+```
+$ python md_upload_daemon.py serve
+$ python md_upload_daemon.py submit /mnt/music/_minidisc_queue/disc.m3u
+```
+Served with --transcode-cache, the PCM ffmpeg produces is kept in that
+directory, so uploading the same tracks again skips transcoding.
+
+A job is one JSON object on a line:
+  playlist         playlist file (required)
+  music_path       root the playlist paths are relative to
+  extensions       list of accepted track file extensions
+  erase            erase the disc first, default true
+  transliterate    language to transliterate titles from, e.g. "ru"
+  archive_path     directory to move the playlist to when done
+  device_timeout   seconds to wait for a device when none is plugged in
+  lookahead        tracks converted to temporary PCM files ahead of the one
+                   being uploaded; 0, the default, streams each track from
+                   ffmpeg as it is uploaded instead
+  split            split playlists too long for the disc, default false
+  split_path       directory for the per-disc playlists, by default the one
+                   of the playlist
+Events sent back have an "event" field: queued, waiting_for_device, started,
+preflight, split, track_started, progress, track_done, done or error. A
+playlist that does not fit on the disc is rejected before the disc is erased.
+With split, it is instead planned across as few discs as possible and written
+as one playlist per disc: the job uploads the first, the others are left to be
+submitted once the next disc is in. The original playlist is archived. Nothing
+is written when the first disc's share does not fit after all, and split
+requires erase since every disc is planned as empty.
+"""
+
+import argparse
+import json
+import os
+from queue import Queue
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+import usb1
+
+from netmd.download import download_tracks
+from netmd.exception import NetMDException
+from netmd.hotplug import DeviceMonitor
+from netmd.hotplug import LEFT
+from netmd.netmd_device import NetMD
+from netmd.preflight import DEFAULT_THROUGHPUT
+from netmd.preflight import Preflight
+from netmd.preflight import track_space
+from playlist import archive_playlist, Playlist, TagIndex
+from playlist.planner import plan_discs
+from playlist.planner import write_disc_playlists
+from transcode import TranscodeCache
+from transcode import TranscodeScheduler
+from transcode import TranscodeStream
+
+
+SOCKET_PATH = '/tmp/md_uploader.sock'
+DEFAULT_MUSIC_PATH = '/mnt/music'
+DEFAULT_EXTENSIONS = ['flac']
+PROGRESS_INTERVAL = 1.0  # seconds between progress events per track
+DEVICE_TIMEOUT = 60.0  # seconds a job waits for a device to be plugged in
+TRANSCODE_CACHE_BYTES = 4 << 30  # about four discs of PCM
+
+strip_ascii = lambda string: string.encode('ascii', errors='ignore').decode('ascii')
+
+
+class UploadJob(object):
+    def __init__(self, options):
+        if 'playlist' not in options:
+            raise ValueError('Job has no playlist')
+        self.options = options
+        self.events = Queue()
+
+    def send(self, event, **fields):
+        fields['event'] = event
+        self.events.put(fields)
+
+
+class Uploader(object):
+    """
+      Runs queued jobs on a worker thread against a NetMD device that stays
+      open across jobs. The device is opened on the first job and again
+      after a USB or protocol error or once it was unplugged; a job waits
+      for a device to be plugged in when there is none.
+    """
+
+    __DONE = object()
+
+    def __init__(self, tag_index=None, transcode_cache=None):
+        self.jobs = Queue()
+        self.tag_index = tag_index
+        self.transcode_cache = transcode_cache
+        self.net_md = None
+        self.monitor = None
+        self.device_left = False
+        self.preflight = None
+        # measured on earlier uploads, for the upload time estimate
+        self.throughput = DEFAULT_THROUGHPUT
+        self.worker = threading.Thread(target=self.__run, name='md-upload-worker')
+        self.worker.daemon = True
+
+    def start(self):
+        self.worker.start()
+
+    def submit(self, job):
+        job.send('queued', position=self.jobs.qsize())
+        self.jobs.put(job)
+
+    def __run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                self.__upload(job)
+            except Exception as e:
+                traceback.print_exc()
+                if isinstance(e, (NetMDException, usb1.USBError)):
+                    # reopen the device for the next job
+                    self.net_md = None
+                job.send('error', message='%s: %s' % (type(e).__name__, e))
+            finally:
+                job.events.put(Uploader.__DONE)
+
+    def __get_device(self, job):
+        if self.net_md is not None and not self.device_left:
+            return self.net_md
+        self.net_md = None
+        self.device_left = False
+        if self.monitor is None:
+            self.monitor = DeviceMonitor(callback=self.__on_device_event)
+            self.monitor.start()
+        net_md_usb = self.monitor.wait_for_device(0)
+        if net_md_usb is None:
+            job.send('waiting_for_device')
+            net_md_usb = self.monitor.wait_for_device(
+                job.options.get('device_timeout', DEVICE_TIMEOUT))
+        if net_md_usb is None:
+            raise NetMDException('No NetMD devices found')
+        self.net_md = NetMD(net_md_usb)
+        return self.net_md
+
+    def __on_device_event(self, event):
+        if event.kind == LEFT:
+            self.device_left = True
+
+    def __upload(self, job):
+        options = job.options
+        clean_string = self.__title_cleaner(options.get('transliterate'))
+        playlist = Playlist(options.get('music_path', DEFAULT_MUSIC_PATH),
+                            options.get('extensions', DEFAULT_EXTENSIONS),
+                            options['playlist'], tag_index=self.tag_index)
+        # reads the tags of every track once, before the device is touched
+        is_va_disc = not playlist.is_single_artist()
+        net_md = self.__get_device(job)
+        job.send('started', playlist=options['playlist'], tracks=playlist.count(),
+                 duration=playlist.duration(), scan_seconds=playlist.scan_stats.seconds,
+                 index_hit_rate=playlist.scan_stats.hit_rate())
+
+        erase = options.get('erase', True)
+        if self.preflight is None or self.preflight.net_md is not net_md:
+            self.preflight = Preflight(net_md)
+        # the disc may have been swapped since the last job
+        self.preflight.invalidate()
+        self.preflight.throughput = self.throughput
+        plan = self.preflight.check((track.duration for track in playlist), erase=erase)
+        job.send('preflight', **plan.to_dict())
+        if not plan.fits and options.get('split'):
+            if not erase:
+                job.send('error', message='Splitting a playlist requires erasing the disc')
+                return
+            discs = plan_discs(playlist, self.preflight.capacity().total, space=track_space)
+            # check the first disc before any playlist is written or archived
+            plan = self.preflight.check((track.duration for track in discs[0].tracks))
+            job.send('preflight', **plan.to_dict())
+            if plan.fits:
+                playlist = self.__split(job, playlist, discs)
+                is_va_disc = not playlist.is_single_artist()
+        if not plan.fits:
+            job.send('error', message='Playlist takes %.0f s, the disc has %.0f s; '
+                     'the first %d of %d tracks fit' % (plan.required, plan.available,
+                                                        plan.fitting_tracks, plan.track_count))
+            return
+
+        if erase:
+            net_md.erase_disc()
+        net_md.set_disc_title(clean_string(playlist.title()))
+
+        def titled_tracks():
+            for (index, track) in enumerate(playlist):
+                title = track.title or track.path.stem
+                title = clean_string(title if not is_va_disc else '%s - %s' % (track.artist, title))
+                yield (index, track, title)
+
+        def pcm_tracks():
+            lookahead = options.get('lookahead', 0)
+            if not lookahead:
+                for (index, track, title) in titled_tracks():
+                    job.send('track_started', index=index, title=title)
+                    with TranscodeStream(track.path, self.transcode_cache) as pcm:
+                        yield (pcm, title)
+                return
+            # the next tracks are converted while this one is uploaded
+            tracks = list(titled_tracks())
+            with TranscodeScheduler([track.path for (_, track, _) in tracks],
+                                    lookahead=lookahead,
+                                    cache=self.transcode_cache) as scheduler:
+                for ((index, track, title), pcm_filename) in zip(tracks, scheduler):
+                    job.send('track_started', index=index, title=title)
+                    yield (pcm_filename, title)
+
+        reported = 0.0
+        def progress(transfer):
+            nonlocal reported
+            if transfer.elapsed < reported + PROGRESS_INTERVAL and \
+                    transfer.bytes_sent < transfer.total_bytes:
+                return
+            reported = transfer.elapsed
+            if transfer.bytes_sent == transfer.total_bytes:
+                self.throughput = transfer.average_throughput() or self.throughput
+            job.send('progress', bytes_sent=transfer.bytes_sent,
+                     total_bytes=transfer.total_bytes,
+                     throughput=transfer.average_throughput(), eta=transfer.eta())
+
+        for (track_number, uuid, ccid) in download_tracks(net_md, pcm_tracks(), progress=progress):
+            reported = 0.0
+            job.send('track_done', track=track_number, uuid=uuid.hex())
+
+        if options.get('archive_path'):
+            archive_playlist(options['playlist'], options['archive_path'])
+        job.send('done')
+
+    def __split(self, job, playlist, discs):
+        """
+          Write a playlist per disc of discs (DiscPlans of the tracks of
+          playlist) and archive playlist.
+          Returns the Playlist of the first disc, which the job goes on with.
+        """
+        options = job.options
+        music_path = options.get('music_path', DEFAULT_MUSIC_PATH)
+        directory = options.get('split_path') or os.path.dirname(options['playlist'])
+        filenames = write_disc_playlists(discs, directory, playlist.title(), music_path)
+        job.send('split', playlists=filenames)
+        if options.get('archive_path'):
+            archive_playlist(options['playlist'], options['archive_path'])
+        options['playlist'] = filenames[0]
+        return Playlist(music_path, options.get('extensions', DEFAULT_EXTENSIONS),
+                        filenames[0], tag_index=self.tag_index)
+
+    def __title_cleaner(self, language):
+        if not language:
+            return strip_ascii
+        from transliterate import translit
+        return lambda string: strip_ascii(translit(string, language, reversed=True))
+
+    @staticmethod
+    def is_done(event):
+        return event is Uploader.__DONE
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = UploadJob(json.loads(line.decode('utf-8')))
+            except ValueError as e:
+                self.__write({'event': 'error', 'message': str(e)})
+                continue
+            self.server.uploader.submit(job)
+            while True:
+                event = job.events.get()
+                if Uploader.is_done(event):
+                    break
+                try:
+                    self.__write(event)
+                except OSError:
+                    # the client went away, the job carries on
+                    pass
+
+    def __write(self, event):
+        self.wfile.write(json.dumps(event).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+
+class UploadServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, uploader):
+        self.uploader = uploader
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, JobHandler)
+
+
+def serve(args):
+    # in memory by default, still saving the upload from reading the tags
+    # read for the playlist aggregates again
+    transcode_cache = None
+    if args.transcode_cache:
+        transcode_cache = TranscodeCache(args.transcode_cache, args.transcode_cache_bytes)
+    uploader = Uploader(TagIndex(args.tag_index or ':memory:'), transcode_cache)
+    uploader.start()
+    server = UploadServer(args.socket, uploader)
+    print('Listening on %s' % args.socket)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+def submit(args):
+    job = {'playlist': os.path.abspath(args.playlist), 'erase': not args.no_erase}
+    if args.music_path:
+        job['music_path'] = args.music_path
+    if args.extensions:
+        job['extensions'] = args.extensions
+    if args.transliterate:
+        job['transliterate'] = args.transliterate
+    if args.archive_path:
+        job['archive_path'] = args.archive_path
+    if args.split:
+        job['split'] = True
+    if args.split_path:
+        job['split_path'] = args.split_path
+    if args.lookahead is not None:
+        job['lookahead'] = args.lookahead
+    if args.device_timeout is not None:
+        job['device_timeout'] = args.device_timeout
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(args.socket)
+    client.sendall(json.dumps(job).encode('utf-8') + b'\n')
+    client.shutdown(socket.SHUT_WR)
+    failed = False
+    with client.makefile('rb') as events:
+        for line in events:
+            event = json.loads(line.decode('utf-8'))
+            print(json.dumps(event))
+            failed = failed or event['event'] == 'error'
+    client.close()
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('--tag-index', help='SQLite file caching track tags')
+    serve_parser.add_argument('--transcode-cache', help='directory caching transcoded PCM')
+    serve_parser.add_argument('--transcode-cache-bytes', type=int, default=TRANSCODE_CACHE_BYTES)
+    serve_parser.set_defaults(run=serve)
+
+    submit_parser = subparsers.add_parser('submit')
+    submit_parser.add_argument('playlist')
+    submit_parser.add_argument('--music-path')
+    submit_parser.add_argument('--extensions', nargs='+')
+    submit_parser.add_argument('--no-erase', action='store_true')
+    submit_parser.add_argument('--transliterate')
+    submit_parser.add_argument('--archive-path')
+    submit_parser.add_argument('--device-timeout', type=float)
+    submit_parser.add_argument('--lookahead', type=int)
+    submit_parser.add_argument('--split', action='store_true')
+    submit_parser.add_argument('--split-path')
+    submit_parser.set_defaults(run=submit)
+
+    args = parser.parse_args()
+    sys.exit(args.run(args))
+
+
+if __name__ == '__main__':
+    main()
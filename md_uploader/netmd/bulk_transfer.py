@@ -0,0 +1,165 @@
+"""Asynchronous bulk transfers
+
+Keeps several libusb bulk transfers queued so the bus does not go idle
+between writes. Used by NetMDUSB when asynchronous writes are enabled.
+"""
+
+from collections import deque
+from time import perf_counter
+
+import usb1
+
+from .exception import NetMDException
+
+
+class TransferStats(object):
+    """
+      Throughput counters of an AsyncBulkWriter.
+    """
+
+    def __init__(self, transfer_count, transfer_size):
+        self.transfer_count = transfer_count
+        self.transfer_size = transfer_size
+        self.bytes = 0
+        self.transfers = 0
+        self.max_in_flight = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+
+    def throughput(self):
+        """
+          Completed bytes per second while transfers were outstanding.
+        """
+        if not self.busy_time:
+            return 0.0
+        return self.bytes / self.busy_time
+
+    def report(self):
+        return '%d bytes in %d transfers of up to %d bytes, %.3f s busy, ' \
+               '%.3f s waiting for a free buffer, %.2f MB/s, ' \
+               '%d/%d transfers in flight at most' % (
+                   self.bytes, self.transfers, self.transfer_size,
+                   self.busy_time, self.wait_time, self.throughput() / 1e6,
+                   self.max_in_flight, self.transfer_count)
+
+
+class AsyncBulkWriter(object):
+    """
+      Keeps up to transfer_count bulk OUT transfers queued on an endpoint.
+      Data handed to write() is copied into a preallocated ring of
+      transfer_size buffers and split into as many transfers as needed.
+      transfer_size must be a multiple of the USB max packet size, so the
+      device sees the same packets as with a single synchronous transfer.
+      usb_handle (usb1.USBDeviceHandle)
+        Handle to allocate transfers from.
+      endpoint (int)
+        Bulk OUT endpoint.
+      handle_events (callable)
+        Processes pending USB events and runs completion callbacks, e.g.
+        usb1.USBContext.handleEvents.
+      Once a transfer fails, the ones queued behind it are cancelled and the
+      error is raised by the next write or flush.
+    """
+
+    __PACKET_ALIGNMENT = 512
+
+    def __init__(self, usb_handle, endpoint, handle_events, transfer_count=8,
+                 transfer_size=128 * 1024, timeout=0):
+        if transfer_count < 1:
+            raise ValueError('transfer_count must be at least 1')
+        if transfer_size <= 0 or transfer_size % AsyncBulkWriter.__PACKET_ALIGNMENT:
+            raise ValueError('transfer_size must be a positive multiple of %d' %
+                             AsyncBulkWriter.__PACKET_ALIGNMENT)
+        self.endpoint = endpoint
+        self.handle_events = handle_events
+        self.timeout = timeout
+        self.stats = TransferStats(transfer_count, transfer_size)
+        ring = memoryview(bytearray(transfer_count * transfer_size))
+        self.__buffers = [ring[slot * transfer_size:(slot + 1) * transfer_size]
+                          for slot in range(transfer_count)]
+        self.__transfers = [usb_handle.getTransfer() for slot in range(transfer_count)]
+        self.__free = deque(range(transfer_count))
+        self.__in_flight = 0
+        self.__busy_since = None
+        self.__error = None
+
+    def write(self, data):
+        """
+          Queue data for writing. Returns once all of it is submitted; call
+          flush() to wait for completion.
+        """
+        self.__raise_error()
+        data = memoryview(data).cast('B')
+        transfer_size = self.stats.transfer_size
+        for offset in range(0, len(data), transfer_size):
+            chunk = data[offset:offset + transfer_size]
+            slot = self.__acquire()
+            buffer = self.__buffers[slot][:len(chunk)]
+            buffer[:] = chunk
+            transfer = self.__transfers[slot]
+            transfer.setBulk(self.endpoint, buffer, callback=self.__on_complete,
+                             user_data=slot, timeout=self.timeout)
+            self.__submit(transfer, slot)
+
+    def flush(self):
+        """
+          Wait for all queued transfers to complete.
+        """
+        while self.__in_flight:
+            self.handle_events()
+        self.__raise_error()
+
+    def __acquire(self):
+        if not self.__free:
+            wait_started = perf_counter()
+            while not self.__free:
+                self.handle_events()
+            self.stats.wait_time += perf_counter() - wait_started
+            self.__raise_error()
+        return self.__free.popleft()
+
+    def __submit(self, transfer, slot):
+        if not self.__in_flight:
+            self.__busy_since = perf_counter()
+        try:
+            transfer.submit()
+        except Exception:
+            self.__free.append(slot)
+            raise
+        self.__in_flight += 1
+        self.stats.transfers += 1
+        self.stats.max_in_flight = max(self.stats.max_in_flight, self.__in_flight)
+
+    def __on_complete(self, transfer):
+        status = transfer.getStatus()
+        failed = False
+        if status == usb1.TRANSFER_COMPLETED:
+            self.stats.bytes += transfer.getActualLength()
+        elif self.__error is None:
+            self.__error = NetMDException('Bulk transfer failed with status %d' % status)
+            failed = True
+        self.__in_flight -= 1
+        self.__free.append(transfer.getUserData())
+        if not self.__in_flight:
+            self.stats.busy_time += perf_counter() - self.__busy_since
+        if failed:
+            # the data behind the failed transfer must not reach the device
+            # with a gap in front of it
+            self.__cancel_in_flight()
+
+    def __cancel_in_flight(self):
+        free = set(self.__free)
+        for (slot, transfer) in enumerate(self.__transfers):
+            if slot in free:
+                continue
+            try:
+                transfer.cancel()
+            except usb1.USBErrorNotFound:
+                # completed already, its callback has yet to run
+                pass
+
+    def __raise_error(self):
+        if self.__error is not None:
+            error = self.__error
+            self.__error = None
+            raise error
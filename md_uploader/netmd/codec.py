@@ -0,0 +1,248 @@
+"""NetMD query/response codec
+
+NetMD commands are described by format strings: pairs of hex digits stand for
+literal bytes, spaces are ignored and '%' introduces a field:
+  %b, %w, %d, %q  big-endian integer of 1, 2, 4 or 8 bytes
+  %x              bytes prefixed with their 16-bit length
+  %s              like %x, 0-terminated (responses only)
+  %*              bytes taking up the rest of the message
+  %?              any byte, ignored (responses only)
+
+Format strings are compiled once into encoders and decoders which are cached
+by format. Encoders still accept str for the byte string fields, converting
+each character to the byte of the same value.
+"""
+
+from functools import lru_cache
+import struct
+
+
+_INT_FORMATS = {
+    'b': 'B', # byte
+    'w': 'H', # word
+    'd': 'I', # doubleword
+    'q': 'Q', # quadword
+}
+_INT_MASKS = {
+    'B': 0xff,
+    'H': 0xffff,
+    'I': 0xffffffff,
+    'Q': 0xffffffffffffffff,
+}
+_LENGTH = struct.Struct('>H')
+
+
+def _tokenize(format, allowed):
+    """
+      Split a format string into ('literal', bytes) and ('field', char)
+      tokens, merging adjacent literal bytes.
+    """
+    tokens = []
+    literal = bytearray()
+    half = None
+    escaped = False
+    for char in format:
+        if escaped:
+            escaped = False
+            if char not in allowed:
+                raise ValueError('Unrecognised format char: %r' % (char, ))
+            if literal:
+                tokens.append(('literal', bytes(literal)))
+                literal = bytearray()
+            tokens.append(('field', char))
+            continue
+        if char == '%':
+            if half is not None:
+                raise ValueError('Odd number of hex digits before %% in %r' % (format, ))
+            escaped = True
+            continue
+        if char == ' ':
+            continue
+        if half is None:
+            half = char
+        else:
+            literal.append(int(half + char, 16))
+            half = None
+    if half is not None or escaped:
+        raise ValueError('Truncated format: %r' % (format, ))
+    if literal:
+        tokens.append(('literal', bytes(literal)))
+    return tokens
+
+
+def _to_bytes(value):
+    if isinstance(value, str):
+        return value.encode('latin-1')
+    return bytes(value)
+
+
+class _FixedRun(object):
+    """
+      Consecutive literals, integers and skipped bytes, packed or unpacked
+      with one Struct.
+      layout
+        (struct code, expected literal or None) per item.
+      fields
+        Per packed value, the expected literal bytes or None for an integer.
+    """
+
+    def __init__(self):
+        self.layout = []
+        self.masks = []
+
+    def add_literal(self, literal):
+        self.layout.append(('%ds' % len(literal), literal))
+
+    def add_int(self, code):
+        self.layout.append((code, None))
+        self.masks.append(_INT_MASKS[code])
+
+    def add_skip(self):
+        self.layout.append(('x', None))
+
+    def finish(self):
+        self.struct = struct.Struct('>' + ''.join(code for (code, _) in self.layout))
+        self.size = self.struct.size
+        self.fields = [literal for (code, literal) in self.layout if code != 'x']
+
+
+class QueryEncoder(object):
+    """
+      Builds the raw bytes of a query from its arguments.
+    """
+
+    def __init__(self, format):
+        self.format = format
+        self.segments = []
+        self.arg_count = 0
+        run = None
+        for (kind, value) in _tokenize(format, 'bwdqx*'):
+            if kind == 'literal' or value in _INT_FORMATS:
+                if run is None:
+                    run = _FixedRun()
+                    self.segments.append(run)
+                if kind == 'literal':
+                    run.add_literal(value)
+                else:
+                    run.add_int(_INT_FORMATS[value])
+                    self.arg_count += 1
+            else:
+                run = None
+                self.segments.append(value)
+                self.arg_count += 1
+        for segment in self.segments:
+            if isinstance(segment, _FixedRun):
+                segment.finish()
+
+    def encode(self, *args):
+        assert len(args) == self.arg_count, (self.format, args)
+        parts = []
+        arg_index = 0
+        for segment in self.segments:
+            if segment == 'x':
+                value = _to_bytes(args[arg_index])
+                arg_index += 1
+                parts.append(_LENGTH.pack(len(value) & 0xffff))
+                parts.append(value)
+            elif segment == '*':
+                parts.append(_to_bytes(args[arg_index]))
+                arg_index += 1
+            else:
+                values = []
+                masks = iter(segment.masks)
+                for literal in segment.fields:
+                    if literal is None:
+                        values.append(args[arg_index] & next(masks))
+                        arg_index += 1
+                    else:
+                        values.append(literal)
+                parts.append(segment.struct.pack(*values))
+        return b''.join(parts)
+
+
+class ResponseDecoder(object):
+    """
+      Checks a response against its format and extracts the fields. Integer
+      fields are returned as int, string fields as bytes.
+    """
+
+    def __init__(self, format):
+        self.format = format
+        self.segments = []
+        run = None
+        for (kind, value) in _tokenize(format, 'bwdq?xs*'):
+            if kind == 'literal' or value in _INT_FORMATS or value == '?':
+                if run is None:
+                    run = _FixedRun()
+                    self.segments.append(run)
+                if kind == 'literal':
+                    run.add_literal(value)
+                elif value == '?':
+                    run.add_skip()
+                else:
+                    run.add_int(_INT_FORMATS[value])
+            else:
+                run = None
+                self.segments.append(value)
+        for segment in self.segments:
+            if isinstance(segment, _FixedRun):
+                segment.finish()
+
+    def decode(self, data, offset=0):
+        """
+          data (bytes-like)
+            Raw response, without the status byte.
+          offset (int)
+            Position of the response within data.
+          Returns the list of extracted values.
+        """
+        result = []
+        append = result.append
+        end = len(data)
+        for segment in self.segments:
+            if segment in ('x', 's'):
+                if end - offset < 2:
+                    raise IndexError('Response too short for %r' % (self.format, ))
+                (length, ) = _LENGTH.unpack_from(data, offset)
+                offset += 2
+                value = bytes(data[offset:offset + length])
+                offset = min(offset + length, end)
+                append(value[:-1] if segment == 's' else value)
+            elif segment == '*':
+                append(bytes(data[offset:]))
+                offset = end
+            else:
+                if end - offset < segment.size:
+                    raise IndexError('Response too short for %r' % (self.format, ))
+                values = segment.struct.unpack_from(data, offset)
+                for (literal, value) in zip(segment.fields, values):
+                    if literal is None:
+                        append(value)
+                    elif literal != value:
+                        self.__mismatch(data, offset, segment)
+                offset += segment.size
+        assert offset == end
+        return result
+
+    def __mismatch(self, data, offset, segment):
+        position = offset
+        for (code, literal) in segment.layout:
+            size = struct.calcsize('>' + code)
+            if literal is not None:
+                for (index, expected) in enumerate(literal):
+                    if data[position + index] != expected:
+                        raise ValueError('Format and input mismatch at %i: '
+                            'expected %02x, got %02x' % (
+                                position + index, expected,
+                                data[position + index]))
+            position += size
+
+
+@lru_cache(maxsize=None)
+def compile_query(format):
+    return QueryEncoder(format)
+
+
+@lru_cache(maxsize=None)
+def compile_response(format):
+    return ResponseDecoder(format)
@@ -54,5 +54,16 @@ WIRE_TO_DISK_FORMAT = {
     WIREFORMAT_LP4: DISKFORMAT_LP4,
 }
 
+# share of the disc a second of audio takes compared to SP stereo
+DISK_FORMAT_SPACE = {
+    DISKFORMAT_SP_STEREO: 1.0,
+    DISKFORMAT_SP_MONO: 0.5,
+    DISKFORMAT_LP2: 0.5,
+    DISKFORMAT_LP4: 0.25,
+}
+
+SAMPLE_RATE = 44100
+SAMPLES_PER_FRAME = 512  # the same for every wire format
+
 ROOT_KEY = b"\x12\x34\x56\x78\x9a\xbc\xde\xf0\x0f\xed\xcb\xa9\x87\x65\x43\x21"
 KEK = b"\x14\xe3\x83\x4e\xe2\xd3\xcc\xa5"
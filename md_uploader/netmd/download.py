@@ -1,10 +1,10 @@
 import array
+from contextlib import contextmanager
 import math
+import mmap
 import os
 import random
-
-from Crypto.Cipher import DES
-from Crypto.Cipher import DES3
+from time import perf_counter
 
 from .constants import KEK
 from .constants import ROOT_KEY
@@ -12,33 +12,76 @@ from .constants import WIREFORMAT_LP2
 from .constants import WIREFORMAT_PCM
 from .constants import WIRE_TO_DISK_FORMAT
 from .constants import WIRE_TO_FRAME_SIZE
+from .exception import NetMDException
 from .exception import NetMDNotImplemented
-from .util import bytes_to_str
+from .exception import NetMDRejected
+from .pipeline import PACKET_HEADER
 from .util import create_iv
 
 
-def download_track(net_md, wav_filename, title):
-    try:
-        net_md.disable_new_track_protection(1)
-    except NetMDNotImplemented:
-        print("Can't set device to non-protecting")
+# seconds to wait for each reply while tearing a session down, so a device
+# left waiting for track data cannot hang the teardown
+TEARDOWN_TIMEOUT = 5.0
 
-    with MDSession(net_md) as session:
+
+def download_track(net_md, wav_filename, title, progress=None):
+    """
+      progress (callable)
+        Transfer progress callback, see NetMD.send_track.
+    """
+    with MDSession(net_md, disable_protection=True) as session:
         track = MDTrack(wav_filename, title, WIREFORMAT_PCM)
-        return session.download_track(track)
+        return session.download_track(track, progress)
+
+
+def download_tracks(net_md, tracks, defer_titles=True, progress=None):
+    """
+      Download several tracks within a single secure session.
+      tracks (iterable)
+        (wav_filename, title) tuples. Consumed lazily, so files can be
+        produced while earlier tracks are downloaded.
+      defer_titles (bool)
+        Write all titles in one TOC update once the tracks are downloaded.
+      progress (callable)
+        Transfer progress callback, see NetMD.send_track. Called for each
+        track in turn.
+      Yields (track_number, uuid, ccid) for each track.
+    """
+    with MDSession(net_md, disable_protection=True, defer_titles=defer_titles) as session:
+        for (wav_filename, title) in tracks:
+            track = MDTrack(wav_filename, title, WIREFORMAT_PCM)
+            yield session.download_track(track, progress)
 
 
 class MDTrack(object):
     __PACKET_SIZE = 2048
 
-    def __init__(self, filename, title, wireformat):
+    def __init__(self, filename, title, wireformat, max_packets_in_flight=1):
+        """
+          filename (str)
+            Path to the raw track data in the given wire format. May also
+            be a stream with a size attribute and a read method, e.g.
+            transcode.PcmStream, which is read exactly once.
+          title (str)
+            Track title.
+          wireformat (int)
+            One of the WIREFORMAT_* constants.
+          max_packets_in_flight (int)
+            Number of packets read and encrypted in one go. Memory use of
+            get_packets is bounded by this many packets.
+        """
+        if max_packets_in_flight < 1:
+            raise ValueError('max_packets_in_flight must be at least 1')
         self.filename = filename
         self.title = title
         self.wireformat = wireformat
         self.framesize = WIRE_TO_FRAME_SIZE[wireformat]
+        self.max_packets_in_flight = max_packets_in_flight
 
     def get_frame_count(self):
-        filesize = os.path.getsize(self.filename)
+        filesize = getattr(self.filename, 'size', None)
+        if filesize is None:
+            filesize = os.path.getsize(self.filename)
         framecount = filesize // self.framesize
         
         misalignment = filesize % 8
@@ -52,34 +95,167 @@ class MDTrack(object):
         return numpackets
 
     def get_packets(self):
+        """
+          Lazily read and encrypt the track.
+          Yields (key, iv, data) tuples, data being a memoryview over the
+          encrypted packet. At most max_packets_in_flight packets are held
+          in memory at any time.
+        """
+        (datakey, firstiv, datacrypter) = self.__create_crypter()
+        packetbytes = MDTrack.__PACKET_SIZE * self.framesize
+
+        with self.__open() as file:
+            bytesremaining = self.get_frame_count() * self.framesize
+            while bytesremaining > 0:
+                # CBC chains across packets, so encrypting several packets
+                # in one call gives the same ciphertext as one at a time
+                batchbytes = min(bytesremaining, packetbytes * self.max_packets_in_flight)
+                data = memoryview(datacrypter.encrypt(file.read(batchbytes)))
+                bytesremaining -= batchbytes
+                for offset in range(0, batchbytes, packetbytes):
+                    yield (datakey, firstiv, data[offset:offset + packetbytes])
+                del data
+
+    def get_framed_packets(self):
+        """
+          Like get_packets, but yields memoryviews over packets in their wire
+          representation (see pipeline.frame_packet). The header is written
+          in front of the data slot and the data is encrypted straight into
+          it, from an mmap of the file when filename is a path, so the track
+          data is only touched by the cipher.
+        """
+        (datakey, firstiv, datacrypter) = self.__create_crypter()
+        packetbytes = MDTrack.__PACKET_SIZE * self.framesize
+        headersize = PACKET_HEADER.size
+
+        bytesremaining = self.get_frame_count() * self.framesize
+        if bytesremaining <= 0:
+            return
+        with self.__open_plaintext() as next_plaintext:
+            while bytesremaining > 0:
+                lengths = []
+                while bytesremaining > 0 and len(lengths) < self.max_packets_in_flight:
+                    lengths.append(min(bytesremaining, packetbytes))
+                    bytesremaining -= lengths[-1]
+                # one allocation per batch, handed over to the writer
+                buffer = memoryview(bytearray(sum(lengths) + headersize * len(lengths)))
+                offset = 0
+                for length in lengths:
+                    PACKET_HEADER.pack_into(buffer, offset, length, datakey, firstiv)
+                    slot = buffer[offset + headersize:offset + headersize + length]
+                    datacrypter.encrypt(next_plaintext(slot), output=slot)
+                    yield buffer[offset:offset + headersize + length]
+                    offset += headersize + length
+                del buffer, slot
+
+    def __create_crypter(self):
+        from Crypto.Cipher import DES
+
         # values do not matter at all
         datakey = b"\x96\x03\xc7\xc0\x53\x37\xd2\xf0"
         firstiv = b"\x08\xd9\xcb\xd4\xc1\x5e\xc0\xff"
         keycrypter = DES.new(KEK, DES.MODE_ECB)
         key = keycrypter.encrypt(datakey)
         datacrypter = DES.new(key, DES.MODE_CBC, firstiv)
+        return (datakey, firstiv, datacrypter)
 
-        with open(self.filename, 'rb') as file:
-            packets = []
-            data = None
+    @contextmanager
+    def __open(self):
+        if hasattr(self.filename, 'read'):
+            yield self.filename
+        else:
+            with open(self.filename, 'rb') as file:
+                yield file
 
-            framesremaining = self.get_frame_count()
-            for i in range(0, self.get_packet_count()):
-                if framesremaining < MDTrack.__PACKET_SIZE:
-                    data = file.read(framesremaining * self.framesize)
-                else:
-                    data = file.read(MDTrack.__PACKET_SIZE * self.framesize)
-                    framesremaining = framesremaining - MDTrack.__PACKET_SIZE
-                packets.append((datakey, firstiv, datacrypter.encrypt(data)))
+    @contextmanager
+    def __open_plaintext(self):
+        """
+          Yields a function returning the next len(slot) bytes of the track.
+          Files are mmap'd and the bytes returned as a view of the mapping;
+          streams are read into slot itself.
+        """
+        if hasattr(self.filename, 'read'):
+            file = self.filename
+            if hasattr(file, 'readinto'):
+                def next_plaintext(slot):
+                    filled = 0
+                    while filled < len(slot):
+                        count = file.readinto(slot[filled:])
+                        if not count:
+                            raise NetMDException('Track data ended early')
+                        filled += count
+                    return slot
+            else:
+                def next_plaintext(slot):
+                    data = file.read(len(slot))
+                    if len(data) < len(slot):
+                        raise NetMDException('Track data ended early')
+                    slot[:] = data
+                    return slot
+            yield next_plaintext
+            return
 
-        return packets
+        with open(self.filename, 'rb') as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            position = 0
+            def next_plaintext(slot):
+                nonlocal position
+                start = position
+                position += len(slot)
+                return view[start:position]
+            try:
+                yield next_plaintext
+            finally:
+                view.release()
 
 
 class MDSession(object):
-    def __init__(self, net_md):
+    def __init__(self, net_md, disable_protection=False, defer_titles=False):
+        """
+          net_md (NetMD)
+            Device to open the secure session with.
+          disable_protection (bool)
+            Ask the device to record unprotected tracks, on models that
+            support it.
+          defer_titles (bool)
+            Collect track titles and write them in a single TOC update
+            when the session ends (or on write_titles) instead of once per
+            track. Tracks are committed after their titles, as without.
+        """
         self.net_md = net_md
+        self.disable_protection = disable_protection
+        self.defer_titles = defer_titles
+        self.pending_titles = []
+        self.sessionkey = None
+        # a track transfer stopped half way, the device may still expect data
+        self.transfer_failed = False
 
     def __enter__(self):
+        if self.net_md.metrics is None:
+            return self.__open()
+        started = perf_counter()
+        try:
+            return self.__open()
+        finally:
+            self.net_md.metrics.record_session('enter', perf_counter() - started)
+
+    def __exit__(self, type, value, traceback):
+        if self.net_md.metrics is None:
+            return self.__close(type)
+        started = perf_counter()
+        try:
+            return self.__close(type)
+        finally:
+            self.net_md.metrics.record_session('exit', perf_counter() - started)
+
+    def __open(self):
+        if self.disable_protection:
+            try:
+                self.net_md.disable_new_track_protection(1)
+            except NetMDNotImplemented:
+                print("Can't set device to non-protecting")
+
         try:
             self.net_md.forget_session_key()
             self.net_md.leave_secure_session()
@@ -89,44 +265,107 @@ class MDSession(object):
         self.net_md.enter_secure_session()
         self.net_md.send_key_data()
 
-        hostnonce = bytes_to_str([random.randrange(255) for x in range(8)])
+        hostnonce = bytes(random.randrange(255) for x in range(8))
         devnonce = self.net_md.exchange_session_key(hostnonce)
         nonce = hostnonce + devnonce
         self.sessionkey = self._get_retail_mac(ROOT_KEY, nonce)
 
         return self
 
-    def __exit__(self, type, value, traceback):
-        if self.sessionkey != None:
-            self.net_md.forget_session_key()
-            self.sessionkey = None
-        self.net_md.leave_secure_session()
+    def __close(self, type):
+        try:
+            try:
+                # tracks downloaded before a failure still get their titles,
+                # unless the device was left in the middle of a transfer
+                if not self.transfer_failed:
+                    self.write_titles()
+            finally:
+                # never leave the device in the secure session
+                with _reply_timeout(self.net_md, TEARDOWN_TIMEOUT):
+                    try:
+                        if self.sessionkey != None:
+                            self.sessionkey = None
+                            self.net_md.forget_session_key()
+                    finally:
+                        self.net_md.leave_secure_session()
+        except Exception:
+            # don't hide the error that brought us here
+            if type is None:
+                raise
 
-    def download_track(self, track):
-        self.net_md.setup_download(self.sessionkey)
+    def reset(self):
+        """
+          Tear down and set up the session again, e.g. after the device
+          dropped it.
+        """
+        self.sessionkey = None
+        self.__enter__()
+
+    def download_track(self, track, progress=None):
+        """
+          Download track (MDTrack). progress is an optional transfer
+          progress callback, see NetMD.send_track.
+          Returns (track_number, uuid, ccid).
+        """
+        try:
+            self.net_md.setup_download(self.sessionkey)
+        except NetMDRejected:
+            # the device no longer knows our session key, nothing has been
+            # written for this track yet so it is safe to start over
+            self.reset()
+            self.net_md.setup_download(self.sessionkey)
         wireformat = track.wireformat
         
-        (track_number, uuid, ccid) = self.net_md.send_track(
-            wireformat,
-            WIRE_TO_DISK_FORMAT[wireformat],
-            track.get_frame_count(),
-            track.get_packet_count(),
-            track.get_packets(),
-            self.sessionkey
-        )
+        try:
+            (track_number, uuid, ccid) = self.net_md.send_track(
+                wireformat,
+                WIRE_TO_DISK_FORMAT[wireformat],
+                track.get_frame_count(),
+                track.get_packet_count(),
+                track.get_framed_packets(),
+                self.sessionkey,
+                progress
+            )
+        except BaseException:
+            self.transfer_failed = True
+            raise
         
+        if self.defer_titles:
+            self.pending_titles.append((track_number, track.title))
+        else:
+            self.net_md.cache_toc()
+            self.net_md.set_track_title(track_number, track.title)
+            self.net_md.sync_toc()
+            self.net_md.commit_track(track_number, self.sessionkey)
+
+        return (track_number, uuid, ccid)
+
+    def write_titles(self):
+        """
+          Write the deferred track titles within one cache_toc/sync_toc
+          window, then commit the tracks. commit_track authenticates with
+          the current session key only, so tracks downloaded before a
+          reset() are committed under the new session.
+        """
+        if not self.pending_titles:
+            return
+        (pending_titles, self.pending_titles) = (self.pending_titles, [])
         self.net_md.cache_toc()
-        self.net_md.set_track_title(track_number, track.title)
+        for (track_number, title) in pending_titles:
+            # freshly downloaded tracks have no title yet, no need to ask
+            # the device for the length of the old one
+            self.net_md.set_track_title(track_number, title, old_length=0)
         self.net_md.sync_toc()
-        self.net_md.commit_track(track_number, self.sessionkey)
-
-        return (track_number, bytes_to_str(uuid), bytes_to_str(ccid))
+        for (track_number, _) in pending_titles:
+            self.net_md.commit_track(track_number, self.sessionkey)
 
     def _get_retail_mac(self, key, value):
-        byte_value = bytearray([ord(c) for c in value])
+        from Crypto.Cipher import DES
+        from Crypto.Cipher import DES3
+
         subkeyA = key[0:8]
-        beginning = byte_value[0:-8]
-        end = byte_value[-8:]
+        beginning = value[0:-8]
+        end = value[-8:]
 
         iv = create_iv()
         step1crypt = DES.new(subkeyA, DES.MODE_CBC, iv)
@@ -135,3 +374,21 @@ class MDSession(object):
         step2crypt = DES3.new(key, DES3.MODE_CBC, iv2)
 
         return step2crypt.encrypt(end)
+
+
+@contextmanager
+def _reply_timeout(net_md, timeout):
+    """
+      Wait at most timeout seconds for each reply within, on devices that
+      poll for replies (NetMDUSB).
+    """
+    polling = getattr(net_md.net_md_usb, 'polling', None)
+    if polling is None or (polling.timeout is not None and polling.timeout <= timeout):
+        yield
+        return
+    previous = polling.timeout
+    polling.timeout = timeout
+    try:
+        yield
+    finally:
+        polling.timeout = previous
@@ -0,0 +1,521 @@
+"""NetMD device emulator
+
+Software stand-in for NetMDUSB, answering the commands NetMD sends the way a
+recorder would: secure session handshake, track download over bulk writes,
+titling, TOC, disc status and capacity. Commands it does not know get the
+"not implemented" status. Optional command latency and bulk bandwidth make it
+usable for timing the upload path without hardware:
+```
+from netmd.emulator import EmulatedNetMDUSB
+from netmd.netmd_device import NetMD
+
+net_md = NetMD(EmulatedNetMDUSB(command_latency=0.005, bulk_bandwidth=1 << 20))
+```
+The emulator keeps its own copy of the protocol details (session key
+derivation, packet decryption) rather than reusing the host side code, so it
+catches mistakes there.
+"""
+
+import os
+import time
+
+from .codec import compile_query
+from .codec import compile_response
+from .constants import DISKFORMAT_LP2
+from .constants import DISKFORMAT_LP4
+from .constants import KEK
+from .constants import ROOT_KEY
+from .constants import SAMPLE_RATE
+from .constants import SAMPLES_PER_FRAME
+from .constants import WIRE_TO_FRAME_SIZE
+from .exception import NetMDException
+from .pipeline import PACKET_HEADER
+from .util import create_iv
+from .util import int2BCD
+
+
+STATUS_NOT_IMPLEMENTED = 0x08
+STATUS_ACCEPTED = 0x09
+STATUS_REJECTED = 0x0a
+STATUS_INTERIM = 0x0f
+
+DISC_FLAG_WRITABLE = 0x10
+DISC_PRESENT = 0x40
+
+SECURE = '1800 080046 f0030103 '
+
+
+class Rejected(Exception):
+    """
+      Raised by command handlers to answer with the rejected status.
+    """
+    pass
+
+
+class EmulatedTrack(object):
+    """
+      A track on the emulated disc.
+    """
+
+    def __init__(self, wireformat, diskformat, frames, uuid):
+        self.wireformat = wireformat
+        self.diskformat = diskformat
+        self.frames = frames
+        self.uuid = uuid
+        self.title = ''
+        self.wchar_title = ''
+        self.data = None
+
+    def get_samples(self):
+        """
+          Track duration in samples per channel.
+        """
+        return self.frames * SAMPLES_PER_FRAME
+
+    def get_disc_samples(self):
+        """
+          Space taken on the disc, in SP stereo samples.
+        """
+        if self.diskformat == DISKFORMAT_LP2:
+            return self.get_samples() // 2
+        if self.diskformat == DISKFORMAT_LP4:
+            return self.get_samples() // 4
+        return self.get_samples()
+
+
+class EmulatedNetMDUSB(object):
+    """
+      Drop-in replacement for NetMDUSB backed by an in-memory disc.
+    """
+
+    def __init__(self, command_latency=0.0, bulk_bandwidth=None,
+                 disc_minutes=80, keep_data=False, sleep=time.sleep):
+        """
+          command_latency (float)
+            Seconds between a command and its reply becoming available.
+          bulk_bandwidth (int)
+            Bulk write throughput in bytes per second, None for unlimited.
+          disc_minutes (int)
+            Disc capacity in SP minutes.
+          keep_data (bool)
+            Decrypt downloaded tracks and keep the PCM in EmulatedTrack.data.
+          sleep (callable)
+            Used to wait out latency and bandwidth, e.g. to run on a fake
+            clock.
+        """
+        self.command_latency = command_latency
+        self.bulk_bandwidth = bulk_bandwidth
+        self.capacity = disc_minutes * 60 * SAMPLE_RATE
+        self.keep_data = keep_data
+        self.sleep = sleep
+
+        self.tracks = []
+        self.disc_title = ''
+        self.disc_present = True
+        self.writable = True
+        self.protect_new_tracks = True
+        self.commands = 0
+        self.bulk_bytes = 0
+        self.metrics = None
+
+        self.__replies = []
+        self.__reply_at = 0.0
+        self.__bulk_done_at = 0.0
+        self.__in_session = False
+        self.__ekb_loaded = False
+        self.__sessionkey = None
+        self.__download_ready = False
+        self.__download = None
+        self.__handlers = [(_literal_prefix(format), compile_response(format), handler)
+                           for (format, handler) in (
+            ('1840 ff 0000', self.__erase_disc),
+            ('1808 10180200 00', self.__echo),
+            ('1808 10180203 00', self.__echo),
+            ('18c3 ff %b 000000', self.__play),
+            ('18c5 ff 00000000', self.__stop),
+            ('1850 ff10 00000000 %w', self.__change_track),
+            ('1850 ff010000 0000 %w', self.__go_to_track),
+            ('1806 02201801 00%b 3000 0a00 ff00 %w%w', self.__get_disc_title),
+            ('1807 02201801 00%b 3000 0a00 5000 %w 0000 %w %*', self.__set_disc_title),
+            ('1806 022018%b %w 3000 0a00 ff00 00000000', self.__get_track_title),
+            ('1807 022018%b %w 3000 0a00 5000 %w 0000 %w %*', self.__set_track_title),
+            ('1809 8001 0230 8800 0030 8804 00 ff00 00000000', self.__get_status),
+            ('1806 02101000 3080 0300 ff00 00000000', self.__get_disc_capacity),
+            ('1806 01101000 ff00 0001000b', self.__get_disc_flags),
+            ('1806 02101001 3000 1000 ff00 00000000', self.__get_track_count),
+            ('1806 02201001 %w %w %w ff00 00000000', self.__get_track_info),
+            (SECURE + '80 ff', self.__enter_secure_session),
+            (SECURE + '81 ff', self.__leave_secure_session),
+            (SECURE + '11 ff', self.__get_leaf_id),
+            (SECURE + '12 ff %w %d %d %d %d 00000000 %*', self.__send_key_data),
+            (SECURE + '20 ff 000000 %*', self.__exchange_session_key),
+            (SECURE + '21 ff 000000', self.__forget_session_key),
+            (SECURE + '22 ff 0000 %*', self.__setup_download),
+            (SECURE + '28 ff 000100 1001 ffff 00 %b %b %d %d', self.__send_track),
+            (SECURE + '2b ff %w', self.__disable_new_track_protection),
+            (SECURE + '48 ff 00 1001 %w %*', self.__commit_track),
+        )]
+
+    #
+    # NetMDUSB interface
+    #
+
+    def sendCommand(self, command):
+        """
+          Handle a raw binary command, queueing its reply.
+        """
+        self.commands += 1
+        command = bytes(command)
+        try:
+            (status, reply) = self.__dispatch(command[1:])
+        except Rejected:
+            (status, reply) = (STATUS_REJECTED, command[1:])
+        self.__reply_at = time.perf_counter() + self.command_latency
+        self.__replies.append(bytes((status, )) + bytes(reply))
+
+    def _getReplyLength(self):
+        if not self.__replies or time.perf_counter() < self.__reply_at:
+            return 0
+        return len(self.__replies[0])
+
+    def readReply(self):
+        if not self.__replies:
+            raise NetMDException('No reply pending')
+        self.__wait_until(self.__reply_at)
+        return self.__replies.pop(0)
+
+    def writeBulk(self, data):
+        """
+          Receive track data for a download started by send_track.
+        """
+        data = memoryview(data).cast('B')
+        if self.metrics is not None:
+            started = time.perf_counter()
+        if self.__download is None:
+            raise NetMDException('Bulk data without a download in progress')
+        if self.bulk_bandwidth:
+            self.__bulk_done_at = max(self.__bulk_done_at, time.perf_counter()) + \
+                len(data) / float(self.bulk_bandwidth)
+            self.__wait_until(self.__bulk_done_at)
+        self.bulk_bytes += len(data)
+        self.__download.receive(data)
+        if self.__download.is_complete():
+            self.__finish_download()
+        if self.metrics is not None:
+            self.metrics.record_bulk(len(data), time.perf_counter() - started)
+
+    def flushBulk(self):
+        pass
+
+    #
+    # Dispatching
+    #
+
+    def __dispatch(self, command):
+        for (prefix, decoder, handler) in self.__handlers:
+            if not command.startswith(prefix):
+                continue
+            try:
+                args = decoder.decode(command)
+            except (AssertionError, IndexError, ValueError):
+                continue
+            return handler(command, *args)
+        return (STATUS_NOT_IMPLEMENTED, command)
+
+    def __wait_until(self, deadline):
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            self.sleep(delay)
+
+    def __reply(self, format, *args):
+        return (STATUS_ACCEPTED, compile_query(format).encode(*args))
+
+    def __echo(self, command):
+        return (STATUS_ACCEPTED, command)
+
+    def __get_track(self, track):
+        if track >= len(self.tracks):
+            raise Rejected()
+        return self.tracks[track]
+
+    #
+    # Disc and playback
+    #
+
+    def __erase_disc(self, command):
+        self.tracks = []
+        self.disc_title = ''
+        return self.__reply('1840 00 0000')
+
+    def __play(self, command, action):
+        return self.__reply('18c3 00 %b 000000', action)
+
+    def __stop(self, command):
+        return self.__reply('18c5 00 00000000')
+
+    def __change_track(self, command, direction):
+        return self.__reply('1850 0010 00000000 %w', direction)
+
+    def __go_to_track(self, command, track):
+        self.__get_track(track)
+        return self.__reply('1850 00010000 0000 %w', track)
+
+    def __get_status(self, command):
+        status = bytearray(8)
+        if self.disc_present:
+            status[3] = DISC_PRESENT
+        return self.__reply('1809 8001 0230 8800 0030 8804 00 1000 0009000000 %x', status)
+
+    def __get_disc_flags(self, command):
+        return self.__reply('1806 01101000 1000 0001000b %b',
+                            DISC_FLAG_WRITABLE if self.writable else 0)
+
+    def __get_disc_capacity(self, command):
+        recorded = sum(track.get_samples() for track in self.tracks)
+        available = self.capacity - sum(track.get_disc_samples() for track in self.tracks)
+        times = []
+        for samples in (recorded, self.capacity, max(available, 0)):
+            times.extend(self.__bcd_time(samples))
+        return self.__reply('1806 02101000 3080 0300 1000 001d0000 001b 8003 0017 8000 '
+                            '0005 %w %b %b %b 0005 %w %b %b %b 0005 %w %b %b %b', *times)
+
+    def __get_track_count(self, command):
+        data = b'\x00\x10\x00\x02\x00' + bytes((len(self.tracks), ))
+        return self.__reply('1806 02101001 3000 1000 1000 0006 0000 %x', data)
+
+    def __get_track_info(self, command, track, p1, p2):
+        if (p1, p2) != (0x3000, 0x0100):
+            return (STATUS_NOT_IMPLEMENTED, command)
+        length = compile_query('0001 0006 0000 %b %b %b %b').encode(
+            *self.__bcd_time(self.__get_track(track).get_samples()))
+        return self.__reply('1806 02201001 %w %w %w 1000 0006 0000 %x', track, p1, p2, length)
+
+    def __bcd_time(self, samples):
+        (seconds, remainder) = divmod(samples, SAMPLE_RATE)
+        (minutes, seconds) = divmod(seconds, 60)
+        (hours, minutes) = divmod(minutes, 60)
+        return [int2BCD(value, length=2) for value in
+                (hours, minutes, seconds, remainder // SAMPLES_PER_FRAME)]
+
+    #
+    # Titles and TOC
+    #
+
+    def __get_disc_title(self, command, wchar, remaining, done):
+        title = self.disc_title.encode('latin-1')
+        return self.__reply('1806 02201801 00%b 3000 0a00 1000 %w 0000 %w 000a %w %*',
+                            wchar, len(title) + 6, len(title), len(title), title)
+
+    def __set_disc_title(self, command, wchar, length, old_length, title):
+        if old_length != len(self.disc_title):
+            raise Rejected()
+        self.disc_title = bytes(title[:length]).decode('latin-1')
+        return self.__reply('1807 02201801 00%b 3000 0a00 5000 %w 0000 %w',
+                            wchar, length, old_length)
+
+    def __get_track_title(self, command, wchar, track):
+        emulated_track = self.__get_track(track)
+        title = (emulated_track.wchar_title if wchar == 3 else emulated_track.title).encode('latin-1')
+        return self.__reply('1806 022018%b %w 3000 0a00 1000 00%b 0000 00%b 000a %*',
+                            wchar, track, len(title), len(title), title)
+
+    def __set_track_title(self, command, wchar, track, length, old_length, title):
+        emulated_track = self.__get_track(track)
+        title = bytes(title[:length]).decode('latin-1')
+        if wchar == 3:
+            if old_length != len(emulated_track.wchar_title):
+                raise Rejected()
+            emulated_track.wchar_title = title
+        else:
+            if old_length != len(emulated_track.title):
+                raise Rejected()
+            emulated_track.title = title
+        return self.__reply('1807 022018%b %w 3000 0a00 5000 %w 0000 %w',
+                            wchar, track, length, old_length)
+
+    #
+    # Secure session
+    #
+
+    def __enter_secure_session(self, command):
+        self.__in_session = True
+        return self.__reply(SECURE + '80 00')
+
+    def __leave_secure_session(self, command):
+        if not self.__in_session:
+            raise Rejected()
+        self.__in_session = False
+        self.__ekb_loaded = False
+        self.__sessionkey = None
+        self.__download_ready = False
+        self.protect_new_tracks = True
+        return self.__reply(SECURE + '81 00')
+
+    def __get_leaf_id(self, command):
+        return self.__reply(SECURE + '11 00 %*', bytes(8))
+
+    def __send_key_data(self, command, databytes, databytes_again, chainlen, depth,
+                        ekbid, keydata):
+        if not self.__in_session:
+            raise Rejected()
+        if len(keydata) != databytes - 16 or len(keydata) != 16 * chainlen + 24:
+            raise Rejected()
+        self.__ekb_loaded = True
+        return (STATUS_ACCEPTED, compile_query(SECURE + '12 01 %w %d').encode(
+            databytes, ekbid))
+
+    def __exchange_session_key(self, command, hostnonce):
+        if not self.__ekb_loaded or len(hostnonce) != 8:
+            raise Rejected()
+        devnonce = os.urandom(8)
+        self.__sessionkey = _retail_mac(ROOT_KEY, bytes(hostnonce) + devnonce)
+        return self.__reply(SECURE + '20 00 000000 %*', devnonce)
+
+    def __forget_session_key(self, command):
+        if self.__sessionkey is None:
+            raise Rejected()
+        self.__sessionkey = None
+        self.__download_ready = False
+        return self.__reply(SECURE + '21 00 000000')
+
+    def __disable_new_track_protection(self, command, value):
+        self.protect_new_tracks = not value
+        return self.__reply(SECURE + '2b 00 %w', value)
+
+    #
+    # Downloads
+    #
+
+    def __setup_download(self, command, encryptedarg):
+        if self.__sessionkey is None or len(encryptedarg) != 32:
+            raise Rejected()
+        decrypter = _des_cbc(self.__sessionkey, create_iv())
+        argument = decrypter.decrypt(bytes(encryptedarg))
+        if argument[:4] != b'\1\1\1\1' or argument[-8:] != KEK:
+            raise Rejected()
+        self.__download_ready = True
+        return self.__reply(SECURE + '22 00 0000')
+
+    def __send_track(self, command, wireformat, diskformat, frames, totalbytes):
+        if not self.__download_ready or not self.writable or \
+                wireformat not in WIRE_TO_FRAME_SIZE:
+            raise Rejected()
+        track = EmulatedTrack(wireformat, diskformat, frames, os.urandom(8))
+        used = sum(existing.get_disc_samples() for existing in self.tracks)
+        if used + track.get_disc_samples() > self.capacity:
+            raise Rejected()
+        self.__download_ready = False
+        self.__download = _Download(track, totalbytes, self.keep_data)
+        return (STATUS_INTERIM, compile_query(
+            SECURE + '28 00 000100 1001 ffff 00 %b %b %d %d').encode(
+                wireformat, diskformat, frames, totalbytes))
+
+    def __finish_download(self):
+        download = self.__download
+        self.__download = None
+        track = download.track
+        if download.data_bytes != track.frames * WIRE_TO_FRAME_SIZE[track.wireformat]:
+            raise NetMDException('Received %d bytes of track data for %d frames' % (
+                download.data_bytes, track.frames))
+        track.data = download.data
+        self.tracks.append(track)
+
+        ccid = bytes(20)
+        encrypter = _des_cbc(self.__sessionkey, create_iv())
+        encryptedreply = encrypter.encrypt(track.uuid + bytes(4) + ccid)
+        self.__reply_at = time.perf_counter() + self.command_latency
+        self.__replies.append(bytes((STATUS_ACCEPTED, )) + compile_query(
+            SECURE + '28 00 000100 1001 %w 00 0000 00000000 00000000 %*').encode(
+                len(self.tracks) - 1, encryptedreply))
+
+    def __commit_track(self, command, track, authentication):
+        self.__get_track(track)
+        if self.__sessionkey is None:
+            raise Rejected()
+        expected = _des_ecb(self.__sessionkey).encrypt(create_iv())
+        if bytes(authentication) != expected:
+            raise Rejected()
+        return self.__reply(SECURE + '48 00 00 1001 %w', track)
+
+
+class _Download(object):
+    """
+      Parses the packet stream of a track download as it arrives.
+    """
+
+    def __init__(self, track, totalbytes, keep_data):
+        self.track = track
+        self.totalbytes = totalbytes
+        self.received = 0
+        self.data_bytes = 0
+        self.data = bytearray() if keep_data else None
+        self.header = bytearray()
+        self.packet_remaining = 0
+        self.decrypter = None
+        self.ciphertext = bytearray()
+
+    def is_complete(self):
+        return self.received == self.totalbytes
+
+    def receive(self, data):
+        if self.received + len(data) > self.totalbytes:
+            raise NetMDException('Track data exceeds the announced %d bytes' % (
+                self.totalbytes, ))
+        self.received += len(data)
+        offset = 0
+        while offset < len(data):
+            if self.packet_remaining:
+                count = min(self.packet_remaining, len(data) - offset)
+                if self.data is not None:
+                    self.__decrypt(data[offset:offset + count])
+                self.packet_remaining -= count
+                offset += count
+                continue
+            count = min(PACKET_HEADER.size - len(self.header), len(data) - offset)
+            self.header += data[offset:offset + count]
+            offset += count
+            if len(self.header) == PACKET_HEADER.size:
+                (length, datakey, iv) = PACKET_HEADER.unpack(self.header)
+                self.header = bytearray()
+                self.packet_remaining = length
+                self.data_bytes += length
+                if self.decrypter is None and self.data is not None:
+                    # CBC runs on across packets, only the first IV counts
+                    key = _des_ecb(KEK).encrypt(datakey)
+                    self.decrypter = _des_cbc(key, iv)
+
+    def __decrypt(self, ciphertext):
+        # writes need not end on a DES block boundary
+        self.ciphertext += ciphertext
+        usable = len(self.ciphertext) - len(self.ciphertext) % 8
+        self.data += self.decrypter.decrypt(bytes(self.ciphertext[:usable]))
+        del self.ciphertext[:usable]
+
+
+def _literal_prefix(format):
+    """
+      Bytes a command matching format starts with, to skip handlers that
+      cannot match without decoding.
+    """
+    return bytes.fromhex(format.split('%')[0].replace(' ', ''))
+
+
+# pycryptodome is imported on first use to keep importing the package cheap
+
+def _des_cbc(key, iv):
+    from Crypto.Cipher import DES
+
+    return DES.new(key, DES.MODE_CBC, iv)
+
+
+def _des_ecb(key):
+    from Crypto.Cipher import DES
+
+    return DES.new(key, DES.MODE_ECB)
+
+
+def _retail_mac(key, value):
+    from Crypto.Cipher import DES3
+
+    iv = _des_cbc(key[0:8], create_iv()).encrypt(value[0:-8])[-8:]
+    return DES3.new(key, DES3.MODE_CBC, iv).encrypt(value[-8:])
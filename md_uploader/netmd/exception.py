@@ -17,3 +17,24 @@ class NetMDRejected(NetMDException):
       NetMD protocol "operation rejected" exception.
     """
     pass
+
+
+class NetMDTimeout(NetMDException):
+    """
+      The device did not reply in time.
+    """
+    pass
+
+
+class NetMDTranscriptMismatch(NetMDException):
+    """
+      A replayed session diverged from the recorded transcript.
+    """
+    pass
+
+
+class NetMDTransferAborted(NetMDException):
+    """
+      A track transfer was stopped by its progress callback.
+    """
+    pass
@@ -0,0 +1,176 @@
+"""NetMD device hotplug
+
+DeviceMonitor watches the USB bus for NetMD devices (KNOWN_USB_ID_SET) coming
+and going. Where libusb supports it, hotplug callbacks report changes as soon
+as they happen; otherwise the device list is polled. Devices already plugged
+in when the monitor starts are reported as arrivals.
+```
+monitor = DeviceMonitor(callback=print)
+monitor.start()
+net_md = NetMD(monitor.wait_for_device())
+```
+"""
+
+from collections import namedtuple
+from queue import Empty
+from queue import Queue
+import threading
+from time import perf_counter
+
+from .constants import KNOWN_USB_ID_SET
+
+
+ARRIVED = 'arrived'
+LEFT = 'left'
+
+DeviceEvent = namedtuple('DeviceEvent', [
+    'kind',  # ARRIVED or LEFT
+    'vendor_id',
+    'product_id',
+    'bus',
+    'address',
+    'device',  # usb1.USBDevice
+])
+
+
+def is_netmd_device(device):
+    return (device.getVendorID(), device.getProductID()) in KNOWN_USB_ID_SET
+
+
+class DeviceMonitor(object):
+    """
+      Tracks plugged-in NetMD devices and reports arrivals and removals.
+      Events are delivered on the monitor thread; callbacks must not block.
+    """
+
+    def __init__(self, usb_context=None, callback=None, poll_interval=1.0,
+                 use_hotplug=None):
+        """
+          usb_context (usb1.USBContext)
+            Context to watch, by default the one shared with
+            usb_device.find_devices. Devices are opened in it.
+          callback (callable)
+            Called with every DeviceEvent.
+          poll_interval (float)
+            Seconds between device list scans without hotplug support, and
+            the longest the monitor thread takes to notice stop().
+          use_hotplug (bool)
+            Force hotplug callbacks on or off, by default they are used when
+            libusb supports them.
+        """
+        import usb1
+        from .usb_device import get_usb_context
+
+        self.usb_context = usb_context if usb_context is not None else get_usb_context()
+        self.callbacks = [callback] if callback is not None else []
+        self.poll_interval = poll_interval
+        if use_hotplug is None:
+            use_hotplug = self.usb_context.hasCapability(usb1.CAP_HAS_HOTPLUG)
+        self.use_hotplug = use_hotplug
+        self.present = {}
+        self.__lock = threading.Condition()
+        self.__pending = Queue()
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def start(self):
+        """
+          Start watching on a background thread.
+        """
+        if self.use_hotplug:
+            # libusb calls back from event handling, where devices cannot
+            # be opened or queried synchronously, so events are queued
+            self.usb_context.hotplugRegisterCallback(self.__on_hotplug)
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run, name='netmd-hotplug')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def devices(self):
+        """
+          Returns the usb1.USBDevices of NetMD devices currently plugged in.
+        """
+        with self.__lock:
+            return list(self.present.values())
+
+    def wait_for_device(self, timeout=None):
+        """
+          Open a plugged-in NetMD device, waiting up to timeout seconds (or
+          indefinitely) for one to arrive.
+          Returns a NetMDUSB, or None on timeout.
+        """
+        from .usb_device import NetMDUSB
+
+        deadline = None if timeout is None else perf_counter() + timeout
+        with self.__lock:
+            while not self.present:
+                remaining = None if deadline is None else deadline - perf_counter()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.__lock.wait(remaining)
+            device = next(iter(self.present.values()))
+        return NetMDUSB(device.open(), usb_context=self.usb_context)
+
+    def __run(self):
+        if self.use_hotplug:
+            while not self.__stopped.is_set():
+                self.usb_context.handleEventsTimeout(tv=self.poll_interval)
+                self.__dispatch_pending()
+        else:
+            while not self.__stopped.is_set():
+                self.__scan()
+                self.__stopped.wait(self.poll_interval)
+
+    def __on_hotplug(self, usb_context, device, event):
+        import usb1
+
+        if is_netmd_device(device):
+            kind = ARRIVED if event == usb1.HOTPLUG_EVENT_DEVICE_ARRIVED else LEFT
+            self.__pending.put((kind, device))
+        return False
+
+    def __dispatch_pending(self):
+        while True:
+            try:
+                (kind, device) = self.__pending.get_nowait()
+            except Empty:
+                return
+            self.__update(kind, device)
+
+    def __scan(self):
+        plugged = {}
+        for device in self.usb_context.getDeviceList(skip_on_error=True):
+            if is_netmd_device(device):
+                plugged[_device_key(device)] = device
+        for (key, device) in list(self.present.items()):
+            if key not in plugged:
+                self.__update(LEFT, device)
+        for (key, device) in plugged.items():
+            if key not in self.present:
+                self.__update(ARRIVED, device)
+
+    def __update(self, kind, device):
+        key = _device_key(device)
+        with self.__lock:
+            if kind == ARRIVED:
+                self.present[key] = device
+            else:
+                self.present.pop(key, None)
+            self.__lock.notify_all()
+        event = DeviceEvent(kind, device.getVendorID(), device.getProductID(),
+                            key[0], key[1], device)
+        for callback in self.callbacks:
+            callback(event)
+
+
+def _device_key(device):
+    return (device.getBusNumber(), device.getDeviceAddress())
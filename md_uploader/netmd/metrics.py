@@ -0,0 +1,171 @@
+"""Protocol metrics
+
+Opt-in instrumentation of the NetMD protocol. A MetricsRegistry passed to
+NetMD (and NetMDUSB for bulk writes) records every command with its size,
+latency and reply status, every bulk write and the secure session set up and
+tear down done by MDSession. Without a registry nothing is measured.
+```
+metrics = MetricsRegistry()
+net_md = NetMD(net_md_usb, metrics=metrics)
+download_track(net_md, 'track.pcm', 'Title')
+print(metrics.to_prometheus())
+```
+"""
+
+import json
+
+from .polling import LatencyHistogram
+
+
+STATUS_NAMES = {
+    0x08: 'not_implemented',
+    0x09: 'accepted',
+    0x0a: 'rejected',
+    0x0b: 'in_transition',
+    0x0c: 'implemented',
+    0x0d: 'changed',
+    0x0f: 'interim',
+}
+
+
+def status_name(status):
+    return STATUS_NAMES.get(status, '%02x' % status)
+
+
+class MetricsRegistry(object):
+    """
+      Collects protocol metrics and forwards each event to callbacks.
+      callbacks (iterable)
+        Functions called as callback(kind, fields) for every event, kind
+        being 'command', 'bulk' or 'session' and fields a dict of the
+        values recorded.
+    """
+
+    def __init__(self, callbacks=()):
+        self.callbacks = list(callbacks)
+        self.commands = {}
+        self.latency = LatencyHistogram()
+        self.bulk = {'count': 0, 'bytes': 0, 'seconds': 0.0}
+        self.sessions = {}
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def record_command(self, name, request_size, response_size, seconds, status):
+        """
+          A command round trip: name as given by polling.command_name, raw
+          request and reply sizes in bytes, latency in seconds and the reply
+          status byte.
+        """
+        entry = self.commands.get(name)
+        if entry is None:
+            entry = self.commands[name] = {
+                'count': 0,
+                'request_bytes': 0,
+                'response_bytes': 0,
+                'seconds': 0.0,
+                'statuses': {},
+            }
+        status = status_name(status)
+        entry['count'] += 1
+        entry['request_bytes'] += request_size
+        entry['response_bytes'] += response_size
+        entry['seconds'] += seconds
+        entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+        self.latency.record(name, seconds)
+        self.__notify('command', {
+            'command': name,
+            'request_bytes': request_size,
+            'response_bytes': response_size,
+            'seconds': seconds,
+            'status': status,
+        })
+
+    def record_bulk(self, size, seconds):
+        self.bulk['count'] += 1
+        self.bulk['bytes'] += size
+        self.bulk['seconds'] += seconds
+        self.__notify('bulk', {'bytes': size, 'seconds': seconds})
+
+    def record_session(self, event, seconds):
+        """
+          A secure session event, 'enter' or 'exit', and its duration.
+        """
+        entry = self.sessions.setdefault(event, {'count': 0, 'seconds': 0.0})
+        entry['count'] += 1
+        entry['seconds'] += seconds
+        self.__notify('session', {'event': event, 'seconds': seconds})
+
+    def to_dict(self):
+        return {
+            'commands': self.commands,
+            'bulk': self.bulk,
+            'sessions': self.sessions,
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), sort_keys=True, **kwargs)
+
+    def to_prometheus(self):
+        """
+          Metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (labels, value) in samples:
+                lines.append('%s%s %s' % (name, _labels(labels), _value(value)))
+
+        metric('netmd_commands_total', 'counter', 'NetMD commands by reply status.',
+               [((('command', name), ('status', status)), count)
+                for (name, entry) in sorted(self.commands.items())
+                for (status, count) in sorted(entry['statuses'].items())])
+        metric('netmd_command_request_bytes_total', 'counter', 'Bytes sent in NetMD commands.',
+               [((('command', name), ), entry['request_bytes'])
+                for (name, entry) in sorted(self.commands.items())])
+        metric('netmd_command_response_bytes_total', 'counter', 'Bytes received in NetMD replies.',
+               [((('command', name), ), entry['response_bytes'])
+                for (name, entry) in sorted(self.commands.items())])
+
+        lines.append('# HELP netmd_command_latency_seconds NetMD command round trip latency.')
+        lines.append('# TYPE netmd_command_latency_seconds histogram')
+        for name in sorted(self.latency.commands):
+            entry = self.latency.commands[name]
+            cumulative = 0
+            for (bound, count) in zip(LatencyHistogram.BUCKETS, entry['buckets']):
+                cumulative += count
+                lines.append('netmd_command_latency_seconds_bucket%s %d' % (
+                    _labels((('command', name), ('le', _value(bound)))), cumulative))
+            command = _labels((('command', name), ))
+            lines.append('netmd_command_latency_seconds_bucket%s %d' % (
+                _labels((('command', name), ('le', '+Inf'))), entry['count']))
+            lines.append('netmd_command_latency_seconds_sum%s %s' % (command, _value(entry['total'])))
+            lines.append('netmd_command_latency_seconds_count%s %d' % (command, entry['count']))
+
+        metric('netmd_bulk_writes_total', 'counter', 'Bulk writes to the device.',
+               [((), self.bulk['count'])])
+        metric('netmd_bulk_bytes_total', 'counter', 'Bytes written in bulk transfers.',
+               [((), self.bulk['bytes'])])
+        metric('netmd_bulk_seconds_total', 'counter', 'Time spent in bulk writes.',
+               [((), self.bulk['seconds'])])
+        metric('netmd_session_seconds_total', 'counter', 'Time spent entering and leaving secure sessions.',
+               [((('event', event), ), entry['seconds'])
+                for (event, entry) in sorted(self.sessions.items())])
+        return '\n'.join(lines) + '\n'
+
+    def __notify(self, kind, fields):
+        for callback in self.callbacks:
+            callback(kind, fields)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value) for (name, value) in labels)
+
+
+def _value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
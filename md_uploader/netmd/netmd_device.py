@@ -2,7 +2,8 @@
 
 High-level interface to NetMD devices.
 
-The module itself is iterable. Getting all supported devices is as simple as:
+Devices are looked up with find_devices(). For compatibility the module itself
+is also iterable:
 ```
 import netmd_device as devices
 
@@ -10,20 +11,24 @@ for netmd in devices:
     # do something with the device, e.g. pass to higher level interface
 
 ```
+Importing the module has no side effects: USB and the ciphers are only loaded
+when first needed.
 """
 
 import sys
-from struct import pack
-
-from Crypto.Cipher import DES
-from Crypto.Cipher import DES3
+from time import perf_counter
+from types import ModuleType
 
+from .codec import compile_query
+from .codec import compile_response
 from .constants import KEK
 from .constants import WIRE_TO_FRAME_SIZE
 from .exception import NetMDException
 from .exception import NetMDNotImplemented
 from .exception import NetMDRejected
-from . import usb_device as devices
+from .pipeline import PacketPipeline
+from .polling import command_name
+from .progress import TransferProgress
 from .util import bytes_to_str
 from .util import BCD2int
 from .util import create_iv
@@ -31,18 +36,31 @@ from .util import int2BCD
 from .util import str_to_bytearray
 
 
-class NetMDDevicesModule(object):
-    def __init__(self):
-        pass
+def find_devices():
+    """
+      Returns a list of NetMD instances for the plugged-in devices.
+    """
+    from . import usb_device
+
+    return [NetMD(net_md_usb) for net_md_usb in usb_device.find_devices()]
+
+
+class NetMDDevicesModule(ModuleType):
+    """
+      Module type making this module an iterator over plugged-in NetMD
+      devices while keeping its attributes (NetMD, ...) importable.
+    """
 
     def __iter__(self):
-      """
-        Iterator for plugged-in NetMD devices.
+        return self
+
+    def __next__(self):
+        """
+          Returns the next NetMD instance.
+        """
+        from . import usb_device
 
-        Returns (yields) NetMD instances.
-      """
-      for dev in devices:
-          yield NetMD(dev)
+        return NetMD(next(usb_device))
 
 
 class NetMD(object):
@@ -70,13 +88,6 @@ class NetMD(object):
     __STATUS_ACCEPTED = 0x09
     __STATUS_REJECTED = 0x0a
 
-    __FORMAT_TYPE_LEN_DICT = {
-        'b': 1, # byte
-        'w': 2, # word
-        'd': 4, # doubleword
-        'q': 8, # quadword
-    }
-
     __ACTION_PLAY = 0x75
     __ACTION_PAUSE = 0x7d
     __ACTION_FASTFORWARD = 0x39
@@ -92,19 +103,30 @@ class NetMD(object):
     __EKBID = 0x26422642 #"\x06\xec\xfa\xb1\xc8\xa2\x1b\xfd"
     __EKB_DATA = (
         [
-            "\x25\x45\x06\x4d\xea\xca\x14\xf9\x96\xbd\xc8\xa4\x06\xc2\x2b\x81",
-            "\xfb\x60\xbd\xdd\x0d\xbc\xab\x84\x8a\x00\x5e\x03\x19\x4d\x3e\xda"
+            b"\x25\x45\x06\x4d\xea\xca\x14\xf9\x96\xbd\xc8\xa4\x06\xc2\x2b\x81",
+            b"\xfb\x60\xbd\xdd\x0d\xbc\xab\x84\x8a\x00\x5e\x03\x19\x4d\x3e\xda"
         ],
         9,
-        "\x8f\x2b\xc3\x52\xe8\x6c\x5e\xd3\x06\xdc\xae\x18\xd2\xf3\x8c\x7f\x89\xb5\xe1\x85\x55\xa1\x05\xea"
+        b"\x8f\x2b\xc3\x52\xe8\x6c\x5e\xd3\x06\xdc\xae\x18\xd2\xf3\x8c\x7f\x89\xb5\xe1\x85\x55\xa1\x05\xea"
     )
 
-    def __init__(self, net_md_usb):
+    def __init__(self, net_md_usb, queue_depth=2, metrics=None):
         """
           net_md (NetMD)
             Interface to the NetMD device to use.
+          queue_depth (int)
+            Number of packets send_track prepares ahead of the USB writes.
+            Zero disables the packet producer thread.
+          metrics (MetricsRegistry)
+            Records every command, see metrics.py. It is also passed on to
+            net_md_usb if that supports it. None disables instrumentation.
         """
         self.net_md_usb = net_md_usb
+        self.queue_depth = queue_depth
+        self.metrics = metrics
+        if metrics is not None and hasattr(net_md_usb, 'metrics'):
+            net_md_usb.metrics = metrics
+        self.transfer_stats = None
 
     #
     # Disc wide controls
@@ -253,9 +275,9 @@ class NetMD(object):
             done += chunk_size
             remaining = total - done
         #if not wchar and len(result):
-        #    assert result[-1] == '\x00'
+        #    assert result[-1] == b'\x00'
         #    result = result[:-1]
-        return ''.join(result)
+        return bytes_to_str(b''.join(result))
 
     def set_disc_title(self, title, wchar=False):
         """
@@ -294,11 +316,11 @@ class NetMD(object):
         result = self.__parse_response(reply, '1806 022018%? %?%? %?%? %?%? 1000 ' \
                                 '00%?0000 00%?000a %*')[0]
         #if not wchar and len(result):
-        #    assert result[-1] == '\x00'
+        #    assert result[-1] == b'\x00'
         #    result = result[:-1]
-        return result
+        return bytes_to_str(result)
 
-    def set_track_title(self, track, title, wchar=False):
+    def set_track_title(self, track, title, wchar=False, old_length=None):
         """
           Set track title.
           track (int)
@@ -308,15 +330,21 @@ class NetMD(object):
           wchar (bool)
             If True, return the content of wchar title.
             If False, return the ASCII title.
+          old_length (int)
+            Length of the title being replaced, if known. Otherwise it is
+            read from the device first.
         """
         if wchar:
             wchar = 3
         else:
             wchar = 2
-        try:
-            old_len = len(self.get_track_title(track))
-        except NetMDRejected:
-            old_len = 0
+        if old_length is not None:
+            old_len = old_length
+        else:
+            try:
+                old_len = len(self.get_track_title(track))
+            except NetMDRejected:
+                old_len = 0
         reply = self.__send_query('1807 022018%b %w 3000 0a00 5000 %w 0000 ' \
                                   '%w %*', wchar, track, len(title), old_len,
                                   title)
@@ -344,12 +372,10 @@ class NetMD(object):
         """
         reply = self.__send_query('1809 8001 0230 8800 0030 8804 00 ff00 ' \
                                   '00000000')
-        return str_to_bytearray(
-            self.__parse_response(
-                reply,
-                '1809 8001 0230 8800 0030 8804 00 1000 0009000000 %x'
-            )[0]
-        )
+        return self.__parse_response(
+            reply,
+            '1809 8001 0230 8800 0030 8804 00 1000 0009000000 %x'
+        )[0]
 
     def get_disc_capacity(self):
         """
@@ -398,8 +424,8 @@ class NetMD(object):
         reply = self.__send_query('1806 02101001 3000 1000 ff00 00000000')
         data = self.__parse_response(reply, '1806 02101001 %?%? %?%? 1000 00%?0000 %x')[0]
         assert len(data) == 6, len(data)
-        assert data[:5] == '\x00\x10\x00\x02\x00', data[:5]
-        return ord(data[5])
+        assert data[:5] == b'\x00\x10\x00\x02\x00', data[:5]
+        return data[5]
 
     def get_track_length(self, track):
         """
@@ -480,7 +506,7 @@ class NetMD(object):
          to decrypt the root key from an EKB.
          ekbid (int)
            The ID of the EKB.
-         keychain (list of 16-byte str)
+         keychain (list of 16-byte bytes)
            A chain of encrypted keys. The one end of the chain is the
            encrypted root key, the other end is a key encrypted by a key
            the device has in it's key set. The direction of the chain is
@@ -507,18 +533,20 @@ class NetMD(object):
             raise ValueError('Supplied EKB signature length wrong')
         reply = self.__send_query('1800 080046 f0030103 12 ff %w %d' \
                                   '%d %d %d 00000000 %* %*', databytes, databytes,
-                                  chainlen, depth, NetMD.__EKBID, "".join(keychain), ekbsignature)
+                                  chainlen, depth, NetMD.__EKBID, b"".join(keychain), ekbsignature)
         return self.__parse_response(reply, '1800 080046 f0030103 12 01 %?%? %?%?%?%?')
 
     def exchange_session_key(self, hostnonce):
         """
          Exchange a session key with the device. Needs to have a root
          key sent to the device using sendKeyData before.
-         hostnonce (str)
+         hostnonce (bytes)
            8 bytes random binary data
          Returns
-           device nonce (str), another 8 bytes random data
+           device nonce (bytes), another 8 bytes random data
         """
+        if isinstance(hostnonce, str):
+            hostnonce = str_to_bytearray(hostnonce)
         if len(hostnonce) != 8:
             raise ValueError('Supplied host nonce length wrong')
         reply = self.__send_query('1800 080046 f0030103 20 ff 000000 %*', hostnonce)
@@ -539,7 +567,7 @@ class NetMD(object):
     def setup_download(self, sessionkey):
         """
          Prepare the download of a music track to the device.
-         sessionkey (str)
+         sessionkey (bytes)
            8 bytes DES key used for securing the current session, the key
            has to be calculated by the caller from the data exchanged in
            sessionKeyExchange and the root key selected by sendKeyData
@@ -547,14 +575,15 @@ class NetMD(object):
         if len(sessionkey) != 8:
             raise ValueError('Supplied Session Key length wrong')
 
+        from Crypto.Cipher import DES
+
         iv = create_iv()
         encrypter = DES.new(sessionkey, DES.MODE_CBC, iv)
 
-        padding = (4 * '\1').encode('utf-8')
-        encryptedarg_bytes = encrypter.encrypt(padding + NetMD.__CONTENT_ID + KEK)
-        encryptedarg_str = bytes_to_str(encryptedarg_bytes)
+        padding = 4 * b'\1'
+        encryptedarg = encrypter.encrypt(padding + NetMD.__CONTENT_ID + KEK)
 
-        reply = self.__send_query('1800 080046 f0030103 22 ff 0000 %*', encryptedarg_str)
+        reply = self.__send_query('1800 080046 f0030103 22 ff 0000 %*', encryptedarg)
         return self.__parse_response(reply, '1800 080046 f0030103 22 00 0000')
 
     def commit_track(self, tracknum, sessionkey):
@@ -564,18 +593,21 @@ class NetMD(object):
          computer.
          track (int)
            Track number returned from downloading command
-         sessionkey (str)
+         sessionkey (bytes)
            8-byte DES key used for securing the download session
         """
         if len(sessionkey) != 8:
             raise ValueError('Supplied Session Key length wrong')
+        from Crypto.Cipher import DES
+
         encrypter = DES.new(sessionkey, DES.MODE_ECB)
         authentication = encrypter.encrypt(create_iv())
         reply = self.__send_query('1800 080046 f0030103 48 ff 00 1001 %w %*',
-                                  tracknum, bytes_to_str(authentication))
+                                  tracknum, authentication)
         return self.__parse_response(reply, '1800 080046 f0030103 48 00 00 1001 %?%?')
 
-    def send_track(self, wireformat, diskformat, frames, pktcount, packets, sessionkey):
+    def send_track(self, wireformat, diskformat, frames, pktcount, packets, sessionkey,
+                   progress=None):
         """
          Send a track to the NetMD unit.
          wireformat (int)
@@ -594,16 +626,24 @@ class NetMD(object):
            Number of data packets to send (needed to calculate the raw
            packetized stream size
          packets (iterator)
-           iterator over (str, str, str), with the first string being the
-           encrypted DES encryption key for this packet (8 bytes), the second
-           the IV (8 bytes, too) and the third string the encrypted data.
-         sessionkey (str)
+           iterator over (bytes, bytes, bytes), with the first value being
+           the encrypted DES encryption key for this packet (8 bytes), the
+           second the IV (8 bytes, too) and the third the encrypted data.
+           An item may also be a packet already in its wire representation
+           (see pipeline.frame_packet), which is written as is.
+         sessionkey (bytes)
            8-byte DES key used for securing the download session
+         progress (callable)
+           Called with a TransferProgress after every packet written, see
+           progress.py. Raising from it aborts the transfer.
+         Packets are read and encrypted on a worker thread while the previous
+         one is written, see queue_depth. Timings of the transfer are kept in
+         transfer_stats.
          Returns
            A tuple (tracknum, UUID, content ID).
            tracknum (int)
              the number the new track got.
-           UUID (str)
+           UUID (bytes)
              an 8-byte-value to recognize this track for check-in purpose
            content ID
              the content ID. Should always be the same as passed to 
@@ -621,19 +661,24 @@ class NetMD(object):
         self.__parse_response(reply, '1800 080046 f0030103 28 00 000100 1001 %?%? 00'\
                               '%*')
 
-        for (key, iv, data) in packets:
-            binpkt = pack('>Q',len(data)) + key + iv + data
-            self.net_md_usb.writeBulk(binpkt)
+        transfer_progress = None
+        if progress is not None:
+            transfer_progress = TransferProgress(totalbytes, pktcount)
+        pipeline = PacketPipeline(packets, self.net_md_usb.writeBulk, self.queue_depth,
+                                  transfer_progress, progress)
+        self.transfer_stats = pipeline.run()
 
-        reply = self.__read_reply()
+        reply = self.__read_reply('1800:28:done')
         self.net_md_usb._getReplyLength()
 
         (track, encryptedreply) = \
           self.__parse_response(reply, '1800 080046 f0030103 28 00 000100 1001 %w 00' \
                                 '%?%? %?%?%?%? %?%?%?%? %*')
+        from Crypto.Cipher import DES
+
         iv = create_iv()
         encrypter = DES.new(sessionkey, DES.MODE_CBC, iv)
-        replydata = encrypter.decrypt(str_to_bytearray(encryptedreply))
+        replydata = encrypter.decrypt(encryptedreply)
 
         return (track, replydata[0:8], replydata[12:32])
 
@@ -657,16 +702,30 @@ class NetMD(object):
     #
 
     def __send_query(self, query_format, *query_args):
-        query = [NetMD.__STATUS_CONTROL, ] + self.__format_query(query_format, *query_args)
-        binquery = bytes_to_str(query)
+        query = bytes((NetMD.__STATUS_CONTROL, )) + self.__format_query(query_format, *query_args)
+
+        if self.metrics is not None:
+            started = perf_counter()
+            self.net_md_usb.sendCommand(query)
+            return self.__read_reply(command_name(query), len(query), started)
 
         self.net_md_usb.sendCommand(query)
 
         return self.__read_reply()
 
-    def __read_reply(self):
+    def __read_reply(self, name=None, request_size=0, started=None):
+        """
+          Read and check a reply. The other arguments are only used for
+          metrics: the name and size of the command replied to and when it
+          was sent, by default the time this reply starts being read.
+        """
+        if self.metrics is not None and started is None:
+            started = perf_counter()
         result = self.net_md_usb.readReply()
         status = result[0]
+        if self.metrics is not None:
+            self.metrics.record_command(name, request_size, len(result),
+                                        perf_counter() - started, status)
         if status == NetMD.__STATUS_NOT_IMPLEMENTED:
             raise NetMDNotImplemented('Not implemented')
         elif status == NetMD.__STATUS_REJECTED:
@@ -675,103 +734,13 @@ class NetMD(object):
                             NetMD.__STATUS_INTERIM):
             raise NotImplementedError('Unknown returned status: %02X' %
                 (status, ))
-        return result[1:]
+        return memoryview(result)[1:]
 
     def __format_query(self, format, *args):
-        result = []
-        append = result.append
-        extend = result.extend
-        half = None
-        def hexAppend(value):
-            append(int(value, 16))
-        escaped = False
-        arg_stack = list(args)
-        for char in format:
-            if escaped:
-                escaped = False
-                value = arg_stack.pop(0)
-                if char in NetMD.__FORMAT_TYPE_LEN_DICT:
-                    for byte in range(NetMD.__FORMAT_TYPE_LEN_DICT[char] - 1, -1, -1):
-                        append((value >> (byte * 8)) & 0xff)
-                elif char == 'x':
-                    length = len(value)
-                    append((length >> 8) & 0xff)
-                    append(length & 0xff)
-                    extend(ord(x) for x in value)
-                elif char == '*':
-                    extend(ord(x) for x in value)
-                else:
-                    raise ValueError('Unrecognised format char: %r' % (char, ))
-                continue
-            if char == '%':
-                assert half is None
-                escaped = True
-                continue
-            if char == ' ':
-                continue
-            if half is None:
-                half = char
-            else:
-                hexAppend(half + char)
-                half = None
-        assert len(arg_stack) == 0
-        return result
+        return compile_query(format).encode(*args)
 
     def __parse_response(self, response, format):
-        result = []
-        append = result.append
-        half = None
-        escaped = False
-        input_stack = list(response)
-        def pop():
-            return input_stack.pop(0)
-        for char in format:
-            if escaped:
-                escaped = False
-                if char == '?':
-                    pop()
-                    continue
-                if char in NetMD.__FORMAT_TYPE_LEN_DICT:
-                    value = 0
-                    for byte in range(NetMD.__FORMAT_TYPE_LEN_DICT[char] - 1, -1, -1):
-                        value |= (pop() << (byte * 8))
-                    append(value)
-                # String ('s' is 0-terminated, 'x' is not)
-                elif char in ('s', 'x'):
-                    length = pop() << 8 | pop()
-                    value = ''.join(bytes_to_str(input_stack)[:length])
-                    input_stack = input_stack[length:]
-                    if char == 's':
-                        append(value[:-1])
-                    else:
-                        append(value)
-                # Fetch the remainder of the response in one value
-                elif char == '*':
-                    value = bytes_to_str(input_stack)
-                    input_stack = []
-                    append(value)
-                else:
-                    raise ValueError('Unrecognised format char: %r' % (char, ))
-                continue
-            if char == '%':
-                assert half is None
-                escaped = True
-                continue
-            if char == ' ':
-                continue
-            if half is None:
-                half = char
-            else:
-                input_value = pop()
-                format_value = int(half + char, 16)
-                if format_value != input_value:
-                    raise ValueError('Format and input mismatch at %i: '
-                        'expected %02x, got %02x' % (
-                            len(response) - len(input_stack) - 1,
-                            format_value, input_value))
-                half = None
-        assert len(input_stack) == 0
-        return result
+        return compile_response(format).decode(response)
 
 
-sys.modules[__name__] = iter(NetMDDevicesModule())
+sys.modules[__name__].__class__ = NetMDDevicesModule
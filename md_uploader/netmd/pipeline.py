@@ -0,0 +1,203 @@
+"""Packet pipeline
+
+Overlaps packet production (reading and encrypting track data) with USB bulk
+writes. A worker thread pulls packets from the producer iterator and hands them
+over through a bounded queue while the calling thread writes the previous
+packet to the device.
+"""
+
+from queue import Full
+from queue import Queue
+from struct import Struct
+import threading
+import time
+
+
+class PipelineStats(object):
+    """
+      Per-stage timing counters of a packet transfer, all in seconds.
+      produce_time
+        Time spent reading, encrypting and framing packets.
+      write_time
+        Time spent in bulk writes.
+      producer_wait
+        Time the producer was blocked on a full queue.
+      consumer_wait
+        Time the writer was blocked on an empty queue.
+      elapsed
+        Wall time of the whole transfer.
+    """
+
+    def __init__(self, queue_depth):
+        self.queue_depth = queue_depth
+        self.packets = 0
+        self.bytes = 0
+        self.produce_time = 0.0
+        self.write_time = 0.0
+        self.producer_wait = 0.0
+        self.consumer_wait = 0.0
+        self.elapsed = 0.0
+
+    def overlap(self):
+        """
+          Time during which producing and writing ran concurrently.
+        """
+        return max(0.0, self.produce_time + self.write_time - self.elapsed)
+
+    def __repr__(self):
+        return '<PipelineStats depth=%d packets=%d bytes=%d produce=%.3fs ' \
+               'write=%.3fs producer_wait=%.3fs consumer_wait=%.3fs ' \
+               'elapsed=%.3fs overlap=%.3fs>' % (
+                   self.queue_depth, self.packets, self.bytes, self.produce_time,
+                   self.write_time, self.producer_wait, self.consumer_wait,
+                   self.elapsed, self.overlap())
+
+
+PACKET_HEADER = Struct('>Q8s8s')
+
+
+def frame_packet(key, iv, data):
+    """
+      Build the wire representation of a packet: data length (8 bytes, big
+      endian), encrypted key, IV, encrypted data.
+    """
+    return PACKET_HEADER.pack(len(data), key, iv) + data
+
+
+def to_wire(packet):
+    """
+      Wire representation of a packet given either as a (key, iv, data)
+      tuple or already framed.
+    """
+    if isinstance(packet, tuple):
+        return frame_packet(*packet)
+    return packet
+
+
+class PacketPipeline(object):
+    """
+      Writes packets to a bulk writer, producing the next ones on a worker
+      thread.
+      packets (iterator)
+        iterator over (key, iv, data) tuples or framed packets, see
+        NetMD.send_track.
+      write (callable)
+        Called with each framed packet, e.g. NetMDUSB.writeBulk.
+      queue_depth (int)
+        Number of framed packets allowed to wait for the writer. Zero
+        disables the worker thread and runs everything in the caller.
+      progress (TransferProgress)
+        Updated after each write, see progress.py.
+      callback (callable)
+        Called with progress after each write, in the writing thread.
+        Raising from it aborts the transfer.
+    """
+
+    __POLL_INTERVAL = 0.1
+    __DONE = object()
+
+    def __init__(self, packets, write, queue_depth=2, progress=None, callback=None):
+        if queue_depth < 0:
+            raise ValueError('queue_depth must not be negative')
+        self.packets = packets
+        self.write = write
+        self.queue_depth = queue_depth
+        self.progress = progress
+        self.callback = callback
+        self.stats = PipelineStats(queue_depth)
+
+    def run(self):
+        """
+          Transfer all packets. Returns the PipelineStats.
+        """
+        started = time.perf_counter()
+        try:
+            if self.queue_depth == 0:
+                self.__run_serial()
+            else:
+                self.__run_threaded()
+        finally:
+            self.stats.elapsed = time.perf_counter() - started
+        return self.stats
+
+    def __run_serial(self):
+        stats = self.stats
+        packets = iter(self.packets)
+        while True:
+            produce_started = time.perf_counter()
+            try:
+                packet = next(packets)
+            except StopIteration:
+                break
+            binpkt = to_wire(packet)
+            stats.produce_time += time.perf_counter() - produce_started
+            self.__write(binpkt)
+
+    def __run_threaded(self):
+        stats = self.stats
+        queue = Queue(self.queue_depth)
+        stopped = threading.Event()
+        worker = threading.Thread(target=self.__produce, args=(queue, stopped),
+                                  name='netmd-packet-producer')
+        worker.daemon = True
+        worker.start()
+        try:
+            while True:
+                wait_started = time.perf_counter()
+                item = queue.get()
+                stats.consumer_wait += time.perf_counter() - wait_started
+                if item is PacketPipeline.__DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                self.__write(item)
+        finally:
+            stopped.set()
+            worker.join()
+
+    def __produce(self, queue, stopped):
+        stats = self.stats
+        packets = iter(self.packets)
+        try:
+            while not stopped.is_set():
+                produce_started = time.perf_counter()
+                try:
+                    packet = next(packets)
+                except StopIteration:
+                    break
+                binpkt = to_wire(packet)
+                stats.produce_time += time.perf_counter() - produce_started
+                if not self.__put(queue, stopped, binpkt):
+                    return
+        except BaseException as e:
+            self.__put(queue, stopped, e)
+            return
+        finally:
+            close = getattr(packets, 'close', None)
+            if close is not None:
+                close()
+        self.__put(queue, stopped, PacketPipeline.__DONE)
+
+    def __put(self, queue, stopped, item):
+        wait_started = time.perf_counter()
+        try:
+            while not stopped.is_set():
+                try:
+                    queue.put(item, timeout=PacketPipeline.__POLL_INTERVAL)
+                    return True
+                except Full:
+                    pass
+            return False
+        finally:
+            self.stats.producer_wait += time.perf_counter() - wait_started
+
+    def __write(self, binpkt):
+        write_started = time.perf_counter()
+        self.write(binpkt)
+        self.stats.write_time += time.perf_counter() - write_started
+        self.stats.packets += 1
+        self.stats.bytes += len(binpkt)
+        if self.progress is not None:
+            self.progress.update(len(binpkt))
+            if self.callback is not None:
+                self.callback(self.progress)
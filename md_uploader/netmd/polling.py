@@ -0,0 +1,133 @@
+"""Reply polling
+
+Strategy for waiting on NetMD replies and a latency histogram to tune it.
+"""
+
+from bisect import bisect_left
+from time import perf_counter
+from time import sleep
+
+from .exception import NetMDTimeout
+
+
+class PollingStrategy(object):
+    """
+      Decides how long to wait between polls for a reply: a few immediate
+      re-polls, then exponentially growing sleeps up to a cap.
+      spin_count (int)
+        Number of polls repeated without sleeping.
+      initial_delay (float)
+        First sleep after spinning, in seconds.
+      backoff (float)
+        Factor applied to the sleep after each empty poll.
+      max_delay (float)
+        Upper bound of a single sleep, in seconds.
+      timeout (float)
+        Give up with NetMDTimeout after this many seconds. None waits
+        forever.
+    """
+
+    def __init__(self, spin_count=3, initial_delay=0.001, backoff=2.0,
+                 max_delay=0.1, timeout=None):
+        if initial_delay <= 0 or max_delay < initial_delay:
+            raise ValueError('Need 0 < initial_delay <= max_delay')
+        if backoff < 1:
+            raise ValueError('backoff must be at least 1')
+        self.spin_count = spin_count
+        self.initial_delay = initial_delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.timeout = timeout
+
+    def delays(self):
+        """
+          Yields the sleep to apply after each consecutive empty poll.
+        """
+        for spin in range(self.spin_count):
+            yield 0.0
+        delay = self.initial_delay
+        while True:
+            yield delay
+            delay = min(delay * self.backoff, self.max_delay)
+
+    def wait(self, poll):
+        """
+          Call poll until it returns a true value and return that value.
+        """
+        deadline = None
+        if self.timeout is not None:
+            deadline = perf_counter() + self.timeout
+        for delay in self.delays():
+            value = poll()
+            if value:
+                return value
+            if deadline is not None:
+                remaining = deadline - perf_counter()
+                if remaining <= 0:
+                    raise NetMDTimeout('No reply within %.3f s' % self.timeout)
+                delay = min(delay, remaining)
+            if delay:
+                sleep(delay)
+
+
+def command_name(command):
+    """
+      Short name of a raw NetMD command for reporting: the hex opcode, plus
+      the subcommand for secure session commands.
+    """
+    command = bytes(command)
+    name = command[1:3].hex()
+    if command[3:10] == b'\x08\x00\x46\xf0\x03\x01\x03' and len(command) > 10:
+        name += ':%02x' % command[10]
+    return name
+
+
+class LatencyHistogram(object):
+    """
+      Reply latencies per command, in logarithmic buckets.
+    """
+
+    BUCKETS = tuple(0.00025 * 2 ** exponent for exponent in range(16))
+
+    def __init__(self):
+        self.commands = {}
+
+    def record(self, name, seconds):
+        entry = self.commands.get(name)
+        if entry is None:
+            entry = self.commands[name] = {
+                'count': 0,
+                'total': 0.0,
+                'max': 0.0,
+                'buckets': [0] * (len(LatencyHistogram.BUCKETS) + 1),
+            }
+        entry['count'] += 1
+        entry['total'] += seconds
+        entry['max'] = max(entry['max'], seconds)
+        entry['buckets'][bisect_left(LatencyHistogram.BUCKETS, seconds)] += 1
+
+    def percentile(self, name, fraction):
+        """
+          Upper bound of the bucket holding the given fraction of replies.
+        """
+        entry = self.commands[name]
+        threshold = fraction * entry['count']
+        seen = 0
+        for (index, count) in enumerate(entry['buckets']):
+            seen += count
+            if count and seen >= threshold:
+                if index < len(LatencyHistogram.BUCKETS):
+                    return min(LatencyHistogram.BUCKETS[index], entry['max'])
+                break
+        return entry['max']
+
+    def report(self):
+        lines = ['%-10s %6s %9s %9s %9s %9s' % ('command', 'count', 'mean ms',
+                                                 'p50 ms', 'p95 ms', 'max ms')]
+        for name in sorted(self.commands):
+            entry = self.commands[name]
+            lines.append('%-10s %6d %9.2f %9.2f %9.2f %9.2f' % (
+                name, entry['count'], 1000 * entry['total'] / entry['count'],
+                1000 * self.percentile(name, 0.5), 1000 * self.percentile(name, 0.95),
+                1000 * entry['max']))
+        return '\n'.join(lines)
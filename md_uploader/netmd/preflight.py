@@ -0,0 +1,172 @@
+"""Upload preflight
+
+Checks whether tracks fit on the disc before anything is erased or written,
+and estimates how long uploading them takes. Track durations are rounded up
+to whole frames, the unit the disc space is taken in, and compared with the
+space reported by NetMD.get_disc_capacity:
+```
+preflight = Preflight(net_md)
+result = preflight.check(track.duration for track in playlist)
+if not result.fits:
+    raise ...
+net_md.erase_disc()
+```
+"""
+
+from collections import namedtuple
+import math
+
+from .constants import DISK_FORMAT_SPACE
+from .constants import SAMPLE_RATE
+from .constants import SAMPLES_PER_FRAME
+from .constants import WIRE_TO_DISK_FORMAT
+from .constants import WIRE_TO_FRAME_SIZE
+from .constants import WIREFORMAT_PCM
+
+
+# rough bulk rate of a full speed USB NetMD unit, bytes per second; pass the
+# rate measured on earlier uploads for better estimates
+DEFAULT_THROUGHPUT = 1 << 20
+# secure session commands around each track, seconds
+DEFAULT_TRACK_OVERHEAD = 1.0
+
+DiscCapacity = namedtuple('DiscCapacity', [
+    'recorded',
+    'total',
+    'available',
+])  # seconds of SP stereo
+
+
+def track_frames(duration):
+    """
+      Number of frames a track of duration seconds is uploaded in.
+    """
+    return int(math.ceil(duration * SAMPLE_RATE / SAMPLES_PER_FRAME))
+
+
+def track_space(duration, wireformat=WIREFORMAT_PCM):
+    """
+      Disc space, in seconds of SP stereo, a track of duration seconds
+      takes once uploaded in wireformat.
+    """
+    space = DISK_FORMAT_SPACE[WIRE_TO_DISK_FORMAT[wireformat]]
+    return track_frames(duration) * SAMPLES_PER_FRAME * space / SAMPLE_RATE
+
+
+def capacity_seconds(time):
+    """
+      Seconds in a [hours, minutes, seconds, frames] list as returned by
+      get_disc_capacity and get_track_length.
+    """
+    (hours, minutes, seconds, frames) = time
+    return (hours * 60 + minutes) * 60 + seconds + frames * SAMPLES_PER_FRAME / float(SAMPLE_RATE)
+
+
+class PreflightResult(object):
+    """
+      fits (bool)
+        Whether all tracks fit.
+      required (float)
+        Disc space the tracks take, in seconds of SP stereo.
+      available (float)
+        Disc space available for them, in seconds of SP stereo.
+      fitting_tracks (int)
+        Number of leading tracks that fit.
+      track_count (int)
+      upload_bytes (int)
+        Track data to transfer.
+      upload_seconds (float)
+        Estimated transfer time of all tracks.
+    """
+
+    def __init__(self, required, available, fitting_tracks, track_count,
+                 upload_bytes, upload_seconds):
+        self.fits = fitting_tracks == track_count
+        self.required = required
+        self.available = available
+        self.fitting_tracks = fitting_tracks
+        self.track_count = track_count
+        self.upload_bytes = upload_bytes
+        self.upload_seconds = upload_seconds
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    def __repr__(self):
+        return '<PreflightResult fits=%s required=%.1fs available=%.1fs tracks=%d/%d ' \
+               'upload=%.1fs>' % (self.fits, self.required, self.available,
+                                  self.fitting_tracks, self.track_count,
+                                  self.upload_seconds)
+
+
+class Preflight(object):
+    """
+      Plans uploads to the disc in a NetMD device. The disc capacity is
+      queried once and cached until invalidate() is called, e.g. when the
+      disc may have been swapped; commit() accounts for uploads done since.
+    """
+
+    def __init__(self, net_md, wireformat=WIREFORMAT_PCM,
+                 throughput=DEFAULT_THROUGHPUT, track_overhead=DEFAULT_TRACK_OVERHEAD):
+        """
+          net_md (NetMD)
+            Device holding the disc.
+          wireformat (int)
+            Format tracks are uploaded in, see WIREFORMAT_* constants.
+          throughput (float)
+            Upload rate in bytes per second.
+          track_overhead (float)
+            Seconds spent per track besides the transfer.
+        """
+        self.net_md = net_md
+        self.wireformat = wireformat
+        self.throughput = throughput
+        self.track_overhead = track_overhead
+        self.__capacity = None
+
+    def capacity(self):
+        """
+          Returns the DiscCapacity, asking the device on first use.
+        """
+        if self.__capacity is None:
+            (recorded, total, available) = self.net_md.get_disc_capacity()
+            self.__capacity = DiscCapacity(capacity_seconds(recorded),
+                                           capacity_seconds(total),
+                                           capacity_seconds(available))
+        return self.__capacity
+
+    def invalidate(self):
+        self.__capacity = None
+
+    def check(self, durations, erase=True):
+        """
+          Plan the upload of tracks of the given durations (seconds).
+          erase (bool)
+            Whether the disc is erased first, making all of it available.
+          Returns a PreflightResult.
+        """
+        capacity = self.capacity()
+        available = capacity.total if erase else capacity.available
+        frame_size = WIRE_TO_FRAME_SIZE[self.wireformat]
+
+        (required, fitting_tracks, track_count, upload_bytes) = (0.0, 0, 0, 0)
+        for duration in durations:
+            frames = track_frames(duration)
+            required += track_space(duration, self.wireformat)
+            track_count += 1
+            if required <= available and fitting_tracks == track_count - 1:
+                fitting_tracks += 1
+            upload_bytes += frames * frame_size
+        upload_seconds = upload_bytes / float(self.throughput) + track_count * self.track_overhead
+        return PreflightResult(required, available, fitting_tracks, track_count,
+                               upload_bytes, upload_seconds)
+
+    def commit(self, result, erase=True):
+        """
+          Account for the upload planned by result having been done, so the
+          capacity need not be queried again.
+        """
+        capacity = self.capacity()
+        recorded = result.required if erase else capacity.recorded + result.required
+        self.__capacity = DiscCapacity(recorded, capacity.total,
+                                       max(capacity.total - recorded, 0.0))
@@ -0,0 +1,103 @@
+"""Transfer progress
+
+Progress reporting for track downloads. send_track (and download_track,
+download_tracks, MDSession.download_track) accept a progress callback that is
+called with a TransferProgress after every bulk write. A callback aborts the
+transfer by raising, e.g. NetMDTransferAborted; ThroughputWatchdog is a
+ready-made callback doing so when the link is too slow.
+"""
+
+import time
+
+from .exception import NetMDTransferAborted
+
+
+class TransferProgress(object):
+    """
+      State of a track transfer. The same instance is updated and passed
+      to the callback after every write; copy the values to keep them.
+      total_bytes, total_packets
+        Size of the whole transfer.
+      bytes_sent, packets_sent
+        Written so far.
+      elapsed
+        Seconds since the transfer started.
+      current_throughput
+        Bytes per second since the previous write.
+    """
+
+    def __init__(self, total_bytes, total_packets):
+        self.total_bytes = total_bytes
+        self.total_packets = total_packets
+        self.bytes_sent = 0
+        self.packets_sent = 0
+        self.elapsed = 0.0
+        self.current_throughput = 0.0
+        self.__started = time.perf_counter()
+
+    def update(self, size):
+        """
+          Account for a write of size bytes that just completed.
+        """
+        elapsed = time.perf_counter() - self.__started
+        interval = elapsed - self.elapsed
+        self.bytes_sent += size
+        self.packets_sent += 1
+        self.elapsed = elapsed
+        self.current_throughput = size / interval if interval > 0 else 0.0
+
+    def average_throughput(self):
+        """
+          Bytes per second since the transfer started.
+        """
+        if self.elapsed <= 0:
+            return 0.0
+        return self.bytes_sent / self.elapsed
+
+    def fraction(self):
+        if not self.total_bytes:
+            return 1.0
+        return self.bytes_sent / float(self.total_bytes)
+
+    def eta(self):
+        """
+          Estimated seconds until the transfer completes at the average
+          throughput, None before anything was sent.
+        """
+        throughput = self.average_throughput()
+        if not throughput:
+            return None
+        return max(self.total_bytes - self.bytes_sent, 0) / throughput
+
+    def __repr__(self):
+        eta = self.eta()
+        return '<TransferProgress %d/%d bytes %d/%d packets %.1f KiB/s eta %s>' % (
+            self.bytes_sent, self.total_bytes, self.packets_sent, self.total_packets,
+            self.average_throughput() / 1024.0, '-' if eta is None else '%.1fs' % eta)
+
+
+class ThroughputWatchdog(object):
+    """
+      Progress callback aborting transfers whose average throughput stays
+      below a minimum once a grace period is over.
+      min_throughput (float)
+        Bytes per second.
+      grace_period (float)
+        Seconds from the start of a transfer during which it is not
+        checked.
+      callback (callable)
+        Optional progress callback to forward to, e.g. a UI update.
+    """
+
+    def __init__(self, min_throughput, grace_period=5.0, callback=None):
+        self.min_throughput = min_throughput
+        self.grace_period = grace_period
+        self.callback = callback
+
+    def __call__(self, progress):
+        if self.callback is not None:
+            self.callback(progress)
+        if progress.elapsed >= self.grace_period and \
+                progress.average_throughput() < self.min_throughput:
+            raise NetMDTransferAborted('Transfer too slow: %.1f KiB/s after %.1f s' % (
+                progress.average_throughput() / 1024.0, progress.elapsed))
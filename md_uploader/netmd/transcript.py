@@ -0,0 +1,261 @@
+"""NetMD USB transcripts
+
+RecordingNetMDUSB wraps a NetMDUSB and logs every command, reply, reply
+length poll and bulk write with its timing into a binary trace file. Bulk
+payloads are only summarised by length and hash. ReplayNetMDUSB serves the
+recorded replies back to NetMD, checking that the same commands come in, so a
+session captured once on a real device can be run again without it:
+```
+net_md = next(devices)
+with RecordingNetMDUSB(net_md.net_md_usb, 'upload.trace') as recorder:
+    net_md.net_md_usb = recorder
+    download_track(net_md, 'track.pcm', 'Title')
+
+net_md = NetMD(ReplayNetMDUSB('upload.trace'))
+download_track(net_md, 'track.pcm', 'Title')
+```
+
+A trace starts with MAGIC followed by records of RECORD_HEADER (kind, start
+time and duration in seconds relative to the start of the recording, length)
+and length bytes of data; for bulk writes the data is the BULK_DIGEST_SIZE
+byte hash of the payload while length is the payload size.
+"""
+
+from collections import namedtuple
+import hashlib
+import struct
+import time
+
+from .exception import NetMDTranscriptMismatch
+
+
+MAGIC = b'NMDT\x01'
+RECORD_HEADER = struct.Struct('>BdfI')
+BULK_DIGEST_SIZE = 8
+
+KIND_COMMAND = 1
+KIND_REPLY = 2
+KIND_REPLY_LENGTH = 3  # length holds the polled value, no data
+KIND_BULK = 4
+
+# status byte and the command header identifying the operation
+COMMAND_KEY_LENGTH = 11
+
+TranscriptRecord = namedtuple('TranscriptRecord', [
+    'kind',
+    'started',
+    'elapsed',
+    'length',
+    'data',
+])
+
+
+def bulk_digest(data):
+    return hashlib.blake2b(data, digest_size=BULK_DIGEST_SIZE).digest()
+
+
+def read_transcript(filename):
+    """
+      Returns the list of TranscriptRecords stored in filename.
+    """
+    with open(filename, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a NetMD transcript' % (filename, ))
+        records = []
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if not header:
+                return records
+            if len(header) < RECORD_HEADER.size:
+                raise ValueError('Truncated transcript %s' % (filename, ))
+            (kind, started, elapsed, length) = RECORD_HEADER.unpack(header)
+            if kind == KIND_REPLY_LENGTH:
+                data = b''
+            elif kind == KIND_BULK:
+                data = file.read(BULK_DIGEST_SIZE)
+            else:
+                data = file.read(length)
+            records.append(TranscriptRecord(kind, started, elapsed, length, data))
+
+
+class RecordingNetMDUSB(object):
+    """
+      Forwards to a NetMDUSB while logging the traffic to a trace file.
+      Other attributes (enableAsyncWrites, reply_latency, ...) are those of
+      the wrapped device.
+    """
+
+    def __init__(self, net_md_usb, filename):
+        """
+          net_md_usb (NetMDUSB)
+            Device to record.
+          filename (str)
+            Trace file to write, replaced if it exists.
+        """
+        self.net_md_usb = net_md_usb
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC)
+        self.started = time.perf_counter()
+
+    def __getattr__(self, name):
+        return getattr(self.net_md_usb, name)
+
+    @property
+    def metrics(self):
+        return self.net_md_usb.metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        # NetMD hands its registry down, the wrapped device does the recording
+        self.net_md_usb.metrics = metrics
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def sendCommand(self, command):
+        started = time.perf_counter()
+        self.net_md_usb.sendCommand(command)
+        self.__record(KIND_COMMAND, started, len(command), bytes(command))
+
+    def readReply(self):
+        started = time.perf_counter()
+        reply = self.net_md_usb.readReply()
+        self.__record(KIND_REPLY, started, len(reply), bytes(reply))
+        return reply
+
+    def _getReplyLength(self):
+        started = time.perf_counter()
+        length = self.net_md_usb._getReplyLength()
+        self.__record(KIND_REPLY_LENGTH, started, length, b'')
+        return length
+
+    def writeBulk(self, data):
+        started = time.perf_counter()
+        self.net_md_usb.writeBulk(data)
+        self.__record(KIND_BULK, started, len(memoryview(data).cast('B')), bulk_digest(data))
+
+    def __record(self, kind, started, length, data):
+        now = time.perf_counter()
+        self.file.write(RECORD_HEADER.pack(kind, started - self.started, now - started, length))
+        self.file.write(data)
+
+
+class ReplayNetMDUSB(object):
+    """
+      Stand-in for NetMDUSB replaying a trace written by RecordingNetMDUSB.
+    """
+
+    def __init__(self, filename, time_scale=1.0, strict=False, sleep=time.sleep):
+        """
+          filename (str)
+            Trace file to replay.
+          time_scale (float)
+            Factor applied to the recorded device timing: 1 reproduces it,
+            0 replays as fast as possible.
+          strict (bool)
+            Require commands and bulk payloads to be identical to the
+            recorded ones. Otherwise only the operation of each command and
+            the size of each bulk write are checked, which allows for the
+            fresh nonce (and so session key) of every secure session.
+          sleep (callable)
+            Used to reproduce the recorded timing.
+        """
+        self.records = read_transcript(filename)
+        self.time_scale = time_scale
+        self.strict = strict
+        self.sleep = sleep
+        self.commands = 0
+        self.bulk_bytes = 0
+        self.__position = 0
+        # end of the last replayed event, recorded and replayed clock
+        self.__recorded_end = 0.0
+        self.__replayed_end = time.perf_counter()
+
+    def sendCommand(self, command):
+        command = bytes(command)
+        record = self.__next(KIND_COMMAND)
+        expected = record.data
+        if not self.strict:
+            (command, expected) = (command[:COMMAND_KEY_LENGTH], expected[:COMMAND_KEY_LENGTH])
+        if command != expected:
+            raise NetMDTranscriptMismatch('Command %s sent where %s was recorded' % (
+                command.hex(), expected.hex()))
+        self.commands += 1
+        self.__replay_duration(record)
+
+    def _getReplyLength(self):
+        if self.__position < len(self.records) and \
+                self.records[self.__position].kind == KIND_REPLY_LENGTH:
+            self.__position += 1
+        position = self.__peek(KIND_REPLY)
+        if position is None:
+            return 0
+        record = self.records[position]
+        if time.perf_counter() < self.__due(record):
+            return 0
+        return record.length
+
+    def readReply(self):
+        record = self.__next(KIND_REPLY)
+        self.__wait_until(self.__due(record))
+        self.__advance(record)
+        return record.data
+
+    def writeBulk(self, data):
+        length = len(memoryview(data).cast('B'))
+        record = self.__next(KIND_BULK)
+        if length != record.length or (self.strict and bulk_digest(data) != record.data):
+            raise NetMDTranscriptMismatch('Bulk write of %d bytes does not match the '
+                                          'recorded one of %d bytes' % (length, record.length))
+        self.bulk_bytes += length
+        self.__replay_duration(record)
+
+    def flushBulk(self):
+        pass
+
+    def __peek(self, kind):
+        """
+          Position of the next record of kind, skipping reply length polls,
+          or None when the next record is of another kind.
+        """
+        position = self.__position
+        while position < len(self.records) and self.records[position].kind == KIND_REPLY_LENGTH:
+            position += 1
+        if position == len(self.records) or self.records[position].kind != kind:
+            return None
+        return position
+
+    def __next(self, kind):
+        position = self.__peek(kind)
+        if position is None:
+            raise NetMDTranscriptMismatch('Transcript has no matching record at %d' % (
+                self.__position, ))
+        self.__position = position + 1
+        return self.records[position]
+
+    def __due(self, record):
+        """
+          Replay time at which a reply becomes available, as long after the
+          previous event as in the recording.
+        """
+        recorded_delay = record.started + record.elapsed - self.__recorded_end
+        return self.__replayed_end + max(recorded_delay, 0.0) * self.time_scale
+
+    def __replay_duration(self, record):
+        self.__wait_until(time.perf_counter() + record.elapsed * self.time_scale)
+        self.__advance(record)
+
+    def __advance(self, record):
+        self.__recorded_end = record.started + record.elapsed
+        self.__replayed_end = time.perf_counter()
+
+    def __wait_until(self, deadline):
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            self.sleep(delay)
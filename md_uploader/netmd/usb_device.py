@@ -3,7 +3,8 @@
 This module defines lower-level interaction with NetMD devices via USB. Those
 calling the module should not concern themselves with USB at all.
 
-The module itself is iterable. Getting all supported devices is as simple as:
+Devices are looked up with find_devices(). For compatibility the module itself
+is also iterable:
 ```
 import devices
 
@@ -12,21 +13,53 @@ for netmd in devices:
     libnetmd.NetMDInterface(netmd)
 
 ```
+Nothing touches USB until devices are looked up: the USB context is created on
+the first call.
 """
 
 from io import StringIO
 import sys
-from time import sleep
+from time import perf_counter
+from types import ModuleType
 
 import libusb1
 import usb1
 
+from .bulk_transfer import AsyncBulkWriter
 from .constants import KNOWN_USB_ID_SET
+from .polling import command_name
+from .polling import LatencyHistogram
+from .polling import PollingStrategy
+
+
+_usb_context = None
+_devices = None
+
+
+def get_usb_context():
+    """
+      Returns the USB context shared by find_devices and module iteration,
+      creating it on the first call.
+    """
+    global _usb_context
+    if _usb_context is None:
+        _usb_context = usb1.USBContext()
+    return _usb_context
+
+
+def find_devices(usb_context=None):
+    """
+      Enumerate the plugged-in NetMD devices.
+      usb_context (usb1.USBContext)
+        Context to enumerate in, the shared one by default.
+      Returns a list of NetMDUSB instances.
+    """
+    return list(USBDevicesModule(usb_context))
 
 
 class USBDevicesModule(object):
-    def __init__(self):
-        self.usb_context = usb1.USBContext()
+    def __init__(self, usb_context=None):
+        self.usb_context = usb_context if usb_context is not None else get_usb_context()
 
     def __iter__(self):
       """
@@ -36,7 +69,24 @@ class USBDevicesModule(object):
       """
       for device in self.usb_context.getDeviceList():
           if (device.getVendorID(), device.getProductID()) in KNOWN_USB_ID_SET:
-              yield NetMDUSB(device.open())
+              yield NetMDUSB(device.open(), usb_context=self.usb_context)
+
+
+class NetMDUSBModule(ModuleType):
+    """
+      Module type making this module an iterator over plugged-in NetMD
+      devices while keeping its attributes (NetMDUSB, find_devices, ...)
+      importable. Devices are enumerated on the first next() call.
+    """
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        global _devices
+        if _devices is None:
+            _devices = iter(USBDevicesModule())
+        return next(_devices)
 
 
 class NetMDUSB(object):
@@ -46,15 +96,30 @@ class NetMDUSB(object):
 
     __BULK_WRITE_ENDPOINT = 0x02
 
-    def __init__(self, usb_handle, interface=0):
+    def __init__(self, usb_handle, interface=0, usb_context=None, polling=None,
+                 metrics=None):
         """
           usb_handle (usb1.USBDeviceHandle)
             USB device corresponding to a NetMD player.
           interface (int)
             USB interface implementing NetMD protocol on the USB device.
+          usb_context (usb1.USBContext)
+            Context the handle belongs to, needed for asynchronous writes.
+          polling (PollingStrategy)
+            How to wait for replies, defaults to PollingStrategy().
+          metrics (MetricsRegistry)
+            Records bulk writes, None disables instrumentation.
         """
         self.usb_handle = usb_handle
         self.interface = interface
+        self.usb_context = usb_context
+        self.bulk_writer = None
+        self.polling = polling if polling is not None else PollingStrategy()
+        self.reply_latency = LatencyHistogram()
+        self.metrics = metrics
+        self.__command_name = None
+        self.__command_sent = None
+        self.__bulk_done = None
         usb_handle.setConfiguration(1)
         usb_handle.claimInterface(interface)
         if self._getReplyLength() != 0:
@@ -68,6 +133,47 @@ class NetMDUSB(object):
         except: # Should specify an usb exception
             pass
 
+    def enableAsyncWrites(self, transfer_count=8, transfer_size=128 * 1024,
+                          handle_events=None):
+        """
+          Make writeBulk queue asynchronous transfers instead of blocking on
+          each one. Pending writes are completed before the next command.
+          transfer_count (int)
+            Number of transfers kept in flight.
+          transfer_size (int)
+            Size of each transfer buffer, in bytes.
+          handle_events (callable)
+            USB event processing function, defaults to the one of
+            usb_context.
+        """
+        if handle_events is None:
+            if self.usb_context is None:
+                raise ValueError('Asynchronous writes need the usb_context of the '
+                                 'handle or a handle_events function')
+            handle_events = self.usb_context.handleEvents
+        self.disableAsyncWrites()
+        self.bulk_writer = AsyncBulkWriter(self.usb_handle,
+                                           NetMDUSB.__BULK_WRITE_ENDPOINT,
+                                           handle_events, transfer_count,
+                                           transfer_size)
+
+    def disableAsyncWrites(self):
+        """
+          Go back to synchronous bulk writes.
+        """
+        if self.bulk_writer is not None:
+            try:
+                self.flushBulk()
+            finally:
+                self.bulk_writer = None
+
+    def flushBulk(self):
+        """
+          Wait for queued asynchronous writes to complete.
+        """
+        if self.bulk_writer is not None:
+            self.bulk_writer.flush()
+
     def _getReplyLength(self):
         reply = self.usb_handle.controlRead(libusb1.LIBUSB_TYPE_VENDOR | \
                                             libusb1.LIBUSB_RECIPIENT_INTERFACE,
@@ -80,23 +186,39 @@ class NetMDUSB(object):
           command (str)
             Binary command to send.
         """
+        self.flushBulk()
         self.usb_handle.controlWrite(libusb1.LIBUSB_TYPE_VENDOR | \
                                      libusb1.LIBUSB_RECIPIENT_INTERFACE,
                                      0x80, 0, 0, command)
+        self.__command_name = command_name(command)
+        self.__command_sent = perf_counter()
+        self.__bulk_done = None
 
     def readReply(self):
         """
           Get a raw binary reply from device.
           Returns the reply.
+          Latency is recorded in reply_latency, counted from the command or,
+          for replies that follow bulk data, from the end of the transfer,
+          under the command name with ':done' appended.
         """
-        reply_length = 0
-        while reply_length == 0:
-            reply_length = self._getReplyLength()
-            if reply_length == 0:
-                sleep(0.1)
+        self.flushBulk()
+        name = self.__command_name
+        waiting_since = self.__command_sent or perf_counter()
+        if self.__bulk_done is not None and name is not None:
+            if self.bulk_writer is not None:
+                # queued transfers are only known to be done once flushed
+                self.__bulk_done = perf_counter()
+            name = '%s:done' % name
+            waiting_since = self.__bulk_done
+        reply_length = self.polling.wait(self._getReplyLength)
         reply = self.usb_handle.controlRead(libusb1.LIBUSB_TYPE_VENDOR | \
                                             libusb1.LIBUSB_RECIPIENT_INTERFACE,
                                             0x81, 0, 0, reply_length)
+        if name is not None:
+            self.reply_latency.record(name, perf_counter() - waiting_since)
+        self.__command_sent = None
+        self.__bulk_done = None
         return reply
 
     def writeBulk(self, data):
@@ -105,7 +227,15 @@ class NetMDUSB(object):
           data (str)
             Data to write.
         """
-        self.usb_handle.bulkWrite(NetMDUSB.__BULK_WRITE_ENDPOINT, data)
-
-
-sys.modules[__name__] = iter(USBDevicesModule())
+        if self.metrics is not None:
+            started = perf_counter()
+        if self.bulk_writer is not None:
+            self.bulk_writer.write(data)
+        else:
+            self.usb_handle.bulkWrite(NetMDUSB.__BULK_WRITE_ENDPOINT, data)
+        self.__bulk_done = perf_counter()
+        if self.metrics is not None:
+            self.metrics.record_bulk(len(data), perf_counter() - started)
+
+
+sys.modules[__name__].__class__ = NetMDUSBModule
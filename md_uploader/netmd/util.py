@@ -37,12 +37,19 @@ def int2BCD(value, length=1):
 
 
 def bytes_to_str(value):
-    return ''.join([chr(c) for c in value])
+    """
+      Compatibility helper for callers still passing binary data as str:
+      maps each byte to the character of the same value.
+    """
+    return bytes(value).decode('latin-1')
 
 
 def str_to_bytearray(value):
-    return bytearray([ord(c) for c in value])
+    """
+      Reverse of bytes_to_str.
+    """
+    return bytearray(value.encode('latin-1'))
 
 
 def create_iv():
-    return (8 * '\0').encode('utf-8')
+    return bytes(8)
@@ -1 +1,2 @@
-from .playlist import archive_playlist, find_next_playlist_path_name, Playlist
\ No newline at end of file
+from .playlist import archive_playlist, find_next_playlist_path_name, Playlist
+from .tag_index import TagIndex
\ No newline at end of file
@@ -0,0 +1,177 @@
+"""Multi-disc planning
+
+Splits playlists too long for one disc across as few discs as possible.
+Filling discs in playlist order is tried first. When that needs more discs
+than necessary, albums (runs of consecutive tracks sharing the album tag) are
+packed whole with the best fit decreasing heuristic. If that needs more discs
+too, albums are packed whole onto as many discs as the total duration calls
+for and the tracks of the albums left over fill the gaps. The plan with the
+fewest discs wins, the more order preserving one on ties. Either way, tracks
+on a disc keep their playlist order, and discs are ordered by their first
+track.
+```
+discs = plan_discs(playlist, capacity=80 * 60)
+for disc_playlist in write_disc_playlists(discs, '/mnt/music/_minidisc_queue',
+                                          playlist.title(), music_path):
+    ...  # queue each disc as its own upload
+```
+"""
+
+from bisect import bisect_left
+import math
+import os
+from pathlib import Path, PureWindowsPath
+
+
+class DiscPlan(object):
+    """
+      Tracks planned for one disc.
+      number (int)
+        Position of the disc, from 1.
+      tracks (list)
+        Tracks, in playlist order.
+      space (float)
+        Disc space they take.
+    """
+
+    def __init__(self, number, tracks, space):
+        self.number = number
+        self.tracks = tracks
+        self.space = space
+
+    def __repr__(self):
+        return '<DiscPlan %d tracks=%d space=%.1f>' % (self.number, len(self.tracks), self.space)
+
+
+def plan_discs(tracks, capacity, space=None):
+    """
+      Plan the upload of tracks to as few discs as the heuristics find.
+      tracks (iterable)
+        Tracks with duration and album, e.g. a Playlist.
+      capacity (float)
+        Space on each disc, in the unit of space.
+      space (callable)
+        Disc space a track of the given duration in seconds takes, by
+        default the duration itself.
+      Returns a list of DiscPlans.
+    """
+    tracks = list(tracks)
+    sizes = [space(track.duration) if space is not None else track.duration
+             for track in tracks]
+    for (track, size) in zip(tracks, sizes):
+        if size > capacity:
+            raise ValueError('%s does not fit on a disc' % (track.path, ))
+    fewest = int(math.ceil(sum(sizes) / capacity)) if tracks else 0
+    albums = _album_groups(tracks, sizes, capacity)
+
+    plans = (
+        lambda: _next_fit(range(len(tracks)), sizes, capacity),
+        lambda: _best_fit_decreasing(albums, sizes, capacity),
+        lambda: _best_fit_decreasing(albums, sizes, capacity, limit=fewest),
+    )
+    bins = None
+    for plan in plans:
+        candidate = plan()
+        if bins is None or len(candidate) < len(bins):
+            bins = candidate
+        if len(bins) == fewest:
+            break
+
+    bins = sorted(sorted(indices) for indices in bins)
+    return [DiscPlan(number, [tracks[index] for index in indices],
+                     sum(sizes[index] for index in indices))
+            for (number, indices) in enumerate(bins, 1)]
+
+
+def write_disc_playlists(discs, directory, title, music_path):
+    """
+      Write an M3U playlist per disc, named after title and the disc
+      number, that Playlist reads back relative to music_path. Durations
+      are written as #EXTINF so the tracks need not be opened again, in
+      full so they read back as the very value planned with.
+      Returns the playlist file names, in disc order.
+    """
+    music_path = Path(music_path)
+    filenames = []
+    for disc in discs:
+        filename = os.path.join(directory, '%s (%d of %d).m3u' % (title, disc.number, len(discs)))
+        with open(filename, 'w') as file:
+            file.write('#EXTM3U\n')
+            for track in disc.tracks:
+                # Playlist drops the first part of each path, a drive or root
+                relative = Path(track.path).relative_to(music_path)
+                file.write('#EXTINF:%r,%s\n' % (float(track.duration), Path(track.path).stem))
+                file.write('%s\n' % PureWindowsPath('\\', *relative.parts))
+        filenames.append(filename)
+    return filenames
+
+
+def _album_groups(tracks, sizes, capacity):
+    """
+      Runs of consecutive tracks of the same album, as lists of track
+      indices. Runs longer than a disc are cut into disc sized runs.
+    """
+    groups = []
+    (group, group_size, album) = ([], 0.0, None)
+    for (index, track) in enumerate(tracks):
+        same_album = track.album is not None and track.album == album
+        if group and (not same_album or group_size + sizes[index] > capacity):
+            groups.append(group)
+            (group, group_size) = ([], 0.0)
+        group.append(index)
+        group_size += sizes[index]
+        album = track.album
+    if group:
+        groups.append(group)
+    return groups
+
+
+def _next_fit(indices, sizes, capacity):
+    bins = []
+    (current, used) = (None, 0.0)
+    for index in indices:
+        if current is None or used + sizes[index] > capacity:
+            current = []
+            bins.append(current)
+            used = 0.0
+        current.append(index)
+        used += sizes[index]
+    return bins
+
+
+def _best_fit_decreasing(groups, sizes, capacity, limit=None):
+    """
+      Put each group, largest first, on the disc it leaves the least space
+      on. Free space is kept sorted so finding that disc is a bisection.
+      Once limit discs are used, groups fitting on none of them are put
+      aside and their tracks packed one by one, largest first, at the end.
+    """
+    sized = sorted(((sum(sizes[index] for index in group), position, group)
+                    for (position, group) in enumerate(groups)),
+                   key=lambda item: (-item[0], item[1]))
+    bins = []
+    # free space of the discs, ascending, and the disc of each entry
+    (free, free_bins) = ([], [])
+
+    def place(position, indices, size):
+        if position == len(free):
+            bins.append(list(indices))
+            (remaining, number) = (capacity - size, len(bins) - 1)
+        else:
+            number = free_bins.pop(position)
+            remaining = free.pop(position) - size
+            bins[number].extend(indices)
+        position = bisect_left(free, remaining)
+        free.insert(position, remaining)
+        free_bins.insert(position, number)
+
+    split = []
+    for (size, _, group) in sized:
+        position = bisect_left(free, size)
+        if position == len(free) and limit is not None and len(bins) >= limit:
+            split.extend(group)
+        else:
+            place(position, group, size)
+    for index in sorted(split, key=lambda index: -sizes[index]):
+        place(bisect_left(free, sizes[index]), (index, ), sizes[index])
+    return bins
@@ -1,59 +1,256 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
 from os import listdir
 from pathlib import Path, PureWindowsPath
 import shutil
 import re
+import threading
+from time import perf_counter
 
 from tinytag import TinyTag
 
+from .tag_index import TrackTags
+
 
 __SUPPORTED_PLAYLIST_EXTENSIONS = ['.m3u', '.m3u8']
 
 
+class ScanStats(object):
+    """
+      Tag scanning of a playlist: time taken by the pass computing its
+      aggregates and, with a TagIndex, how many tracks were found in it.
+    """
+
+    def __init__(self):
+        self.tracks = 0
+        self.seconds = 0.0
+        self.index_hits = 0
+        self.index_misses = 0
+
+    def hit_rate(self):
+        lookups = self.index_hits + self.index_misses
+        return self.index_hits / float(lookups) if lookups else 0.0
+
+    def __repr__(self):
+        return '<ScanStats tracks=%d seconds=%.3f index_hits=%d index_misses=%d ' \
+               'hit_rate=%.2f>' % (self.tracks, self.seconds, self.index_hits,
+                                   self.index_misses, self.hit_rate())
+
+
 class Playlist(object):
-    def __init__(self, music_path, supported_extensions, playlist_path):
+    """
+      M3U playlist. The file is read line by line whenever it is iterated
+      and tracks read their tags only when needed, so very large playlists
+      are never held in memory, only their tags. Each file's tags are read
+      at most once per Playlist, however often it is iterated. Aggregates
+      (count, duration, artists) are computed in a single pass on first
+      use. #EXTINF durations are taken instead of the track's own.
+
+      music_path (str)
+        Root the playlist entries are relative to.
+      supported_extensions (list)
+        Track file extensions to pick from the playlist.
+      playlist_path (str)
+        M3U playlist file.
+      max_workers (int)
+        Number of track tags read ahead of the iteration at the same time,
+        which hides the latency of network mounts.
+      tag_index (TagIndex)
+        Optional index tags are taken from for files that did not change,
+        and stored to.
+    """
+
+    def __init__(self, music_path, supported_extensions, playlist_path,
+                 max_workers=8, tag_index=None):
         self.__playlist_path = Path(playlist_path)
         self.__music_path = Path(music_path)
         self.__path_regex = re.compile(
             '(.*\\.(%s))' % '|'.join(supported_extensions),
             flags=re.IGNORECASE
         )
+        self.__extinf_regex = re.compile('#EXTINF:\\s*(-?[0-9.]+)')
+        self.max_workers = max_workers
 
-        track_paths = self.__parse_file_paths()
-        self.__tracks = [Track(track_path) for track_path in track_paths]
+        self.__tag_index = tag_index
+        self.scan_stats = ScanStats()
+        self.__stats_lock = threading.Lock()
+        # tags read by earlier passes, by track path
+        self.__tags = {}
+        self.__tags_lock = threading.Lock()
+        self.__count = None
+        self.__duration = None
+        self.__artists = None
 
-    def __parse_file_paths(self):
+    def __entries(self):
+        """
+          Yields (track path, #EXTINF duration or None) for every track of
+          the playlist file.
+        """
+        duration = None
         with self.__playlist_path.open() as file:
-            contents = file.read()
-            track_paths = [self.__create_path(match[0]) for match in self.__path_regex.findall(contents)]
-            return [self.__music_path.joinpath(*track_path.parts[1:]) for track_path in track_paths]
+            for line in file:
+                line = line.strip()
+                if line.startswith('#'):
+                    match = self.__extinf_regex.match(line)
+                    if match is not None:
+                        duration = _parse_duration(match.group(1))
+                    continue
+                match = self.__path_regex.search(line)
+                if match is None:
+                    continue
+                track_path = self.__create_path(match.group(1))
+                yield (self.__music_path.joinpath(*track_path.parts[1:]), duration)
+                duration = None
 
     def __create_path(self, path):
         return PureWindowsPath(path)
 
+    def __read_tags(self, track_path):
+        with self.__tags_lock:
+            tags = self.__tags.get(track_path)
+        if tags is None:
+            tags = self.__read_file_tags(track_path)
+            with self.__tags_lock:
+                self.__tags[track_path] = tags
+        return tags
+
+    def __read_file_tags(self, track_path):
+        if self.__tag_index is None:
+            return read_tags(track_path)
+        stat = os.stat(track_path)
+        tags = self.__tag_index.lookup(track_path, stat)
+        with self.__stats_lock:
+            if tags is None:
+                self.scan_stats.index_misses += 1
+            else:
+                self.scan_stats.index_hits += 1
+        if tags is None:
+            tags = read_tags(track_path)
+            self.__tag_index.store(track_path, stat, tags)
+        return tags
+
     def count(self):
-        return len(self.__tracks)
+        if self.__count is None:
+            self.__count = sum(1 for _ in self.__entries())
+        return self.__count
 
     def title(self):
         return self.__playlist_path.stem
 
     def duration(self):
-        return sum([track.duration for track in self.__tracks])
+        if self.__duration is None:
+            # no need to open any track when #EXTINF has all durations
+            total = 0.0
+            for (_, duration) in self.__entries():
+                if duration is None:
+                    self.__aggregate()
+                    break
+                total += duration
+            else:
+                self.__duration = total
+        return self.__duration
 
     def is_single_artist(self):
-        return len(set([track.artist for track in self.__tracks])) == 1
+        if self.__artists is None:
+            self.__aggregate()
+        return len(self.__artists) == 1
+
+    def __aggregate(self):
+        started = perf_counter()
+        (count, duration, artists) = (0, 0.0, set())
+        for track in self:
+            count += 1
+            duration += track.duration
+            artists.add(track.artist)
+        (self.__count, self.__duration, self.__artists) = (count, duration, artists)
+        self.scan_stats.tracks = count
+        self.scan_stats.seconds += perf_counter() - started
 
     def __iter__(self):
-        for track in self.__tracks:
-            yield track
+        """
+          Yields the Tracks, with the tags of up to max_workers upcoming
+          tracks read in the background.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = deque()
+            try:
+                for (track_path, duration) in self.__entries():
+                    track = Track(track_path, duration=duration, tag_reader=self.__read_tags)
+                    pending.append((track, executor.submit(track.load_tags)))
+                    if len(pending) > self.max_workers:
+                        yield self.__loaded(pending.popleft())
+                while pending:
+                    yield self.__loaded(pending.popleft())
+            finally:
+                for (_, future) in pending:
+                    future.cancel()
+
+    def __loaded(self, pending_track):
+        (track, future) = pending_track
+        future.result()
+        return track
 
 
 class Track(object):
-    def __init__(self, path):
+    """
+      A playlist entry. Its tags are read from the file on first access.
+    """
+
+    def __init__(self, path, tags=None, duration=None, tag_reader=None):
+        """
+          tags (TrackTags)
+            Known tags of the file, read from it when None.
+          duration (float)
+            Known duration, e.g. from #EXTINF, taking precedence over the
+            tags.
+          tag_reader (callable)
+            Function returning the TrackTags of a path, read_tags by
+            default.
+        """
         self.path = path
-        tag = TinyTag.get(path)
-        self.title = tag.title
-        self.artist = tag.artist
-        self.duration = tag.duration
+        self.__tags = tags
+        self.__duration = duration
+        self.__tag_reader = tag_reader if tag_reader is not None else read_tags
+
+    def load_tags(self):
+        if self.__tags is None:
+            self.__tags = self.__tag_reader(self.path)
+        return self.__tags
+
+    @property
+    def title(self):
+        return self.load_tags().title
+
+    @property
+    def artist(self):
+        return self.load_tags().artist
+
+    @property
+    def album(self):
+        return self.load_tags().album
+
+    @property
+    def duration(self):
+        if self.__duration is not None:
+            return self.__duration
+        return self.load_tags().duration
+
+
+def read_tags(path):
+    tag = TinyTag.get(path)
+    return TrackTags(tag.title, tag.artist, tag.duration, tag.album)
+
+
+def _parse_duration(value):
+    """
+      #EXTINF duration in seconds, None when unknown (-1) or malformed.
+    """
+    try:
+        duration = float(value)
+    except ValueError:
+        return None
+    return duration if duration >= 0 else None
 
 
 def find_next_playlist_path_name(playlist_directory_path_name):
@@ -0,0 +1,74 @@
+"""Track metadata index
+
+Persists the tags read from music files in SQLite, keyed by path and checked
+against the file size and modification time, so later playlists referring to
+the same files do not open them again.
+"""
+
+from collections import namedtuple
+import os
+import sqlite3
+import threading
+
+
+TrackTags = namedtuple('TrackTags', ['title', 'artist', 'duration', 'album'])
+
+
+class TagIndex(object):
+    """
+      filename (str)
+        SQLite database holding the index, created if missing.
+    """
+
+    __COLUMNS = ('path', 'size', 'mtime_ns') + TrackTags._fields
+    __SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS tags (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            title TEXT,
+            artist TEXT,
+            duration REAL,
+            album TEXT
+        )
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.__lock = threading.Lock()
+        # shared by the tag scanning threads, serialised by the lock
+        self.__connection = sqlite3.connect(filename, check_same_thread=False)
+        with self.__connection:
+            columns = [row[1] for row in self.__connection.execute('PRAGMA table_info(tags)')]
+            if columns and columns != list(TagIndex.__COLUMNS):
+                # an index of an older layout, it is only a cache
+                self.__connection.execute('DROP TABLE tags')
+            self.__connection.execute(TagIndex.__SCHEMA)
+
+    def lookup(self, path, stat):
+        """
+          Returns the TrackTags stored for path, or None when there are none
+          or the file changed since, according to stat (os.stat_result).
+        """
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT size, mtime_ns, title, artist, duration, album FROM tags WHERE path = ?',
+                (os.path.abspath(path), )).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+        return TrackTags(*row[2:])
+
+    def store(self, path, stat, tags):
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (os.path.abspath(path), stat.st_size, stat.st_mtime_ns) + tuple(tags))
+
+    def close(self):
+        self.__connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
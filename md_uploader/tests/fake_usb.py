@@ -0,0 +1,126 @@
+"""Fake USB device handle
+
+Stands in for usb1.USBDeviceHandle in tests and benchmarks. Bulk writes, both
+synchronous and through asynchronous transfers, complete after a fixed setup
+latency plus the time their payload takes at the configured bandwidth.
+Queued transfers are serviced back to back, so only synchronous writes pay the
+latency for every transfer.
+"""
+
+import heapq
+import time
+
+import usb1
+
+
+class FakeTransfer(object):
+    def __init__(self, handle):
+        self.handle = handle
+        self.submitted = False
+        self.cancelled = False
+        self.status = None
+        self.actual_length = 0
+
+    def setBulk(self, endpoint, buffer, callback=None, user_data=None, timeout=0):
+        self.buffer = buffer
+        self.callback = callback
+        self.user_data = user_data
+
+    def submit(self):
+        self.submitted = True
+        self.cancelled = False
+        self.handle.schedule(self)
+
+    def cancel(self):
+        if not self.submitted:
+            raise usb1.USBErrorNotFound
+        # completes with TRANSFER_CANCELLED on the next handle_events
+        self.cancelled = True
+
+    def getStatus(self):
+        return self.status
+
+    def getActualLength(self):
+        return self.actual_length
+
+    def getUserData(self):
+        return self.user_data
+
+
+class FakeBulkHandle(object):
+    """
+      Simulates a device with a bulk OUT endpoint.
+      latency (float)
+        Per-transfer turnaround in seconds.
+      bandwidth (float)
+        Bus speed in bytes per second, None for unlimited.
+      fail_transfer (int)
+        Number, from 1, of the asynchronous transfer that completes with
+        an error instead of its data. Cancelled transfers write nothing.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, fail_transfer=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fail_transfer = fail_transfer
+        self.bytes = 0
+        self.data = bytearray()
+        self.__bus_free_at = 0.0
+        self.__pending = []
+        self.__sequence = 0
+
+    def setConfiguration(self, configuration):
+        pass
+
+    def claimInterface(self, interface):
+        pass
+
+    def releaseInterface(self, interface):
+        pass
+
+    def resetDevice(self):
+        pass
+
+    def controlRead(self, request_type, request, value, index, length):
+        # no reply pending
+        return bytes(length)
+
+    def getTransfer(self):
+        return FakeTransfer(self)
+
+    def bulkWrite(self, endpoint, data):
+        time.sleep(self.latency + self.__transfer_time(len(data)))
+        self.bytes += len(data)
+        self.data += data
+        return len(data)
+
+    def schedule(self, transfer):
+        started = max(time.perf_counter() + self.latency, self.__bus_free_at)
+        self.__bus_free_at = started + self.__transfer_time(len(transfer.buffer))
+        self.__sequence += 1
+        heapq.heappush(self.__pending, (self.__bus_free_at, self.__sequence, transfer))
+
+    def handle_events(self):
+        """
+          Block until the next transfer completes and run its callback.
+        """
+        (completes_at, sequence, transfer) = heapq.heappop(self.__pending)
+        delay = completes_at - time.perf_counter()
+        if delay > 0 and not transfer.cancelled:
+            time.sleep(delay)
+        transfer.submitted = False
+        if transfer.cancelled:
+            transfer.status = usb1.TRANSFER_CANCELLED
+            transfer.actual_length = 0
+        elif sequence == self.fail_transfer:
+            transfer.status = usb1.TRANSFER_ERROR
+            transfer.actual_length = 0
+        else:
+            transfer.status = usb1.TRANSFER_COMPLETED
+            transfer.actual_length = len(transfer.buffer)
+            self.data += transfer.buffer
+        self.bytes += transfer.actual_length
+        transfer.callback(transfer)
+
+    def __transfer_time(self, size):
+        return size / self.bandwidth if self.bandwidth else 0.0
@@ -0,0 +1,147 @@
+"""Asynchronous bulk writes against a fake USB handle"""
+
+import os
+
+import pytest
+
+from netmd.bulk_transfer import AsyncBulkWriter
+from netmd.exception import NetMDException
+from tests.fake_usb import FakeBulkHandle
+
+try:
+    from netmd.usb_device import NetMDUSB
+except OSError:
+    # libusb itself is not installed
+    NetMDUSB = None
+
+requires_libusb = pytest.mark.skipif(NetMDUSB is None, reason='libusb is not installed')
+
+
+def create_writer(handle, transfer_count=4, transfer_size=1024):
+    return AsyncBulkWriter(handle, 0x02, handle.handle_events, transfer_count, transfer_size)
+
+
+def test_writes_arrive_in_order():
+    handle = FakeBulkHandle(latency=0.001)
+    writer = create_writer(handle)
+    writes = [os.urandom(size) for size in (10000, 24, 4096, 1)]
+
+    for data in writes:
+        writer.write(data)
+    writer.flush()
+
+    assert bytes(handle.data) == b''.join(writes)
+    assert writer.stats.bytes == sum(len(data) for data in writes)
+    assert writer.stats.transfers == 10 + 1 + 4 + 1
+    assert writer.stats.max_in_flight == 4
+
+
+def test_data_is_copied_on_write():
+    handle = FakeBulkHandle()
+    writer = create_writer(handle)
+    data = bytearray(b'a' * 2048)
+
+    writer.write(data)
+    data[:] = b'b' * 2048
+    writer.flush()
+
+    assert bytes(handle.data) == b'a' * 2048
+
+
+def test_failed_transfer_raises():
+    handle = FakeBulkHandle(fail_transfer=2)
+    writer = create_writer(handle)
+
+    writer.write(bytes(3000))
+    with pytest.raises(NetMDException):
+        writer.flush()
+
+
+def test_failed_transfer_cancels_the_rest():
+    handle = FakeBulkHandle(fail_transfer=2)
+    writer = create_writer(handle)
+    data = os.urandom(4096)
+
+    writer.write(data)
+    with pytest.raises(NetMDException):
+        writer.flush()
+
+    # nothing after the gap reaches the device
+    assert bytes(handle.data) == data[:1024]
+    assert writer.stats.bytes == 1024
+
+
+@pytest.mark.parametrize('transfer_count, transfer_size', [(0, 1024), (4, 0), (4, 1000)])
+def test_invalid_sizes(transfer_count, transfer_size):
+    with pytest.raises(ValueError):
+        create_writer(FakeBulkHandle(), transfer_count, transfer_size)
+
+
+@requires_libusb
+def test_net_md_usb_async_writes():
+    handle = FakeBulkHandle()
+    net_md_usb = NetMDUSB(handle)
+    data = os.urandom(5000)
+
+    net_md_usb.enableAsyncWrites(transfer_count=2, transfer_size=1024,
+                                 handle_events=handle.handle_events)
+    net_md_usb.writeBulk(data)
+    net_md_usb.flushBulk()
+    net_md_usb.disableAsyncWrites()
+    net_md_usb.writeBulk(data)
+
+    assert bytes(handle.data) == data + data
+    assert net_md_usb.bulk_writer is None
+
+
+@requires_libusb
+def test_failed_async_write_disables_async_writes():
+    handle = FakeBulkHandle(fail_transfer=1)
+    net_md_usb = NetMDUSB(handle)
+
+    net_md_usb.enableAsyncWrites(handle_events=handle.handle_events)
+    net_md_usb.writeBulk(bytes(1024))
+    with pytest.raises(NetMDException):
+        net_md_usb.disableAsyncWrites()
+    assert net_md_usb.bulk_writer is None
+
+
+class ReplyingHandle(FakeBulkHandle):
+    """
+      Has a reply ready as soon as it is polled for.
+    """
+
+    def controlWrite(self, request_type, request, value, index, data):
+        pass
+
+    def controlRead(self, request_type, request, value, index, length):
+        return bytes((0, 0, 4, 0))
+
+
+@requires_libusb
+@pytest.mark.parametrize('async_writes', [False, True])
+def test_reply_after_bulk_data_timed_apart(async_writes):
+    handle = ReplyingHandle(bandwidth=1e6)
+    net_md_usb = NetMDUSB(handle)
+    if async_writes:
+        net_md_usb.enableAsyncWrites(handle_events=handle.handle_events)
+    send_track = bytes.fromhex('001800080046f003010328ff000100')
+
+    net_md_usb.sendCommand(send_track)
+    net_md_usb.readReply()
+    net_md_usb.writeBulk(bytes(50000))
+    net_md_usb.readReply()
+
+    commands = net_md_usb.reply_latency.commands
+    assert sorted(commands) == ['1800:28', '1800:28:done']
+    # counted from the end of the 50 ms transfer
+    assert commands['1800:28:done']['max'] < 0.025
+
+
+@requires_libusb
+def test_async_writes_need_event_handling():
+    net_md_usb = NetMDUSB(FakeBulkHandle())
+
+    with pytest.raises(ValueError):
+        net_md_usb.enableAsyncWrites()
+    assert net_md_usb.bulk_writer is None
@@ -0,0 +1,45 @@
+"""Transcode cache"""
+
+import os
+import time
+
+from transcode import TranscodeCache
+from transcode.cache import STALE_TEMP_AGE
+
+
+def write(filename, data=b''):
+    with open(filename, 'wb') as file:
+        file.write(data)
+
+
+def test_hit_after_miss(tmpdir):
+    source = os.path.join(str(tmpdir), 'track.flac')
+    write(source, b'flac')
+    cache = TranscodeCache(os.path.join(str(tmpdir), 'cache'), 1 << 20)
+    converted = []
+
+    def convert(output):
+        converted.append(output)
+        write(output, b'pcm')
+
+    for _ in range(2):
+        entry = cache.acquire(source, convert)
+        cache.release(entry)
+
+    assert len(converted) == 1
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+
+
+def test_only_stale_temp_files_removed(tmpdir):
+    directory = str(tmpdir)
+    stale = os.path.join(directory, '.tmp-stale')
+    running = os.path.join(directory, '.tmp-running')
+    write(stale)
+    write(running)
+    stale_time = time.time() - STALE_TEMP_AGE - 60
+    os.utime(stale, (stale_time, stale_time))
+
+    # another process converting into the same directory keeps its file
+    TranscodeCache(directory, 1 << 20)
+
+    assert sorted(os.listdir(directory)) == ['.tmp-running']
@@ -0,0 +1,182 @@
+"""Uploads through the NetMD emulator
+
+Covers the host side of the protocol end to end without hardware: the secure
+session, track data as the device decrypts it, titles and disc capacity.
+"""
+
+from array import array
+import os
+import wave
+
+import pytest
+
+from netmd.download import download_tracks
+from netmd.download import TEARDOWN_TIMEOUT
+from netmd.emulator import EmulatedNetMDUSB
+from netmd.exception import NetMDException
+from netmd.exception import NetMDTransferAborted
+from netmd.netmd_device import NetMD
+from netmd.polling import PollingStrategy
+from netmd.preflight import capacity_seconds
+from netmd.preflight import Preflight
+from transcode import TranscodeStream
+
+
+FRAME_SIZE = 2048  # bytes of a PCM frame
+FRAMES = 100
+
+
+@pytest.fixture
+def emulator():
+    return EmulatedNetMDUSB(keep_data=True)
+
+
+@pytest.fixture
+def net_md(emulator):
+    return NetMD(emulator)
+
+
+def write_pcm(directory, name, frames=FRAMES):
+    filename = os.path.join(str(directory), name)
+    with open(filename, 'wb') as file:
+        file.write(os.urandom(frames * FRAME_SIZE))
+    return filename
+
+
+def read(filename):
+    with open(filename, 'rb') as file:
+        return file.read()
+
+
+def test_upload_decrypts_to_the_source_pcm(tmpdir, net_md, emulator):
+    filenames = [write_pcm(tmpdir, '%d.pcm' % number) for number in range(3)]
+    tracks = [(filename, 'Track %d' % number) for (number, filename) in enumerate(filenames)]
+
+    results = list(download_tracks(net_md, tracks))
+
+    assert [track_number for (track_number, _, _) in results] == [0, 1, 2]
+    assert [bytes(track.data) for track in emulator.tracks] == [read(name) for name in filenames]
+    assert [track.frames for track in emulator.tracks] == [FRAMES] * 3
+
+
+def test_titles(tmpdir, net_md, emulator):
+    tracks = [(write_pcm(tmpdir, '%d.pcm' % number), title)
+              for (number, title) in enumerate(['First', 'Second'])]
+
+    net_md.set_disc_title('Disc')
+    list(download_tracks(net_md, tracks))
+
+    assert net_md.get_disc_title() == 'Disc'
+    assert [net_md.get_track_title(number) for number in range(2)] == ['First', 'Second']
+    assert net_md.get_track_count() == 2
+
+
+def test_titles_written_per_track(tmpdir, net_md, emulator):
+    tracks = [(write_pcm(tmpdir, 'track.pcm'), 'Only')]
+
+    list(download_tracks(net_md, tracks, defer_titles=False))
+
+    assert emulator.tracks[0].title == 'Only'
+
+
+def test_capacity(tmpdir, net_md, emulator):
+    (_, total, available) = [capacity_seconds(time) for time in net_md.get_disc_capacity()]
+    assert total == available == 80 * 60
+
+    list(download_tracks(net_md, [(write_pcm(tmpdir, 'track.pcm'), 'Track')]))
+
+    preflight = Preflight(net_md)
+    seconds = FRAMES * 512 / 44100.0
+    # the device reports times in whole 512 sample units
+    unit = 512 / 44100.0
+    assert preflight.capacity().recorded == pytest.approx(seconds, abs=unit)
+    assert preflight.capacity().available == pytest.approx(80 * 60 - seconds, abs=unit)
+    assert preflight.check([80 * 60 - seconds - unit], erase=False).fits
+    assert not preflight.check([80 * 60], erase=False).fits
+
+    net_md.erase_disc()
+    preflight.invalidate()
+    assert preflight.capacity().available == 80 * 60
+
+
+def test_stream_from_wav(tmpdir, net_md, emulator):
+    samples = array('h', os.urandom(FRAMES * FRAME_SIZE))
+    filename = os.path.join(str(tmpdir), 'track.wav')
+    with wave.open(filename, 'wb') as output:
+        output.setnchannels(2)
+        output.setsampwidth(2)
+        output.setframerate(44100)
+        output.writeframes(samples.tobytes())
+
+    def pcm_tracks():
+        with TranscodeStream(filename) as pcm:
+            yield (pcm, 'Streamed')
+
+    list(download_tracks(net_md, pcm_tracks()))
+
+    # WAV is little endian, the device gets big endian PCM
+    samples.byteswap()
+    assert bytes(emulator.tracks[0].data) == samples.tobytes()
+
+
+def test_session_left_when_titling_fails(tmpdir, net_md, emulator):
+    def set_track_title(*args, **kwargs):
+        raise NetMDException('Titling failed')
+    net_md.set_track_title = set_track_title
+
+    with pytest.raises(NetMDException):
+        list(download_tracks(net_md, [(write_pcm(tmpdir, 'track.pcm'), 'Track')]))
+
+    # the device only accepts leaving a secure session it is in
+    with pytest.raises(NetMDException):
+        net_md.leave_secure_session()
+
+
+def abort_second_track():
+    transfers = set()
+
+    def progress(transfer):
+        transfers.add(id(transfer))
+        if len(transfers) == 2:
+            raise NetMDTransferAborted('Aborted')
+    return progress
+
+
+def test_aborted_transfer_skips_titles(tmpdir, net_md, emulator):
+    # the second track takes two packets, the abort comes after the first
+    tracks = [(write_pcm(tmpdir, '0.pcm'), 'Track 0'),
+              (write_pcm(tmpdir, '1.pcm', frames=3000), 'Track 1')]
+
+    with pytest.raises(NetMDTransferAborted):
+        list(download_tracks(net_md, tracks, progress=abort_second_track()))
+
+    # the device is still waiting for track data, nothing is titled
+    assert [track.title for track in emulator.tracks] == ['']
+    with pytest.raises(NetMDException):
+        net_md.leave_secure_session()
+
+
+def test_teardown_error_keeps_original_error(tmpdir, net_md, emulator):
+    def leave_secure_session():
+        raise OSError('Device gone')
+    net_md.leave_secure_session = leave_secure_session
+    tracks = [(write_pcm(tmpdir, '%d.pcm' % number), 'Track %d' % number) for number in range(2)]
+
+    with pytest.raises(NetMDTransferAborted):
+        list(download_tracks(net_md, tracks, progress=abort_second_track()))
+
+
+def test_teardown_waits_for_replies_a_bounded_time(tmpdir, net_md, emulator):
+    emulator.polling = PollingStrategy()
+    timeouts = []
+    leave_secure_session = net_md.leave_secure_session
+
+    def recording_leave_secure_session():
+        timeouts.append(emulator.polling.timeout)
+        leave_secure_session()
+    net_md.leave_secure_session = recording_leave_secure_session
+
+    list(download_tracks(net_md, [(write_pcm(tmpdir, 'track.pcm'), 'Track')]))
+
+    assert timeouts == [TEARDOWN_TIMEOUT]
+    assert emulator.polling.timeout is None
@@ -0,0 +1,68 @@
+"""In-process conversion of 16-bit WAV"""
+
+from array import array
+import io
+import os
+import wave
+
+import pytest
+
+from transcode.native import NativePcmReader
+from transcode.source_info import read_source_info
+
+
+class OddReads(io.FileIO):
+    """
+      File returning at most three bytes per read, as a pipe or network file
+      system may return any count.
+    """
+
+    def read(self, size=-1):
+        return super().read(min(size, 3))
+
+    def readinto(self, buffer):
+        return super().readinto(memoryview(buffer)[:3])
+
+
+@pytest.fixture
+def wav(tmpdir):
+    samples = array('h', os.urandom(4000))
+    filename = os.path.join(str(tmpdir), 'track.wav')
+    with wave.open(filename, 'wb') as output:
+        output.setnchannels(2)
+        output.setsampwidth(2)
+        output.setframerate(44100)
+        output.writeframes(samples.tobytes())
+    # s16be, as the device gets it
+    samples.byteswap()
+    return (filename, samples.tobytes())
+
+
+def open_reader(filename):
+    info = read_source_info(filename)
+    reader = NativePcmReader(filename, info)
+    reader.file.close()
+    reader.file = OddReads(filename)
+    reader.file.seek(info.data_offset)
+    return reader
+
+
+def test_read_keeps_samples_aligned(wav):
+    (filename, expected) = wav
+    data = b''
+    with open_reader(filename) as reader:
+        for chunk in iter(lambda: reader.read(100), b''):
+            data += chunk
+
+    assert data == expected
+
+
+def test_readinto_keeps_samples_aligned(wav):
+    (filename, expected) = wav
+    data = b''
+    buffer = bytearray(100)
+    with open_reader(filename) as reader:
+        for count in iter(lambda: reader.readinto(buffer), 0):
+            data += buffer[:count]
+
+    assert data == expected
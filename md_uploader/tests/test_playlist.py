@@ -0,0 +1,54 @@
+"""Playlist parsing and tag reading"""
+
+import os
+import wave
+
+from playlist import playlist as playlist_module
+from playlist import Playlist
+
+
+def write_playlist(directory, names, extinf=False):
+    music_path = os.path.join(str(directory), 'music')
+    os.mkdir(music_path)
+    lines = []
+    for name in names:
+        with wave.open(os.path.join(music_path, name), 'wb') as output:
+            output.setnchannels(2)
+            output.setsampwidth(2)
+            output.setframerate(44100)
+            output.writeframes(bytes(44100 * 4))
+        if extinf:
+            lines.append('#EXTINF:1.000,%s' % name)
+        lines.append('X:\\%s' % name)
+    playlist_path = os.path.join(str(directory), 'playlist.m3u')
+    with open(playlist_path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    return (music_path, playlist_path)
+
+
+def test_tags_read_once_per_file(tmpdir, monkeypatch):
+    names = ['%02d.wav' % number for number in range(4)]
+    (music_path, playlist_path) = write_playlist(tmpdir, names)
+    read = []
+    read_tags = playlist_module.read_tags
+    monkeypatch.setattr(playlist_module, 'read_tags',
+                        lambda path: read.append(path) or read_tags(path))
+
+    playlist = Playlist(music_path, ['wav'], playlist_path)
+    # the passes of a typical upload: totals, preflight, upload
+    assert playlist.duration() == 4.0
+    assert [track.duration for track in playlist] == [1.0] * 4
+    assert [track.path.name for track in playlist] == names
+    assert playlist.is_single_artist()
+
+    assert sorted(os.path.basename(str(path)) for path in read) == names
+
+
+def test_extinf_durations_need_no_tags(tmpdir, monkeypatch):
+    (music_path, playlist_path) = write_playlist(tmpdir, ['a.wav', 'b.wav'], extinf=True)
+    monkeypatch.setattr(playlist_module, 'read_tags', None)
+
+    playlist = Playlist(music_path, ['wav'], playlist_path)
+
+    assert playlist.count() == 2
+    assert playlist.duration() == 2.0
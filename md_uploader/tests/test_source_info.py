@@ -0,0 +1,46 @@
+"""Stream parameters read from audio file headers"""
+
+import os
+import struct
+import wave
+
+import pytest
+
+from transcode.source_info import read_source_info
+
+
+def write_wav(directory, frames=1000):
+    filename = os.path.join(str(directory), 'track.wav')
+    with wave.open(filename, 'wb') as output:
+        output.setnchannels(2)
+        output.setsampwidth(2)
+        output.setframerate(44100)
+        output.writeframes(bytes(frames * 4))
+    return filename
+
+
+def patch_header(filename, offset, format, value):
+    with open(filename, 'r+b') as file:
+        file.seek(offset)
+        file.write(struct.pack(format, value))
+
+
+def test_wav(tmpdir):
+    info = read_source_info(write_wav(tmpdir))
+
+    assert (info.format, info.sample_rate, info.channels, info.bits_per_sample) == \
+        ('wav', 44100, 2, 16)
+    assert (info.total_samples, info.encoding, info.data_offset, info.data_size) == \
+        (1000, 'pcm_le', 44, 4000)
+
+
+@pytest.mark.parametrize('offset, format, value', [
+    (40, '<I', 0xffffffff),     # data size of a streamed WAV
+    (40, '<I', 4001),           # more data than the file holds
+    (32, '<H', 0),              # block align
+])
+def test_wav_bad_header(tmpdir, offset, format, value):
+    filename = write_wav(tmpdir)
+    patch_header(filename, offset, format, value)
+
+    assert read_source_info(filename) is None
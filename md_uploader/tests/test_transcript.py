@@ -0,0 +1,25 @@
+"""Recording NetMD traffic"""
+
+import os
+
+from netmd.download import download_tracks
+from netmd.emulator import EmulatedNetMDUSB
+from netmd.metrics import MetricsRegistry
+from netmd.netmd_device import NetMD
+from netmd.transcript import read_transcript
+from netmd.transcript import RecordingNetMDUSB
+
+
+def test_recording_keeps_device_metrics(tmpdir):
+    track = os.path.join(str(tmpdir), 'track.pcm')
+    with open(track, 'wb') as file:
+        file.write(os.urandom(100 * 2048))
+    emulator = EmulatedNetMDUSB()
+    metrics = MetricsRegistry()
+
+    with RecordingNetMDUSB(emulator, os.path.join(str(tmpdir), 'trace')) as recording:
+        list(download_tracks(NetMD(recording, metrics=metrics), [(track, 'Track')]))
+
+    assert emulator.metrics is metrics
+    assert metrics.bulk['bytes'] == emulator.bulk_bytes > 0
+    assert read_transcript(recording.file.name)
@@ -1 +1,3 @@
-from .transcode import Transcode
\ No newline at end of file
+from .cache import TranscodeCache
+from .scheduler import TranscodeScheduler
+from .transcode import Transcode, TranscodeError, TranscodeStream
\ No newline at end of file
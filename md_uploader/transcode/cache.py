@@ -0,0 +1,159 @@
+"""Transcode cache
+
+Keeps s16be PCM produced by ffmpeg on disk, keyed by the identity of the
+source file, so re-burning the same tracks skips transcoding. Entries are
+evicted least recently used first once the cache exceeds its byte budget.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+
+# temporary files older than this, in seconds, are taken for leftovers of a
+# crashed conversion; younger ones may belong to another process using the
+# same directory
+STALE_TEMP_AGE = 60 * 60
+
+
+class CacheStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.0
+
+    def __repr__(self):
+        return '<CacheStats hits=%d misses=%d hit_rate=%.2f evictions=%d ' \
+               'evicted_bytes=%d>' % (self.hits, self.misses, self.hit_rate(),
+                                      self.evictions, self.evicted_bytes)
+
+
+class TranscodeCache(object):
+    """
+      directory (str)
+        Where cache entries live. Created if missing.
+      max_bytes (int)
+        Total size the cache is trimmed to after each new entry.
+      hash_content (bool)
+        Include a hash of the source contents in the key, on top of path,
+        size and modification time. Safer, but reads every source fully.
+    """
+
+    __ENTRY_SUFFIX = '.pcm'
+    __TEMP_PREFIX = '.tmp-'
+    __HASH_CHUNK_SIZE = 1 << 20
+
+    def __init__(self, directory, max_bytes, hash_content=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hash_content = hash_content
+        self.stats = CacheStats()
+        self.__lock = threading.Lock()
+        self.__pinned = {}
+        os.makedirs(directory, exist_ok=True)
+        # leftovers of conversions interrupted by a crash
+        stale_before = time.time() - STALE_TEMP_AGE
+        for name in os.listdir(directory):
+            if not name.startswith(TranscodeCache.__TEMP_PREFIX):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                if os.stat(path).st_mtime < stale_before:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def key(self, track_filename):
+        """
+          Cache key of a source file.
+        """
+        path = os.path.abspath(track_filename)
+        stat = os.stat(path)
+        digest = hashlib.sha256(('%s\0%d\0%d' % (path, stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+        if self.hash_content:
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(TranscodeCache.__HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def acquire(self, track_filename, convert):
+        """
+          Returns the path of the cached PCM for track_filename, creating it
+          with convert(output_path) on a miss. The entry is protected from
+          eviction until release is called with the returned path.
+        """
+        key = self.key(track_filename)
+        entry_path = self.__entry_path(key)
+        with self.__lock:
+            self.__pin(entry_path)
+            hit = os.path.exists(entry_path)
+            if hit:
+                self.stats.hits += 1
+            else:
+                self.stats.misses += 1
+        if hit:
+            # modification time doubles as last use for LRU eviction
+            os.utime(entry_path)
+            return entry_path
+
+        try:
+            (fd, temp_path) = tempfile.mkstemp(prefix=TranscodeCache.__TEMP_PREFIX,
+                                               dir=self.directory)
+            os.close(fd)
+            try:
+                convert(temp_path)
+                os.replace(temp_path, entry_path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+        except BaseException:
+            self.release(entry_path)
+            raise
+        self.evict()
+        return entry_path
+
+    def release(self, entry_path):
+        with self.__lock:
+            self.__pinned[entry_path] -= 1
+            if not self.__pinned[entry_path]:
+                del self.__pinned[entry_path]
+
+    def evict(self):
+        """
+          Remove least recently used entries until the cache fits max_bytes.
+          Entries in use are kept.
+        """
+        with self.__lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(TranscodeCache.__ENTRY_SUFFIX):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+            total = sum(size for (_, size, _) in entries)
+            for (_, size, path) in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path in self.__pinned:
+                    continue
+                os.remove(path)
+                total -= size
+                self.stats.evictions += 1
+                self.stats.evicted_bytes += size
+
+    def __entry_path(self, key):
+        return os.path.join(self.directory, key + TranscodeCache.__ENTRY_SUFFIX)
+
+    def __pin(self, entry_path):
+        self.__pinned[entry_path] = self.__pinned.get(entry_path, 0) + 1
@@ -0,0 +1,121 @@
+"""In-process PCM conversion
+
+16-bit integer WAV and AIFF sources only need their samples byte-swapped (or
+copied as is) to become the s16be PCM Transcode produces, which is much
+cheaper than starting ffmpeg. Anything else is left to ffmpeg.
+"""
+
+from array import array
+import mmap
+
+from .source_info import read_source_info
+
+
+CHUNK_SIZE = 4 << 20
+
+
+def is_native_supported(info):
+    """
+      Whether a source described by info can be converted without ffmpeg.
+    """
+    return info is not None and info.bits_per_sample == 16 and \
+        info.encoding in ('pcm_le', 'pcm_be') and info.data_offset is not None
+
+
+class NativePcmReader(object):
+    """
+      File-like object reading s16be PCM from a 16-bit WAV or AIFF file.
+    """
+
+    def __init__(self, track_filename, info):
+        self.info = info
+        self.file = open(track_filename, 'rb')
+        self.file.seek(info.data_offset)
+        # a truncated last sample is dropped
+        self.remaining = min(info.data_size, info.total_samples * info.channels * 2)
+        self.remaining -= self.remaining % 2
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        size -= size % 2
+        data = self.file.read(size)
+        if len(data) % 2:
+            data = data[:-1]
+            self.__unread_odd_byte()
+        self.remaining -= len(data)
+        if self.info.encoding == 'pcm_le':
+            samples = array('h')
+            samples.frombytes(data)
+            samples.byteswap()
+            return samples.tobytes()
+        return data
+
+    def readinto(self, buffer):
+        buffer = memoryview(buffer).cast('B')
+        size = min(len(buffer), self.remaining)
+        size -= size % 2
+        count = self.file.readinto(buffer[:size])
+        if count % 2:
+            count -= 1
+            self.__unread_odd_byte()
+        self.remaining -= count
+        if self.info.encoding == 'pcm_le' and count:
+            samples = buffer[:count].cast('H')
+            # memoryview cannot byteswap: swap a copy and write it back
+            swapped = array('H', samples)
+            swapped.byteswap()
+            samples[:] = swapped
+        return count
+
+    def close(self):
+        self.file.close()
+
+    def __unread_odd_byte(self):
+        # half a sample, it is read again with the other half
+        self.file.seek(-1, 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def convert_native(track_filename, filename_out):
+    """
+      Write s16be PCM for track_filename into filename_out without ffmpeg.
+      Returns False, without writing anything, for unsupported sources.
+    """
+    info = read_source_info(track_filename)
+    if not is_native_supported(info):
+        return False
+
+    size = min(info.data_size, info.total_samples * info.channels * 2)
+    size -= size % 2
+    with open(track_filename, 'rb') as source, open(filename_out, 'wb') as output:
+        if info.encoding == 'pcm_be' or not size:
+            source.seek(info.data_offset)
+            _copy_range(source, output, size)
+            return True
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                samples = array('h')
+                for offset in range(info.data_offset, info.data_offset + size, CHUNK_SIZE):
+                    end = min(offset + CHUNK_SIZE, info.data_offset + size)
+                    del samples[:]
+                    samples.frombytes(view[offset:end])
+                    samples.byteswap()
+                    samples.tofile(output)
+            finally:
+                view.release()
+    return True
+
+
+def _copy_range(source, output, size):
+    while size > 0:
+        data = source.read(min(size, CHUNK_SIZE))
+        if not data:
+            break
+        output.write(data)
+        size -= len(data)
@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from .source_info import pcm_size
+from .source_info import read_source_info
+from .transcode import Transcode
+
+
+# rough PCM to file size ratio assumed for sources without a usable header
+UNKNOWN_SOURCE_EXPANSION = 10
+
+
+def estimate_pcm_size(track_filename):
+    """
+      Size of the PCM Transcode will produce, from the header when possible.
+    """
+    info = read_source_info(track_filename)
+    if info is not None:
+        return pcm_size(info)
+    return os.path.getsize(track_filename) * UNKNOWN_SOURCE_EXPANSION
+
+
+class TranscodeScheduler(object):
+    """
+      Converts upcoming tracks ahead of time on a thread pool so the next
+      track is ready as soon as the previous one is uploaded.
+
+      Iterating yields the PCM file name of each track, in order. A file is
+      removed once the iteration moves past it. On failure or early exit,
+      conversions that have not started are cancelled, running ffmpeg
+      processes are terminated and all produced files are removed.
+
+      track_filenames (iterable)
+        Source files to convert.
+      lookahead (int)
+        Number of tracks converted ahead of the one being consumed.
+      max_bytes (int)
+        Disk budget for converted PCM files. Tracks are only started when
+        their estimated size fits, except for the one needed next. None
+        means no limit.
+      cache (TranscodeCache)
+        Optional cache the conversions go through, see Transcode.
+    """
+
+    def __init__(self, track_filenames, lookahead=2, max_bytes=None, cache=None):
+        if lookahead < 0:
+            raise ValueError('lookahead must not be negative')
+        self.track_filenames = list(track_filenames)
+        self.lookahead = lookahead
+        self.max_bytes = max_bytes
+        self.cache = cache
+        self.reserved_bytes = 0
+        self.__executor = None
+        self.__scheduled = {}
+        self.__next_index = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __iter__(self):
+        self.__executor = ThreadPoolExecutor(max_workers=max(self.lookahead, 1))
+        try:
+            for index in range(len(self.track_filenames)):
+                self.__schedule(index)
+                (transcode, future, _) = self.__scheduled[index]
+                yield future.result()
+                self.__release(index)
+        finally:
+            self.close()
+
+    def close(self):
+        """
+          Cancel pending conversions, stop running ones and remove all
+          converted files.
+        """
+        for index in sorted(self.__scheduled):
+            (transcode, future, _) = self.__scheduled[index]
+            if not future.cancel() and not future.done():
+                transcode.terminate()
+        for index in sorted(self.__scheduled):
+            self.__release(index)
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True)
+            self.__executor = None
+
+    def __schedule(self, current):
+        last = min(current + self.lookahead, len(self.track_filenames) - 1)
+        while self.__next_index <= last:
+            index = self.__next_index
+            track_filename = self.track_filenames[index]
+            estimate = estimate_pcm_size(track_filename)
+            if index != current and self.max_bytes is not None and \
+                    self.reserved_bytes + estimate > self.max_bytes:
+                break
+            transcode = Transcode(track_filename, self.cache)
+            future = self.__executor.submit(transcode.__enter__)
+            self.__scheduled[index] = (transcode, future, estimate)
+            self.reserved_bytes += estimate
+            self.__next_index += 1
+
+    def __release(self, index):
+        (transcode, future, estimate) = self.__scheduled.pop(index)
+        self.reserved_bytes -= estimate
+        if future.cancelled() or future.exception() is not None:
+            # never ran or failed, at most the placeholder file is left
+            if transcode.cache is None and os.path.exists(transcode.transcoded_filename):
+                os.remove(transcode.transcoded_filename)
+        else:
+            transcode.__exit__(None, None, None)
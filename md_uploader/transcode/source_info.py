@@ -0,0 +1,159 @@
+"""Audio source inspection
+
+Reads stream parameters from WAV, AIFF and FLAC headers without decoding, so
+the size of the PCM that ffmpeg will produce is known before it starts.
+"""
+
+from collections import namedtuple
+import os
+import struct
+
+
+SourceInfo = namedtuple('SourceInfo', [
+    'format',           # 'wav', 'aiff' or 'flac'
+    'sample_rate',
+    'channels',
+    'bits_per_sample',
+    'total_samples',    # per channel
+    'encoding',         # 'pcm_le', 'pcm_be' for integer PCM, else a hint
+    'data_offset',      # start of the sample data in the file, if stored raw
+    'data_size',
+])
+
+PCM_SAMPLE_SIZE = 2  # Transcode produces s16be
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+
+
+def pcm_size(info):
+    """
+      Size in bytes of the s16be PCM produced from a source.
+    """
+    return info.total_samples * info.channels * PCM_SAMPLE_SIZE
+
+
+def read_source_info(path):
+    """
+      Returns the SourceInfo of a WAV, AIFF or FLAC file, or None when the
+      format is not recognised or the sample count is not recorded in the
+      header.
+    """
+    with open(path, 'rb') as file:
+        header = file.read(12)
+        if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+            return _read_wav_info(file)
+        if header[:4] == b'FORM' and header[8:12] in (b'AIFF', b'AIFC'):
+            return _read_aiff_info(file)
+        file.seek(0)
+        _skip_id3(file)
+        if file.read(4) == b'fLaC':
+            return _read_flac_info(file)
+    return None
+
+
+def _read_wav_info(file):
+    fmt = None
+    while True:
+        chunk_header = file.read(8)
+        if len(chunk_header) < 8:
+            return None
+        (chunk_id, chunk_size) = struct.unpack('<4sI', chunk_header)
+        if chunk_id == b'fmt ':
+            fmt_data = file.read(chunk_size + chunk_size % 2)
+            fmt = struct.unpack('<HHIIHH', fmt_data[:16])
+            format_tag = fmt[0]
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt_data) >= 26:
+                # the sub format GUID starts with the actual format tag
+                (format_tag, ) = struct.unpack('<H', fmt_data[24:26])
+            encoding = 'pcm_le' if format_tag == WAVE_FORMAT_PCM else 'other'
+        elif chunk_id == b'data':
+            if fmt is None:
+                return None
+            (_, channels, sample_rate, _, block_align, bits_per_sample) = fmt
+            data_offset = file.tell()
+            # streamed WAVs leave the size at 0xffffffff, only trust a size
+            # the file actually holds
+            if block_align == 0 or chunk_size > os.fstat(file.fileno()).st_size - data_offset:
+                return None
+            return SourceInfo('wav', sample_rate, channels, bits_per_sample,
+                              chunk_size // block_align, encoding,
+                              data_offset, chunk_size)
+        else:
+            # chunks are padded to an even size
+            file.seek(chunk_size + chunk_size % 2, 1)
+
+
+def _read_aiff_info(file):
+    comm = None
+    encoding = 'pcm_be'
+    while True:
+        chunk_header = file.read(8)
+        if len(chunk_header) < 8:
+            return None
+        (chunk_id, chunk_size) = struct.unpack('>4sI', chunk_header)
+        if chunk_id == b'COMM':
+            comm_data = file.read(chunk_size + chunk_size % 2)
+            comm = struct.unpack('>hIh', comm_data[:8])
+            sample_rate = _read_extended(comm_data[8:18])
+            if len(comm_data) >= 22:
+                # AIFF-C compression type
+                compression = comm_data[18:22]
+                if compression == b'sowt':
+                    encoding = 'pcm_le'
+                elif compression not in (b'NONE', b'twos'):
+                    encoding = 'other'
+        elif chunk_id == b'SSND':
+            if comm is None:
+                return None
+            (offset, _) = struct.unpack('>II', file.read(8))
+            (channels, total_samples, bits_per_sample) = comm
+            data_offset = file.tell() + offset
+            return SourceInfo('aiff', sample_rate, channels, bits_per_sample,
+                              total_samples, encoding, data_offset,
+                              total_samples * channels * ((bits_per_sample + 7) // 8))
+        else:
+            file.seek(chunk_size + chunk_size % 2, 1)
+
+
+def _read_extended(data):
+    """
+      80-bit IEEE 754 extended precision number, as used by AIFF.
+    """
+    (exponent, mantissa) = struct.unpack('>HQ', data)
+    sign = -1 if exponent & 0x8000 else 1
+    exponent &= 0x7fff
+    if exponent == 0 and mantissa == 0:
+        return 0
+    return int(sign * mantissa * 2.0 ** (exponent - 16383 - 63))
+
+
+def _skip_id3(file):
+    header = file.read(10)
+    if len(header) == 10 and header[:3] == b'ID3':
+        size = 0
+        for byte in header[6:10]:
+            size = (size << 7) | (byte & 0x7f)
+        file.seek(10 + size)
+    else:
+        file.seek(0)
+
+
+def _read_flac_info(file):
+    block_header = file.read(4)
+    if len(block_header) < 4 or block_header[0] & 0x7f != 0:
+        return None
+    streaminfo = file.read(34)
+    if len(streaminfo) < 34:
+        return None
+    # 20 bits sample rate, 3 bits channels - 1, 5 bits bits per sample - 1,
+    # 36 bits total samples
+    (packed, ) = struct.unpack('>Q', streaminfo[10:18])
+    sample_rate = packed >> 44
+    channels = ((packed >> 41) & 0x7) + 1
+    bits_per_sample = ((packed >> 36) & 0x1f) + 1
+    total_samples = packed & 0xfffffffff
+    if not total_samples:
+        return None
+    return SourceInfo('flac', sample_rate, channels, bits_per_sample,
+                      total_samples, 'flac', None, None)
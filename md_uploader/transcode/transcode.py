@@ -2,23 +2,186 @@ import os
 import subprocess
 import tempfile
 
+from .native import NativePcmReader
+from .native import convert_native
+from .native import is_native_supported
+from .source_info import pcm_size
+from .source_info import read_source_info
+
 
 DEV_NULL = open(os.devnull, 'w')
+# silence a PcmStream may be padded with before the track counts as failed:
+# a PCM frame, covering header and decoder rounding
+PADDING_TOLERANCE = 2048
+
+
+class TranscodeError(Exception):
+    """
+      ffmpeg failed to convert a track.
+    """
+    pass
 
 
 class Transcode(object):
-    def __init__(self, track_filename):
+    def __init__(self, track_filename, cache=None):
+        """
+          track_filename (str)
+            Source file to convert.
+          cache (TranscodeCache)
+            When given, the PCM comes from and is kept in the cache instead
+            of a temporary file.
+        """
         self.track_filename = track_filename
-        (_, filename_out) = tempfile.mkstemp()
-        self.transcoded_filename = filename_out
+        self.cache = cache
+        self.process = None
+        self.__terminated = False
+        if cache is None:
+            (fd, filename_out) = tempfile.mkstemp()
+            os.close(fd)
+            self.transcoded_filename = filename_out
+        else:
+            self.transcoded_filename = None
 
     def __enter__(self):
+        if self.cache is not None:
+            self.transcoded_filename = self.cache.acquire(self.track_filename, self.__convert)
+            return self.transcoded_filename
+
         try:
-            subprocess.call(['ffmpeg', '-y', '-i', self.track_filename, '-f', 's16be', self.transcoded_filename], stdout=DEV_NULL, stderr=DEV_NULL)
-        except subprocess.CalledProcessError as e:
-            filename_out = None
+            self.__convert(self.transcoded_filename)
+        except BaseException:
+            os.remove(self.transcoded_filename)
+            raise
 
         return self.transcoded_filename
 
     def __exit__(self, type, value, traceback):
-        os.remove(self.transcoded_filename)
+        if self.cache is not None:
+            self.cache.release(self.transcoded_filename)
+        else:
+            os.remove(self.transcoded_filename)
+
+    def terminate(self):
+        """
+          Stop a conversion running in another thread, whose __enter__ then
+          raises TranscodeError.
+        """
+        self.__terminated = True
+        if self.process is not None:
+            self.process.terminate()
+
+    def __convert(self, filename_out):
+        if convert_native(self.track_filename, filename_out):
+            return
+        self.process = subprocess.Popen(['ffmpeg', '-y', '-i', self.track_filename, '-f', 's16be', filename_out], stdout=DEV_NULL, stderr=DEV_NULL)
+        # terminate() may have run before the process existed
+        if self.__terminated:
+            self.process.terminate()
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise TranscodeError('ffmpeg failed on %s with exit code %d' % (
+                self.track_filename, returncode))
+
+
+class PcmStream(object):
+    """
+      s16be PCM read straight from ffmpeg's output, with the size known
+      before any data is produced.
+    """
+
+    def __init__(self, file, size):
+        self.file = file
+        self.size = size
+        self.bytes_read = 0
+        self.padding = 0
+
+    def read(self, size):
+        data = self.file.read(size)
+        self.bytes_read += len(data)
+        if len(data) < size:
+            # ffmpeg produced less than the header promised, the device
+            # still expects the announced number of frames; TranscodeStream
+            # fails the track when this is more than rounding
+            self.padding += size - len(data)
+            data += bytes(size - len(data))
+        return data
+
+    def readinto(self, buffer):
+        buffer = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(buffer):
+            count = self.file.readinto(buffer[filled:])
+            if not count:
+                # see read
+                self.padding += len(buffer) - filled
+                buffer[filled:] = bytes(len(buffer) - filled)
+                break
+            filled += count
+        self.bytes_read += filled
+        return len(buffer)
+
+
+class TranscodeStream(object):
+    """
+      Like Transcode, but without a temporary file: gives a PcmStream fed by
+      ffmpeg's stdout. The PCM size is computed from the WAV, AIFF or FLAC
+      header; other sources fall back to Transcode and give a file name.
+      16-bit WAV and AIFF are read in process without ffmpeg.
+      With a TranscodeCache, sources that need ffmpeg go through the cache
+      like with Transcode instead, and give the file name of the cached PCM.
+      Leaving the context without an exception raises TranscodeError when
+      ffmpeg failed or the stream was padded with more than
+      PADDING_TOLERANCE bytes of silence.
+    """
+
+    __PIPE_BUFFER_SIZE = 1 << 20
+
+    def __init__(self, track_filename, cache=None):
+        self.track_filename = track_filename
+        self.cache = cache
+        self.process = None
+        self.reader = None
+        self.fallback = None
+        self.stream = None
+
+    def __enter__(self):
+        info = read_source_info(self.track_filename)
+        if info is not None and is_native_supported(info):
+            self.reader = NativePcmReader(self.track_filename, info)
+            self.stream = PcmStream(self.reader, pcm_size(info))
+            return self.stream
+
+        if info is None or self.cache is not None:
+            self.fallback = Transcode(self.track_filename, self.cache)
+            return self.fallback.__enter__()
+
+        self.process = subprocess.Popen(
+            ['ffmpeg', '-i', self.track_filename, '-f', 's16be', 'pipe:1'],
+            stdout=subprocess.PIPE, stderr=DEV_NULL,
+            bufsize=TranscodeStream.__PIPE_BUFFER_SIZE
+        )
+        self.stream = PcmStream(self.process.stdout, pcm_size(info))
+        return self.stream
+
+    def __exit__(self, type, value, traceback):
+        if self.fallback is not None:
+            return self.fallback.__exit__(type, value, traceback)
+        if self.reader is not None:
+            self.reader.close()
+        else:
+            if type is None:
+                # let ffmpeg finish, so its exit status is meaningful
+                while self.process.stdout.read(TranscodeStream.__PIPE_BUFFER_SIZE):
+                    pass
+            # closing the pipe stops ffmpeg if the upload ended early
+            self.process.stdout.close()
+            self.process.wait()
+        if type is not None:
+            return
+        if self.process is not None and self.process.returncode != 0:
+            raise TranscodeError('ffmpeg failed on %s with exit code %d' % (
+                self.track_filename, self.process.returncode))
+        if self.stream.padding > PADDING_TOLERANCE:
+            raise TranscodeError('%s gave %d bytes of PCM, %d short of the expected %d' % (
+                self.track_filename, self.stream.bytes_read, self.stream.padding,
+                self.stream.size))